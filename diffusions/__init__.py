@@ -1,10 +1,13 @@
-from .schedule import get_beta_schedule, get_respaced_seq
+from .schedule import get_beta_schedule, get_respaced_seq, get_noise_schedule, NoiseSchedule
+from .cfg_schedule import CFGSchedule
 
 from .ddpm import DDPM, DDPMCFG
 from .ddim import DDIM, DDIMCFG
 from .euler import EulerSampler
 from .heun import HeunSampler
+from .trajectory import TrajectoryRecorder
+from .inversion import InversionPipeline, NoiseCache
 
 from .guidance.ilvr import ILVR
-from .guidance.mask_guidance import MaskGuidance
+from .guidance.mask_guidance import MaskGuidance, RePaintScheduler
 from .guidance.clip_guidance import CLIPGuidance
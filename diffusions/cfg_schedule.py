@@ -0,0 +1,198 @@
+import math
+from typing import Any, Dict, Tuple, Union
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+class CFGSchedule:
+    def __init__(
+            self,
+            guidance_scale: Union[float, Tensor] = 1.,
+            interval: Tuple[float, float] = (0., 1.),
+            scaling: str = 'constant',
+            scale_pow: float = 4.,
+            total_steps: int = 1000,
+    ):
+        """Schedule of classifier-free guidance scale over timesteps.
+
+        The guidance scale at timestep t is determined by the normalized timestep r = t / total_steps, where r=1 is
+        pure noise and r=0 is the clean image:
+         - Outside `interval`, the scale is 1, i.e., non-guided conditional generation, so only the conditional branch
+           is evaluated and the unconditional pass is skipped. For example, `interval=(0.4, 1.0)` turns off guidance
+           on the last 40% of the timesteps, and `interval=(0.2, 0.8)` applies guidance only in the middle [1].
+         - Inside `interval`, the scale is `1 + (guidance_scale - 1) * w(r)`, where w is given by `scaling`:
+            - 'constant': w(r) = 1.
+            - 'linear': w(r) = 1 - r, increasing linearly from 0 to 1 during sampling.
+            - 'power-cos': w(r) = (1 - cos(pi * (1 - r) ** scale_pow)) / 2, the power-cosine scaling of MDTv2 [2].
+
+        Args:
+            guidance_scale: Strength of guidance, with the same definition as in `DDPMCFG` and `DDIMCFG`. Either a
+             float, or a Tensor of shape [B] giving the scale of each row in a batch.
+            interval: Range of normalized timesteps (inclusive) where guidance is applied.
+            scaling: Scaling of guidance scale inside the interval. Options: 'constant', 'linear', 'power-cos'.
+            scale_pow: Power of 'power-cos' scaling.
+            total_steps: Total number of timesteps of the diffusion process.
+
+        References:
+            [1] Kynkäänniemi, Tuomas, Miika Aittala, Tero Karras, Samuli Laine, Timo Aila, and Jaakko Lehtinen.
+            "Applying guidance in a limited interval improves sample and distribution quality in diffusion models."
+            arXiv preprint arXiv:2404.07724 (2024).
+
+            [2] Gao, Shanghua, Pan Zhou, Ming-Ming Cheng, and Shuicheng Yan. "MDTv2: Masked Diffusion Transformer is a
+            Strong Image Synthesizer." arXiv preprint arXiv:2303.14389 (2023).
+
+        """
+        if scaling not in ['constant', 'linear', 'power-cos']:
+            raise ValueError(f'Invalid scaling: {scaling}')
+        self.guidance_scale = guidance_scale
+        self.interval = tuple(interval)
+        self.scaling = scaling
+        self.scale_pow = scale_pow
+        self.total_steps = total_steps
+
+    def __call__(self, t: int):
+        """Return the guidance scale at timestep t, a float or a Tensor of shape [B] like `guidance_scale`."""
+        r = t / self.total_steps
+        if not self.interval[0] <= r <= self.interval[1]:
+            return 1.
+        if self.scaling == 'constant':
+            w = 1.
+        elif self.scaling == 'linear':
+            w = 1. - r
+        else:
+            w = (1. - math.cos(math.pi * (1. - r) ** self.scale_pow)) / 2
+        return 1. + (self.guidance_scale - 1.) * w
+
+
+def _batched_tensors(x: Any, batch_size: int):
+    """Collect Tensors with batch dimension `batch_size` in x, which can be a Tensor or a (nested) dict / list. """
+    if isinstance(x, Tensor):
+        return [x] if x.dim() > 0 and x.shape[0] == batch_size else []
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        return [t for v in x for t in _batched_tensors(v, batch_size)]
+    return []
+
+
+def _index_batch(x: Any, index: Tensor, batch_size: int):
+    """Index the batch dimension of Tensors in x, leaving other values unchanged. """
+    if isinstance(x, Tensor):
+        return x[index] if x.dim() > 0 and x.shape[0] == batch_size else x
+    if isinstance(x, dict):
+        return {k: _index_batch(v, index, batch_size) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_index_batch(v, index, batch_size) for v in x)
+    return x
+
+
+def dedup_model_call(model: nn.Module, img: Tensor, t_batch: Tensor, model_kwargs: Dict):
+    """Evaluate the model only on unique rows of the batch, and scatter the outputs back to all rows.
+
+    Two rows are identical if their inputs, timesteps and all batched Tensors in `model_kwargs` (including those
+    nested in dicts, e.g., the condition dict of SDXL) are exactly equal. Detecting duplicates costs a few sorts over
+    the batch, which is negligible compared to a forward pass of the model.
+
+    """
+    B = img.shape[0]
+    keys = [img, t_batch] + _batched_tensors(model_kwargs, B)
+    row_ids = [torch.unique(k.reshape(B, -1), dim=0, return_inverse=True)[1] for k in keys]
+    unique_ids, inverse = torch.unique(torch.stack(row_ids, dim=1), dim=0, return_inverse=True)
+    n_unique = unique_ids.shape[0]
+    if n_unique == B:
+        return model(img, t_batch, **model_kwargs)
+    arange = torch.arange(B, device=inverse.device)
+    first = torch.full((n_unique, ), B, device=inverse.device).scatter_reduce_(0, inverse, arange, reduce='amin')
+    model_output = model(img[first], t_batch[first], **_index_batch(model_kwargs, first, B))
+    return model_output[inverse]
+
+
+def cfg_model_output(
+        model: nn.Module, img: Tensor, t_batch: Tensor, guidance_scale: Union[float, Tensor],
+        model_kwargs: Dict, uncond_model_kwargs: Dict, predict_eps, dedup_rows: bool = False,
+):
+    """Evaluate the model with classifier-free guidance and return the guided eps.
+
+    The unconditional branch is skipped when `guidance_scale` is 1, and the conditional branch is skipped when it
+    is 0, so a step costs one model evaluation instead of two outside the guidance interval of a `CFGSchedule`.
+    With per-row guidance scales, the unconditional branch is evaluated only on the rows whose scale is not 1.
+
+    Args:
+        model: The model.
+        img: The noisy samples.
+        t_batch: The timesteps of shape [B].
+        guidance_scale: Strength of guidance, a float or a Tensor of shape [B].
+        model_kwargs: Arguments passed to the model in the conditional branch.
+        uncond_model_kwargs: Arguments passed to the model in the unconditional branch.
+        predict_eps: Function that converts model output (of the rows given by the second argument, or all rows if
+         it is None) to predicted eps.
+        dedup_rows: Evaluate each branch only on its unique rows by `dedup_model_call()`.
+
+    Returns:
+        A tuple of the guided eps and the raw model output of the conditional branch (or the only evaluated branch),
+        from which extra channels (e.g., the learned variance) can be taken.
+
+    """
+    if dedup_rows:
+        call = dedup_model_call
+    else:
+        def call(m, x, t, kwargs):
+            return m(x, t, **kwargs)
+
+    rows = None
+    if not isinstance(guidance_scale, Tensor):
+        guidance_scale = float(guidance_scale)
+    else:
+        guided = guidance_scale != 1.
+        if torch.all(guidance_scale == 0.):
+            guidance_scale = 0.
+        elif not torch.any(guided):
+            guidance_scale = 1.
+        elif not torch.all(guided):
+            rows = torch.nonzero(guided).squeeze(dim=1)
+
+    if isinstance(guidance_scale, float) and guidance_scale == 1.:
+        model_output = call(model, img, t_batch, model_kwargs)
+        return predict_eps(model_output, None), model_output
+    if isinstance(guidance_scale, float) and guidance_scale == 0.:
+        model_output = call(model, img, t_batch, uncond_model_kwargs)
+        return predict_eps(model_output, None), model_output
+    if isinstance(guidance_scale, Tensor):
+        guidance_scale = guidance_scale.reshape(-1, *([1] * (img.dim() - 1)))
+    # conditional branch
+    model_output_cond = call(model, img, t_batch, model_kwargs)
+    pred_eps_cond = predict_eps(model_output_cond, None)
+    if rows is None:
+        # unconditional branch
+        model_output_uncond = call(model, img, t_batch, uncond_model_kwargs)
+        pred_eps_uncond = predict_eps(model_output_uncond, None)
+        # combine
+        pred_eps = (1 - guidance_scale) * pred_eps_uncond + guidance_scale * pred_eps_cond
+        return pred_eps, model_output_cond
+    # unconditional branch, only on the guided rows
+    B = img.shape[0]
+    model_output_uncond = call(
+        model, img[rows], t_batch[rows], _index_batch(uncond_model_kwargs, rows, B),
+    )
+    pred_eps_uncond = predict_eps(model_output_uncond, rows)
+    # combine
+    pred_eps = pred_eps_cond.clone()
+    scale = guidance_scale[rows]
+    pred_eps[rows] = (1 - scale) * pred_eps_uncond + scale * pred_eps_cond[rows]
+    return pred_eps, model_output_cond
+
+
+def _test():
+    schedules = [
+        CFGSchedule(guidance_scale=7.5, interval=(0.4, 1.0), scaling='constant'),
+        CFGSchedule(guidance_scale=7.5, scaling='linear'),
+        CFGSchedule(guidance_scale=7.5, scaling='power-cos'),
+    ]
+    for t in range(999, -1, -111):
+        print(t, [round(schedule(t), 4) for schedule in schedules])
+
+
+if __name__ == '__main__':
+    _test()
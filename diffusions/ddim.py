@@ -1,5 +1,5 @@
 import tqdm
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Union
 from contextlib import contextmanager
 
 import torch
@@ -7,6 +7,7 @@ import torch.nn as nn
 from torch import Tensor
 
 from diffusions.ddpm import DDPM
+from diffusions.cfg_schedule import CFGSchedule, cfg_model_output
 
 
 class DDIM(DDPM):
@@ -73,7 +74,7 @@ class DDIM(DDPM):
                 torch.sqrt(1. - alphas_cumprod_t_prev - var) * pred_eps)
 
         # Sample x{t-1}
-        reverse_eps = torch.randn_like(xt)
+        reverse_eps = self.randn_like(xt)
         sample = mean if t == 0 else mean + torch.sqrt(var) * reverse_eps
 
         return {
@@ -133,15 +134,35 @@ class DDIM(DDPM):
 
 
 class DDIMCFG(DDIM):
-    def __init__(self, guidance_scale: float = 1., cond_kwarg: str = 'y', *args, **kwargs):
+    def __init__(
+            self,
+            guidance_scale: float = 1.,
+            cond_kwarg: str = 'y',
+            guidance_interval: Tuple[float, float] = (0., 1.),
+            guidance_scaling: str = 'constant',
+            guidance_scale_pow: float = 4.,
+            dedup_rows: bool = False,
+            *args, **kwargs,
+    ):
         """Denoising Diffusion Implicit Models with Classifier-Free Guidance.
 
         Args:
             guidance_scale: Strength of guidance. Note we actually use the definition in classifier guidance paper
              instead of classifier-free guidance paper. Specifically, let the former be `s` and latter be `w`, then we
              have `s=w+1`, where `s=0` means unconditional generation, `s=1` means non-guided conditional generation,
-             and `s>1` means guided conditional generation.
+             and `s>1` means guided conditional generation. It can be overridden in each call of `sample_loop()`
+             by a float, or a Tensor of shape [B] giving the scale of each row, so that rows with different scales
+             can be sampled in one batch.
             cond_kwarg: Name of the condition argument passed to model. Default to `y`.
+            guidance_interval: Range of normalized timesteps (t / total_steps) where guidance is applied. Outside the
+             interval, only the conditional branch is evaluated. See `CFGSchedule` for details.
+            guidance_scaling: Scaling of guidance scale over timesteps. Options: 'constant', 'linear', 'power-cos'.
+            guidance_scale_pow: Power of 'power-cos' scaling.
+            dedup_rows: Evaluate the model only once for identical rows in a batch, i.e., rows with exactly the same
+             noisy sample and condition, and share the output. Note that rows sharing the initial noise and the
+             negative prompt but with different prompts are identical in the unconditional branch only at the first
+             step, because their samples diverge afterwards. So the saving is large only if the batch contains
+             duplicated (noise, condition) pairs, e.g., a prompt grid where rows repeat the same prompt and seed.
 
         References:
             [1] Song, Jiaming, Chenlin Meng, and Stefano Ermon. "Denoising diffusion implicit models."
@@ -157,10 +178,24 @@ class DDIMCFG(DDIM):
         super().__init__(*args, **kwargs)
         self.guidance_scale = guidance_scale
         self.cond_kwarg = cond_kwarg
+        self.guidance_interval = guidance_interval
+        self.guidance_scaling = guidance_scaling
+        self.guidance_scale_pow = guidance_scale_pow
+        self.dedup_rows = dedup_rows
+        self.get_cfg_schedule()  # validate arguments
+
+    def get_cfg_schedule(self, guidance_scale: Union[float, Tensor] = None):
+        return CFGSchedule(
+            guidance_scale=self.guidance_scale if guidance_scale is None else guidance_scale,
+            interval=self.guidance_interval,
+            scaling=self.guidance_scaling,
+            scale_pow=self.guidance_scale_pow,
+            total_steps=self.total_steps,
+        )
 
     def sample_loop(
             self, model: nn.Module, init_noise: Tensor, uncond_conditioning: Any = None,
-            tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
+            tqdm_kwargs: Dict = None, model_kwargs: Dict = None, guidance_scale: Union[float, Tensor] = None,
     ):
         tqdm_kwargs = dict() if tqdm_kwargs is None else tqdm_kwargs
 
@@ -168,6 +203,7 @@ class DDIMCFG(DDIM):
             raise ValueError(f'Condition argument `{self.cond_kwarg}` not found in model_kwargs.')
         uncond_model_kwargs = model_kwargs.copy()
         uncond_model_kwargs[self.cond_kwarg] = uncond_conditioning
+        cfg_schedule = self.get_cfg_schedule(guidance_scale)
 
         img = init_noise
         sample_seq = self.respaced_seq.tolist()
@@ -175,14 +211,13 @@ class DDIMCFG(DDIM):
         pbar = tqdm.tqdm(total=len(sample_seq), **tqdm_kwargs)
         for t, t_prev in zip(reversed(sample_seq), reversed(sample_seq_prev)):
             t_batch = torch.full((img.shape[0], ), t, device=self.device)
-            # conditional branch
-            model_output_cond = model(img, t_batch, **model_kwargs)
-            pred_eps_cond = self.predict(model_output_cond, img, t)['pred_eps']
-            # unconditional branch
-            model_output_uncond = model(img, t_batch, **uncond_model_kwargs)
-            pred_eps_uncond = self.predict(model_output_uncond, img, t)['pred_eps']
-            # combine
-            pred_eps = (1 - self.guidance_scale) * pred_eps_uncond + self.guidance_scale * pred_eps_cond
+            pred_eps, model_output_cond = cfg_model_output(
+                model, img, t_batch, cfg_schedule(t), model_kwargs, uncond_model_kwargs,
+                predict_eps=lambda model_output, rows: self.predict(
+                    model_output, img if rows is None else img[rows], t,
+                )['pred_eps'],
+                dedup_rows=self.dedup_rows,
+            )
             with self.hack_objective('pred_eps'):
                 out = self.denoise(pred_eps, img, t, t_prev)
             img = out['sample']
@@ -192,16 +227,18 @@ class DDIMCFG(DDIM):
 
     def sample(
             self, model: nn.Module, init_noise: Tensor, uncond_conditioning: Any = None,
-            tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
+            tqdm_kwargs: Dict = None, model_kwargs: Dict = None, guidance_scale: Union[float, Tensor] = None,
     ):
         sample = None
-        for out in self.sample_loop(model, init_noise, uncond_conditioning, tqdm_kwargs, model_kwargs):
+        for out in self.sample_loop(
+                model, init_noise, uncond_conditioning, tqdm_kwargs, model_kwargs, guidance_scale,
+        ):
             sample = out['sample']
         return sample
 
     def sample_inversion_loop(
             self, model: nn.Module, img: Tensor, uncond_conditioning: Any = None,
-            tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
+            tqdm_kwargs: Dict = None, model_kwargs: Dict = None, guidance_scale: Union[float, Tensor] = None,
     ):
         tqdm_kwargs = dict() if tqdm_kwargs is None else tqdm_kwargs
 
@@ -209,20 +246,20 @@ class DDIMCFG(DDIM):
             raise ValueError(f'Condition argument `{self.cond_kwarg}` not found in model_kwargs.')
         uncond_model_kwargs = model_kwargs.copy()
         uncond_model_kwargs[self.cond_kwarg] = uncond_conditioning
+        cfg_schedule = self.get_cfg_schedule(guidance_scale)
 
         sample_seq = self.respaced_seq[:-1].tolist()
         sample_seq_next = self.respaced_seq[1:].tolist()
         pbar = tqdm.tqdm(total=len(sample_seq), **tqdm_kwargs)
         for t, t_next in zip(sample_seq, sample_seq_next):
             t_batch = torch.full((img.shape[0], ), t, device=img.device, dtype=torch.long)
-            # conditional branch
-            model_output_cond = model(img, t_batch, **model_kwargs)
-            pred_eps_cond = self.predict(model_output_cond, img, t)['pred_eps']
-            # unconditional branch
-            model_output_uncond = model(img, t_batch, **uncond_model_kwargs)
-            pred_eps_uncond = self.predict(model_output_uncond, img, t)['pred_eps']
-            # combine
-            pred_eps = (1 - self.guidance_scale) * pred_eps_uncond + self.guidance_scale * pred_eps_cond
+            pred_eps, model_output_cond = cfg_model_output(
+                model, img, t_batch, cfg_schedule(t), model_kwargs, uncond_model_kwargs,
+                predict_eps=lambda model_output, rows: self.predict(
+                    model_output, img if rows is None else img[rows], t,
+                )['pred_eps'],
+                dedup_rows=self.dedup_rows,
+            )
             with self.hack_objective('pred_eps'):
                 out = self.denoise_inversion(pred_eps, img, t, t_next)
             img = out['sample']
@@ -233,11 +270,13 @@ class DDIMCFG(DDIM):
     def sample_inversion(
             self, model: nn.Module, img: Tensor,
             clip_denoised: bool = None, eta: float = None,
-            guidance_scale: float = None, uncond_conditioning: Any = None,
+            guidance_scale: Union[float, Tensor] = None, uncond_conditioning: Any = None,
             tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
     ):
         sample = None
-        for out in self.sample_inversion_loop(model, img, uncond_conditioning, tqdm_kwargs, model_kwargs):
+        for out in self.sample_inversion_loop(
+                model, img, uncond_conditioning, tqdm_kwargs, model_kwargs, guidance_scale,
+        ):
             sample = out['sample']
         return sample
 
@@ -1,5 +1,6 @@
+import copy
 import tqdm
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Union
 from contextlib import contextmanager
 
 import torch
@@ -7,7 +8,8 @@ import torch.nn as nn
 from torch import Tensor
 import torch.nn.functional as F
 
-from diffusions.schedule import get_beta_schedule, get_respaced_seq
+from diffusions.schedule import NoiseSchedule, get_noise_schedule
+from diffusions.cfg_schedule import CFGSchedule, cfg_model_output
 
 
 class DDPM:
@@ -19,6 +21,10 @@ class DDPM:
             beta_end: float = 0.02,
             betas: Tensor = None,
             objective: str = 'pred_eps',
+            loss_weighting: str = None,
+            min_snr_gamma: float = 5.0,
+            p2_gamma: float = 1.0,
+            p2_k: float = 1.0,
 
             var_type: str = 'fixed_large',
             clip_denoised: bool = True,
@@ -37,6 +43,12 @@ class DDPM:
             beta_end: Ending beta value.
             betas: A 1-D Tensor of pre-defined beta schedule. If provided, arguments `beta_*` will be ignored.
             objective: Prediction objective of the model. Options: 'pred_eps', 'pred_x0', 'pred_v'.
+            loss_weighting: Weighting of the training loss over timesteps. Options: None, 'min_snr', 'p2', 'v'. The
+             weights are defined w.r.t. the eps loss, and converted to the loss of `objective`, so each option means
+             the same weighting regardless of the objective.
+            min_snr_gamma: Parameter gamma of min-SNR weighting, i.e., min(SNR, gamma) / SNR.
+            p2_gamma: Parameter gamma of P2 weighting, i.e., 1 / (k + SNR) ^ gamma.
+            p2_k: Parameter k of P2 weighting.
 
             var_type: Type of variance of the reverse process. Options: 'fixed_large', 'fixed_small', 'learned_range'.
             clip_denoised: Clip the predicted x0 in range [-1, 1].
@@ -56,35 +68,51 @@ class DDPM:
             [3] Salimans, Tim, and Jonathan Ho. "Progressive distillation for fast sampling of diffusion models."
             arXiv preprint arXiv:2202.00512 (2022).
 
+            [4] Hang, Tiankai, Shuyang Gu, Chen Li, Jianmin Bao, Dong Chen, Han Hu, Xin Geng, and Baining Guo.
+            "Efficient diffusion training via min-snr weighting strategy." In Proceedings of the IEEE/CVF
+            International Conference on Computer Vision, pp. 7441-7451. 2023.
+
+            [5] Choi, Jooyoung, Jungbeom Lee, Chaehun Shin, Sungwon Kim, Hyunwoo Kim, and Sungroh Yoon. "Perception
+            prioritized training of diffusion models." In Proceedings of the IEEE/CVF Conference on Computer Vision and
+            Pattern Recognition, pp. 11472-11481. 2022.
+
         """
         if objective not in ['pred_eps', 'pred_x0', 'pred_v']:
             raise ValueError(f'Invalid objective: {objective}')
+        if loss_weighting not in [None, 'min_snr', 'p2', 'v']:
+            raise ValueError(f'Invalid loss_weighting: {loss_weighting}')
         if var_type not in ['fixed_small', 'fixed_large', 'learned_range']:
             raise ValueError(f'Invalid var_type: {var_type}')
 
         self.total_steps = total_steps
         self.objective = objective
+        self.loss_weighting = loss_weighting
+        self.min_snr_gamma = min_snr_gamma
+        self.p2_gamma = p2_gamma
+        self.p2_k = p2_k
         self.var_type = var_type
         self.clip_denoised = clip_denoised
         self.device = device
+        self.generator = None
 
-        # Define betas and alphas
+        # Define betas and alphas, the schedule is shared by all the diffusers with the same parameters
         if betas is None:
-            betas = get_beta_schedule(
+            self.schedule = get_noise_schedule(
                 total_steps=total_steps,
                 beta_schedule=beta_schedule,
                 beta_start=beta_start,
                 beta_end=beta_end,
+                device=device,
             )
-        assert isinstance(betas, Tensor)
-        assert betas.shape == (total_steps, )
-        alphas = 1. - betas
-        self.alphas_cumprod = torch.cumprod(alphas, dim=0).to(device, torch.float)
+        else:
+            assert isinstance(betas, Tensor)
+            assert betas.shape == (total_steps, )
+            self.schedule = NoiseSchedule(betas, device=device)
+        self.alphas_cumprod = self.schedule.alphas_cumprod
 
         # Define respaced sequence for sampling
         if respaced_seq is None:
-            respaced_seq = get_respaced_seq(
-                total_steps=total_steps,
+            respaced_seq = self.schedule.get_respaced_seq(
                 respace_type=respace_type,
                 respace_steps=respace_steps,
             )
@@ -93,11 +121,51 @@ class DDPM:
         self.respaced_seq = respaced_seq.to(device)
 
     def set_respaced_seq(self, respace_type: str = 'uniform', respace_steps: int = 100):
-        self.respaced_seq = get_respaced_seq(
-            total_steps=self.total_steps,
+        self.respaced_seq = self.schedule.get_respaced_seq(
             respace_type=respace_type,
             respace_steps=respace_steps,
-        ).to(self.device)
+        )
+
+    def with_options(self, respace_type: str = None, respace_steps: int = None, **options):
+        """Return a shallow copy of the diffuser with some options replaced, e.g., `eta`, `var_type`, `clip_denoised`
+        or `guidance_scale`. The copy shares the noise schedule, so it is cheap to create one per request.
+
+        Args:
+            respace_type: Type of respaced timestep sequence. Default to 'uniform' if only `respace_steps` is given.
+            respace_steps: Length of respaced timestep sequence. Default to the length of the current sequence.
+            options: Other attributes to replace.
+
+        """
+        diffuser = copy.copy(self)
+        if respace_type is not None or respace_steps is not None:
+            diffuser.set_respaced_seq(
+                respace_type=respace_type or 'uniform',
+                respace_steps=respace_steps or len(self.respaced_seq),
+            )
+        for k, v in options.items():
+            if not hasattr(self, k):
+                raise ValueError(f'Invalid option: {k}')
+            setattr(diffuser, k, v)
+        if diffuser.var_type not in ['fixed_small', 'fixed_large', 'learned_range']:
+            raise ValueError(f'Invalid var_type: {diffuser.var_type}')
+        return diffuser
+
+    def randn_like(self, x: Tensor):
+        """Draw the noise used in sampling, from `self.generator` if it is set. """
+        if self.generator is None:
+            return torch.randn_like(x)
+        return self.generator.randn_like(x)
+
+    @contextmanager
+    def use_generator(self, generator):
+        """Draw the noise used in sampling from `generator`, e.g., `utils.misc.SampleGenerator`, which should have
+        a `randn_like()` method. """
+        tmp = self.generator
+        self.generator = generator
+        try:
+            yield
+        finally:
+            self.generator = tmp
 
     def pred_x0_from_eps(self, xt: Tensor, t: int, eps: Tensor):
         sqrt_recip_alphas_cumprod_t = (1. / self.alphas_cumprod[t]) ** 0.5
@@ -119,24 +187,85 @@ class DDPM:
         sqrt_one_minus_alphas_cumprod = (1. - self.alphas_cumprod[t]) ** 0.5
         return sqrt_one_minus_alphas_cumprod * xt + sqrt_alphas_cumprod_t * v
 
-    def loss_func(self, model: nn.Module, x0: Tensor, t: Tensor, eps: Tensor = None, model_kwargs: Dict = None):
+    def loss_func(
+            self, model: nn.Module, x0: Tensor, t: Tensor, eps: Tensor = None, model_kwargs: Dict = None,
+            weights: Tensor = None, reduction: str = 'mean',
+    ):
+        """Training loss.
+
+        Args:
+            model: The model to train.
+            x0: A Tensor of shape [B, D, ...], the original samples.
+            t: A Tensor of shape [B], timesteps for each sample in x0.
+            eps: A Tensor of shape [B, D, ...], the noise added to the original samples.
+            model_kwargs: Additional arguments passed to the model.
+            weights: A Tensor of shape [B], additional weights for each sample, e.g., the importance weights given by
+             a timestep sampler.
+            reduction: 'mean' to return the averaged loss, or 'none' to return the loss of each sample.
+
+        """
         model_kwargs = dict() if model_kwargs is None else model_kwargs
         eps = torch.randn_like(x0) if eps is None else eps
 
         xt = self.diffuse(x0, t, eps)
         if self.objective == 'pred_eps':
             pred_eps = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_eps, eps)
+            return self.weighted_mse_loss(pred_eps, eps, t, weights, reduction)
         elif self.objective == 'pred_x0':
             pred_x0 = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_x0, x0)
+            return self.weighted_mse_loss(pred_x0, x0, t, weights, reduction)
         elif self.objective == 'pred_v':
             v = self.get_v(x0, eps, t)
             pred_v = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_v, v)
+            return self.weighted_mse_loss(pred_v, v, t, weights, reduction)
         else:
             raise ValueError(f'Objective {self.objective} is not supported.')
 
+    def weighted_mse_loss(
+            self, pred: Tensor, target: Tensor, t: Tensor, weights: Tensor = None, reduction: str = 'mean',
+    ):
+        loss = F.mse_loss(pred, target, reduction='none')
+        loss = loss.mean(dim=tuple(range(1, loss.ndim)))
+        if self.loss_weighting is not None:
+            loss = loss * self.get_loss_weights(t)
+        if weights is not None:
+            loss = loss * weights
+        if reduction == 'mean':
+            return loss.mean()
+        elif reduction == 'none':
+            return loss
+        else:
+            raise ValueError(f'Invalid reduction: {reduction}')
+
+    def get_loss_weights(self, t: Tensor):
+        """Loss weights of timesteps t for the current objective.
+
+        Let SNR = alpha_bar / (1 - alpha_bar). The mse of x0 and v relate to the mse of eps by:
+            mse(x0) = mse(eps) / SNR,  mse(v) = mse(eps) * (SNR + 1) / SNR.
+        Weights are defined w.r.t. mse(eps) and divided by the corresponding factor.
+
+        """
+        alphas_cumprod_t = self.alphas_cumprod[t]
+        snr = alphas_cumprod_t / (1. - alphas_cumprod_t)
+        # SNR is 0 at the last timestep of zero terminal SNR schedules, clamp it to avoid dividing by zero
+        snr = torch.clamp(snr, min=1e-8)
+        if self.loss_weighting is None:
+            weights = torch.ones_like(snr)
+        elif self.loss_weighting == 'min_snr':
+            weights = torch.clamp(snr, max=self.min_snr_gamma) / snr
+        elif self.loss_weighting == 'p2':
+            weights = 1. / (self.p2_k + snr) ** self.p2_gamma
+        elif self.loss_weighting == 'v':
+            weights = (snr + 1.) / snr
+        else:
+            raise ValueError(f'Invalid loss_weighting: {self.loss_weighting}')
+
+        if self.objective == 'pred_x0':
+            weights = weights * snr
+        elif self.objective == 'pred_v':
+            weights = weights * snr / (snr + 1.)
+        return weights
+
     def get_v(self, x0: Tensor, eps: Tensor, t: Tensor):
         sqrt_alphas_cumprod_t = self.alphas_cumprod[t] ** 0.5
         while sqrt_alphas_cumprod_t.ndim < x0.ndim:
@@ -248,7 +377,7 @@ class DDPM:
                 raise ValueError(f'Invalid var_type: {self.var_type}')
 
         # Sample x{t-1}
-        reverse_eps = torch.randn_like(xt)
+        reverse_eps = self.randn_like(xt)
         sample = mean if t == 0 else mean + torch.sqrt(var) * reverse_eps
 
         return {
@@ -291,15 +420,35 @@ class DDPM:
 
 
 class DDPMCFG(DDPM):
-    def __init__(self, guidance_scale: float = 1., cond_kwarg: str = 'y', *args, **kwargs):
+    def __init__(
+            self,
+            guidance_scale: float = 1.,
+            cond_kwarg: str = 'y',
+            guidance_interval: Tuple[float, float] = (0., 1.),
+            guidance_scaling: str = 'constant',
+            guidance_scale_pow: float = 4.,
+            dedup_rows: bool = False,
+            *args, **kwargs,
+    ):
         """Denoising Diffusion Probabilistic Models with Classifier-Free Guidance.
 
         Args:
             guidance_scale: Strength of guidance. Note we actually use the definition in classifier guidance paper
              instead of classifier-free guidance paper. Specifically, let the former be `s` and latter be `w`, then we
              have `s=w+1`, where `s=0` means unconditional generation, `s=1` means non-guided conditional generation,
-             and `s>1` means guided conditional generation.
+             and `s>1` means guided conditional generation. It can be overridden in each call of `sample_loop()`
+             by a float, or a Tensor of shape [B] giving the scale of each row, so that rows with different scales
+             can be sampled in one batch.
             cond_kwarg: Name of the condition argument passed to model. Default to `y`.
+            guidance_interval: Range of normalized timesteps (t / total_steps) where guidance is applied. Outside the
+             interval, only the conditional branch is evaluated. See `CFGSchedule` for details.
+            guidance_scaling: Scaling of guidance scale over timesteps. Options: 'constant', 'linear', 'power-cos'.
+            guidance_scale_pow: Power of 'power-cos' scaling.
+            dedup_rows: Evaluate the model only once for identical rows in a batch, i.e., rows with exactly the same
+             noisy sample and condition, and share the output. Note that rows sharing the initial noise and the
+             negative prompt but with different prompts are identical in the unconditional branch only at the first
+             step, because their samples diverge afterwards. So the saving is large only if the batch contains
+             duplicated (noise, condition) pairs, e.g., a prompt grid where rows repeat the same prompt and seed.
 
         References:
             [1] Ho, Jonathan, Ajay Jain, and Pieter Abbeel. "Denoising diffusion probabilistic models."
@@ -315,10 +464,24 @@ class DDPMCFG(DDPM):
         super().__init__(*args, **kwargs)
         self.guidance_scale = guidance_scale
         self.cond_kwarg = cond_kwarg
+        self.guidance_interval = guidance_interval
+        self.guidance_scaling = guidance_scaling
+        self.guidance_scale_pow = guidance_scale_pow
+        self.dedup_rows = dedup_rows
+        self.get_cfg_schedule()  # validate arguments
+
+    def get_cfg_schedule(self, guidance_scale: Union[float, Tensor] = None):
+        return CFGSchedule(
+            guidance_scale=self.guidance_scale if guidance_scale is None else guidance_scale,
+            interval=self.guidance_interval,
+            scaling=self.guidance_scaling,
+            scale_pow=self.guidance_scale_pow,
+            total_steps=self.total_steps,
+        )
 
     def sample_loop(
             self, model: nn.Module, init_noise: Tensor, uncond_conditioning: Any = None,
-            tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
+            tqdm_kwargs: Dict = None, model_kwargs: Dict = None, guidance_scale: Union[float, Tensor] = None,
     ):
         tqdm_kwargs = dict() if tqdm_kwargs is None else tqdm_kwargs
 
@@ -326,6 +489,7 @@ class DDPMCFG(DDPM):
             raise ValueError(f'Condition argument `{self.cond_kwarg}` not found in model_kwargs.')
         uncond_model_kwargs = model_kwargs.copy()
         uncond_model_kwargs[self.cond_kwarg] = uncond_conditioning
+        cfg_schedule = self.get_cfg_schedule(guidance_scale)
 
         img = init_noise
         sample_seq = self.respaced_seq.tolist()
@@ -333,14 +497,13 @@ class DDPMCFG(DDPM):
         pbar = tqdm.tqdm(total=len(sample_seq), **tqdm_kwargs)
         for t, t_prev in zip(reversed(sample_seq), reversed(sample_seq_prev)):
             t_batch = torch.full((img.shape[0], ), t, device=self.device)
-            # conditional branch
-            model_output_cond = model(img, t_batch, **model_kwargs)
-            pred_eps_cond = self.predict(model_output_cond, img, t)['pred_eps']
-            # unconditional branch
-            model_output_uncond = model(img, t_batch, **uncond_model_kwargs)
-            pred_eps_uncond = self.predict(model_output_uncond, img, t)['pred_eps']
-            # combine
-            pred_eps = (1 - self.guidance_scale) * pred_eps_uncond + self.guidance_scale * pred_eps_cond
+            pred_eps, model_output_cond = cfg_model_output(
+                model, img, t_batch, cfg_schedule(t), model_kwargs, uncond_model_kwargs,
+                predict_eps=lambda model_output, rows: self.predict(
+                    model_output, img if rows is None else img[rows], t,
+                )['pred_eps'],
+                dedup_rows=self.dedup_rows,
+            )
             if self.var_type == 'learned_range':
                 pred_eps = torch.cat([pred_eps, model_output_cond[:, pred_eps.shape[1]:]], dim=1)
             with self.hack_objective('pred_eps'):
@@ -352,10 +515,12 @@ class DDPMCFG(DDPM):
 
     def sample(
             self, model: nn.Module, init_noise: Tensor, uncond_conditioning: Any = None,
-            tqdm_kwargs: Dict = None, model_kwargs: Dict = None,
+            tqdm_kwargs: Dict = None, model_kwargs: Dict = None, guidance_scale: Union[float, Tensor] = None,
     ):
         sample = None
-        for out in self.sample_loop(model, init_noise, uncond_conditioning, tqdm_kwargs, model_kwargs):
+        for out in self.sample_loop(
+                model, init_noise, uncond_conditioning, tqdm_kwargs, model_kwargs, guidance_scale,
+        ):
             sample = out['sample']
         return sample
 
@@ -2,7 +2,6 @@ from typing import Dict
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from torch import Tensor
 
 from diffusions import DDPM
@@ -26,7 +25,10 @@ class DDPM_IP(DDPM):
         super().__init__(*args, **kwargs)
         self.gamma = gamma
 
-    def loss_func(self, model: nn.Module, x0: Tensor, t: Tensor, eps: Tensor = None, model_kwargs: Dict = None):
+    def loss_func(
+            self, model: nn.Module, x0: Tensor, t: Tensor, eps: Tensor = None, model_kwargs: Dict = None,
+            weights: Tensor = None, reduction: str = 'mean',
+    ):
         if model_kwargs is None:
             model_kwargs = dict()
         if eps is None:
@@ -36,13 +38,13 @@ class DDPM_IP(DDPM):
         xt = self.diffuse(x0, t, perturbed_eps)
         if self.objective == 'pred_eps':
             pred_eps = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_eps, eps)
+            return self.weighted_mse_loss(pred_eps, eps, t, weights, reduction)
         elif self.objective == 'pred_x0':
             pred_x0 = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_x0, x0)
+            return self.weighted_mse_loss(pred_x0, x0, t, weights, reduction)
         elif self.objective == 'pred_v':
             v = self.get_v(x0, eps, t)
             pred_v = model(xt, t, **model_kwargs)
-            return F.mse_loss(pred_v, v)
+            return self.weighted_mse_loss(pred_v, v, t, weights, reduction)
         else:
             raise ValueError(f'Objective {self.objective} is not supported.')
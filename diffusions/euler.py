@@ -45,7 +45,7 @@ class EulerSampler(DDPM):
             **kwargs,
         )
 
-        self.sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod).sqrt()
+        self.sigmas = self.schedule.sigmas
 
     def denoise(self, model_output: Tensor, xt: Tensor, t: int, t_prev: int):
         """Denoise from x_t to x_{t-1}."""
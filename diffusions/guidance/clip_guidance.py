@@ -1,11 +1,12 @@
+from typing import Tuple
+
 import torch
+import torch.nn.functional as F
 from torch import Tensor
-import torchvision.transforms as T
 
 from transformers import CLIPProcessor, CLIPModel
 
 from diffusions.guidance.base import BaseGuidance
-from utils.misc import image_norm_to_uint8
 
 
 class CLIPGuidance(BaseGuidance):
@@ -21,30 +22,89 @@ class CLIPGuidance(BaseGuidance):
             self,
             guidance_weight: float = 1.0,
             clip_pretrained: str = 'openai/clip-vit-base-patch32',
+            clip_dtype: str = 'float32',
+            n_cutouts: int = 0,
+            cutout_size_ratio: Tuple[float, float] = (0.5, 1.0),
             **kwargs,
     ):
+        """
+        Args:
+            guidance_weight: Weight of CLIP guidance.
+            clip_pretrained: Name or path of the pretrained CLIP model.
+            clip_dtype: Data type of the CLIP model, e.g., 'float32' or 'float16'.
+            n_cutouts: Number of random square cutouts of each image fed to CLIP. The similarities are averaged over
+             the cutouts. If 0, the whole image is used without augmentation.
+            cutout_size_ratio: Range of the edge length of the cutouts relative to the shorter edge of the image.
+
+        """
         super().__init__(**kwargs)
         self.guidance_weight = guidance_weight
+        self.n_cutouts = n_cutouts
+        self.cutout_size_ratio = cutout_size_ratio
 
+        self.clip_dtype = getattr(torch, clip_dtype)
         self.clip_processor = CLIPProcessor.from_pretrained(clip_pretrained)
-        self.clip_model = CLIPModel.from_pretrained(clip_pretrained).to(self.device)
+        self.clip_model = CLIPModel.from_pretrained(clip_pretrained, torch_dtype=self.clip_dtype).to(self.device)
+        self.clip_model.eval().requires_grad_(False)
+
+        # the preprocessing of CLIPProcessor, reimplemented with differentiable tensor ops on device
+        image_processor = self.clip_processor.image_processor
+        crop_size = image_processor.crop_size
+        self.clip_size = crop_size['height'] if isinstance(crop_size, dict) else crop_size
+        self.clip_mean = torch.tensor(image_processor.image_mean, device=self.device).reshape(1, -1, 1, 1)
+        self.clip_std = torch.tensor(image_processor.image_std, device=self.device).reshape(1, -1, 1, 1)
 
         self.text = None
+        self.text_embeds = None
 
+    @torch.no_grad()
     def set_text(self, text: str):
         assert isinstance(text, str)
         self.text = text
+        # the text embedding does not change during sampling, so it is computed only once here
+        tokens = self.clip_processor.tokenizer(text=text, return_tensors='pt', padding=True)
+        tokens = {k: v.to(self.device) for k, v in tokens.items()}
+        text_embeds = self.clip_model.get_text_features(**tokens).float()
+        self.text_embeds = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+
+    def preprocess(self, images: Tensor):
+        """Resize, center crop and normalize images in [-1, 1] to the input of CLIP, differentiably. """
+        images = (images + 1) / 2
+        H, W = images.shape[-2:]
+        scale = self.clip_size / min(H, W)
+        size = (max(self.clip_size, round(H * scale)), max(self.clip_size, round(W * scale)))
+        images = F.interpolate(images, size=size, mode='bicubic', align_corners=False, antialias=True)
+        top, left = (size[0] - self.clip_size) // 2, (size[1] - self.clip_size) // 2
+        images = images[:, :, top:top+self.clip_size, left:left+self.clip_size]
+        return (images - self.clip_mean) / self.clip_std
+
+    def make_cutouts(self, images: Tensor):
+        """Crop `n_cutouts` random squares of each image, returned as a batch of shape [n_cutouts * B, C, h, w]. """
+        H, W = images.shape[-2:]
+        min_ratio, max_ratio = self.cutout_size_ratio
+        cutouts = []
+        for _ in range(self.n_cutouts):
+            size = int(min(H, W) * (torch.rand(1).item() * (max_ratio - min_ratio) + min_ratio))
+            size = max(size, 1)
+            top = torch.randint(0, H - size + 1, (1, )).item()
+            left = torch.randint(0, W - size + 1, (1, )).item()
+            cutout = images[:, :, top:top+size, left:left+size]
+            cutouts.append(F.interpolate(
+                cutout, size=(self.clip_size, self.clip_size), mode='bicubic', align_corners=False, antialias=True,
+            ))
+        return torch.cat(cutouts, dim=0)
 
     @torch.enable_grad()
     def cond_fn_mean(self, t: int, xt: Tensor, pred_x0: Tensor, var: Tensor, **kwargs):
-        if self.text is None:
+        if self.text_embeds is None:
             raise RuntimeError('Please call `set_text()` before sampling.')
-        images = image_norm_to_uint8(pred_x0)
-        processed = self.clip_processor(text=self.text, images=images, return_tensors="pt", padding=True)
-        processed = {k: v.to(self.device) for k, v in processed.items()}
-        processed['pixel_values'].requires_grad_(True)
-        out = self.clip_model(**processed)
-        similarities = torch.matmul(out['image_embeds'], out['text_embeds'].t()).squeeze(dim=1)
-        grad = torch.autograd.grad(outputs=similarities.sum(), inputs=processed['pixel_values'])[0]
-        grad = T.Resize(xt.shape[-2:], antialias=True)(grad)
+        pred_x0 = pred_x0.detach().float().requires_grad_(True)
+        images = self.make_cutouts(pred_x0) if self.n_cutouts > 0 else pred_x0
+        # all the cutouts are encoded by a single forward pass of CLIP
+        pixel_values = self.preprocess(images).to(self.clip_dtype)
+        image_embeds = self.clip_model.get_image_features(pixel_values=pixel_values).float()
+        image_embeds = image_embeds / image_embeds.norm(dim=-1, keepdim=True)
+        similarities = torch.matmul(image_embeds, self.text_embeds.t()).squeeze(dim=1)
+        similarities = similarities.reshape(-1, pred_x0.shape[0]).mean(dim=0)
+        grad = torch.autograd.grad(outputs=similarities.sum(), inputs=pred_x0)[0]
         return self.guidance_weight * ((1. / self.alphas_cumprod[t]) ** 0.5) * var * grad
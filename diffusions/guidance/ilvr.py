@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import torch
 from torch import Tensor
 
@@ -27,26 +29,53 @@ class ILVR(BaseGuidance):
 
         """
         super().__init__(*args, **kwargs)
-        self.ref_images = ref_images
         self.downsample_factor = downsample_factor
         self.interp_method = getattr(interp_methods, interp_method)
+        self.ref_images = None
+        self.low_pass_ref_images = None
+        if ref_images is not None:
+            self.set_ref_images(ref_images)
 
     def set_ref_images(self, ref_images: Tensor):
         self.ref_images = ref_images
+        self.low_pass_ref_images = self.low_pass_filter(ref_images)
 
     def cond_fn_sample(self, t: int, t_prev: int, sample: Tensor, **kwargs):
         if self.ref_images is None:
             raise RuntimeError('Please call `set_ref_images()` before sampling.')
         if t == 0:
-            noisy_ref_images = self.ref_images
-        else:
-            noisy_ref_images = self.diffuse(
-                x0=self.ref_images,
-                t=torch.full((sample.shape[0], ), t_prev, device=self.device),
-            )
-        return self.low_pass_filter(noisy_ref_images) - self.low_pass_filter(sample)
+            return self.low_pass_ref_images - self.low_pass_filter(sample)
+        # The low-pass filter is linear, so for noisy_ref_images = sqrt(a) * ref_images + sqrt(1 - a) * eps,
+        # LP(noisy_ref_images) - LP(sample) = sqrt(a) * LP(ref_images) + LP(sqrt(1 - a) * eps - sample),
+        # where LP(ref_images) is precomputed and the filter is applied only once per step.
+        alphas_cumprod_t_prev = self.alphas_cumprod[t_prev]
+        eps = self.randn_like(self.ref_images)
+        return (torch.sqrt(alphas_cumprod_t_prev) * self.low_pass_ref_images +
+                self.low_pass_filter(torch.sqrt(1. - alphas_cumprod_t_prev) * eps - sample))
 
     def low_pass_filter(self, x: Tensor):
-        x = resize_right.resize(x, scale_factors=1./self.downsample_factor, interp_method=self.interp_method)
-        x = resize_right.resize(x, scale_factors=self.downsample_factor, interp_method=self.interp_method)
-        return x
+        """Downsample and then upsample x, as a single separable operator `Mh @ x @ Mw^T`. """
+        Mh, Mw = get_low_pass_matrices(
+            tuple(x.shape[-2:]), self.downsample_factor, self.interp_method, x.device, x.dtype,
+        )
+        return Mh @ x @ Mw.T
+
+
+@lru_cache(maxsize=16)
+def get_low_pass_matrices(img_size, downsample_factor, interp_method, device, dtype):
+    """Matrices of the down-up resizing along the height and width. """
+    down = resize_right.get_resize_plan(
+        img_size, scale_factors=1./downsample_factor, interp_method=interp_method, device=device, dtype=dtype,
+    )
+    up = resize_right.get_resize_plan(
+        down.out_shape, scale_factors=float(downsample_factor),
+        interp_method=interp_method, device=device, dtype=dtype,
+    )
+    if up.out_shape != img_size:
+        raise ValueError(f'Image size {img_size} is not divisible by downsample_factor {downsample_factor}')
+    down, up = dict(down.matrices), dict(up.matrices)
+    matrices = []
+    for dim, size in enumerate(img_size):
+        eye = torch.eye(size, device=device, dtype=dtype)
+        matrices.append(up.get(dim, eye) @ down.get(dim, eye))
+    return tuple(matrices)
@@ -1,5 +1,6 @@
 import tqdm
-from typing import Dict
+from collections import defaultdict
+from typing import Dict, Iterable, List
 
 import torch
 import torch.nn as nn
@@ -43,6 +44,7 @@ class MaskGuidance(BaseGuidance):
         super().__init__(*args, **kwargs)
         self.masked_image = masked_image
         self.mask = mask
+        self._resample_seqs = dict()
 
     def set_mask_and_image(self, masked_image: Tensor, mask: Tensor):
         self.masked_image = masked_image
@@ -65,7 +67,7 @@ class MaskGuidance(BaseGuidance):
         alphas_cumprod_t = self.alphas_cumprod[t]
         alphas_cumprod_t_next = self.alphas_cumprod[t_next] if t_next < self.total_steps else torch.tensor(0.0)
         alphas_t_next = alphas_cumprod_t_next / alphas_cumprod_t
-        return torch.sqrt(alphas_t_next) * xt + torch.sqrt(1. - alphas_t_next) * torch.randn_like(xt)
+        return torch.sqrt(alphas_t_next) * xt + torch.sqrt(1. - alphas_t_next) * self.randn_like(xt)
 
     def resample_loop(
             self, model: nn.Module, init_noise: Tensor,
@@ -116,7 +118,13 @@ class MaskGuidance(BaseGuidance):
             resample_j: Jump lengths of resampling, as proposed in RePaint paper.
 
         """
-        t_T = len(self.respaced_seq)
+        respaced_seq = self.respaced_seq.tolist()
+        # the cache may be shared by copies with different respaced sequences, e.g., by `with_options()`
+        key = (tuple(respaced_seq), resample_r, resample_j)
+        if key in self._resample_seqs:
+            return list(self._resample_seqs[key])
+
+        t_T = len(respaced_seq)
 
         jumps = {}
         for j in range(0, t_T - resample_j, resample_j):
@@ -126,15 +134,134 @@ class MaskGuidance(BaseGuidance):
         ts = []
         while t >= 1:
             t = t - 1
-            ts.append(self.respaced_seq[t].item())
+            ts.append(respaced_seq[t])
             if jumps.get(t, 0) > 0:
                 jumps[t] = jumps[t] - 1
                 for _ in range(resample_j):
                     t = t + 1
-                    ts.append(self.respaced_seq[t].item())
+                    ts.append(respaced_seq[t])
+        self._resample_seqs[key] = tuple(ts)
         return ts
 
 
+class _RePaintJob:
+    def __init__(self, item: Dict):
+        self.item = item
+        self.img = item['init_noise']
+        self.masked_image = item['masked_image']
+        self.mask = item['mask'].float()
+        self.pos = 0
+
+    def __len__(self):
+        return self.img.shape[0]
+
+
+class RePaintScheduler:
+    def __init__(
+            self, diffuser: MaskGuidance, model: nn.Module,
+            resample_r: int = 10, resample_j: int = 10, max_batch_size: int = 32,
+    ):
+        """Run RePaint resampling for a stream of independent inpainting jobs.
+
+        Each job walks the resampling schedule (see `MaskGuidance.get_resample_seq()`) on its own. In each tick, the
+        jobs are advanced through re-noising steps (which need no model) until they reach a denoising step, then all
+        active jobs are packed into one model call with per-sample timesteps, regardless of their positions in the
+        schedule. Jobs at the same position are denoised together. New jobs are admitted as soon as there is room in
+        the batch, so the GPU stays busy when requests arrive at different times.
+
+        Args:
+            diffuser: The mask guidance diffuser.
+            model: The model.
+            resample_r: Number of resampling, as proposed in RePaint paper.
+            resample_j: Jump lengths of resampling, as proposed in RePaint paper.
+            max_batch_size: Maximum number of samples in a model call. A job larger than it runs alone.
+
+        """
+        self.diffuser = diffuser
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.seq1 = diffuser.get_resample_seq(resample_r, resample_j)
+        self.seq2 = self.seq1[1:] + [-1]
+
+    def _renoise(self, jobs: List[_RePaintJob]):
+        # advance jobs through re-noising steps, jobs at the same position are processed together
+        while True:
+            groups = defaultdict(list)
+            for job in jobs:
+                if job.pos < len(self.seq1) and self.seq1[job.pos] < self.seq2[job.pos]:
+                    groups[job.pos].append(job)
+            if len(groups) == 0:
+                break
+            for pos, group in groups.items():
+                img = self.diffuser.q_sample_one_step(
+                    torch.cat([job.img for job in group]), self.seq1[pos], self.seq2[pos],
+                )
+                for job, x in zip(group, img.split([len(job) for job in group])):
+                    job.img = x
+                    job.pos += 1
+
+    def _denoise(self, jobs: List[_RePaintJob]):
+        img = torch.cat([job.img for job in jobs])
+        t_batch = torch.tensor(
+            [self.seq1[job.pos] for job in jobs for _ in range(len(job))],
+            device=img.device, dtype=torch.long,
+        )
+        model_outputs = self.model(img, t_batch).split([len(job) for job in jobs])
+        groups = defaultdict(list)
+        for job, model_output in zip(jobs, model_outputs):
+            groups[job.pos].append((job, model_output))
+        for pos, group in groups.items():
+            t, t_prev = self.seq1[pos], self.seq2[pos]
+            xt = torch.cat([job.img for job, _ in group])
+            self.diffuser.set_mask_and_image(
+                torch.cat([job.masked_image for job, _ in group]),
+                torch.cat([job.mask for job, _ in group]),
+            )
+            out = self.diffuser.denoise(torch.cat([o for _, o in group]), xt, t, t_prev)
+            out = self.diffuser.apply_guidance(**out, xt=xt, t=t, t_prev=t_prev)
+            for (job, _), x in zip(group, out['sample'].split([len(job) for job, _ in group])):
+                job.img = x
+                job.pos += 1
+
+    def run(self, items: Iterable[Dict], tqdm_kwargs: Dict = None):
+        """Inpaint a stream of jobs.
+
+        Args:
+            items: An iterable of dicts, each with `init_noise`, `masked_image` and `mask` of a batch of images.
+            tqdm_kwargs: Arguments of the progress bar, which counts model calls.
+
+        Yields:
+            Tuples of (item, sample) in the order of completion, which is the order of `items` if they have the same
+            resampling schedule.
+
+        """
+        tqdm_kwargs = dict() if tqdm_kwargs is None else tqdm_kwargs
+        items = iter(items)
+        active, pending = [], next(items, None)
+        pbar = tqdm.tqdm(**tqdm_kwargs)
+        while active or pending is not None:
+            # admit new jobs
+            while pending is not None:
+                job = _RePaintJob(pending)
+                if active and sum(len(j) for j in active) + len(job) > self.max_batch_size:
+                    break
+                active.append(job)
+                pending = next(items, None)
+            self._renoise(active)
+            # yield finished jobs (a schedule may end with re-noising steps only in degenerate cases)
+            for job in [j for j in active if j.pos == len(self.seq1)]:
+                active.remove(job)
+                yield job.item, job.img
+            if not active:
+                continue
+            self._denoise(active)
+            pbar.update(1)
+            for job in [j for j in active if j.pos == len(self.seq1)]:
+                active.remove(job)
+                yield job.item, job.img
+        pbar.close()
+
+
 def _test(r, j):
     import matplotlib.pyplot as plt
 
@@ -48,7 +48,7 @@ class HeunSampler(DDPM):
             **kwargs,
         )
 
-        self.sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod).sqrt()
+        self.sigmas = self.schedule.sigmas
 
         self._1st_order_derivative = None
         self._1st_order_xt = None
@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+from collections import deque
+from typing import Dict, Iterable, List
+
+import tqdm
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from diffusions.ddim import DDIM
+
+
+class NoiseCache:
+    def __init__(self, cache_dir: str, namespace: Dict):
+        """Cache the noise obtained by DDIM inversion on disk, one file per image.
+
+        The key of an image is the hash of its content (the input Tensor) and `namespace`, which should identify
+        everything else that determines the noise, e.g., the model weights, the respaced timesteps and the class
+        label used for inversion.
+
+        Args:
+            cache_dir: Path to the cache directory.
+            namespace: A json-serializable dict.
+
+        """
+        self.cache_dir = cache_dir
+        self.namespace = json.dumps(namespace, sort_keys=True, default=str)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_keys(self, img: Tensor) -> List[str]:
+        keys = []
+        for x in img.detach().float().cpu():
+            h = hashlib.sha1(self.namespace.encode())
+            h.update(x.contiguous().numpy().tobytes())
+            keys.append(h.hexdigest())
+        return keys
+
+    def load(self, keys: List[str], device: torch.device = 'cpu'):
+        """Load the noise of all keys, return None if any of them is missing."""
+        paths = [os.path.join(self.cache_dir, f'{key}.pt') for key in keys]
+        if not all(os.path.isfile(path) for path in paths):
+            return None
+        return torch.stack([torch.load(path, map_location='cpu') for path in paths]).to(device)
+
+    def save(self, keys: List[str], noise: Tensor):
+        for key, z in zip(keys, noise.detach().cpu()):
+            path = os.path.join(self.cache_dir, f'{key}.pt')
+            torch.save(z.clone(), f'{path}.{os.getpid()}.tmp')
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+class _Job:
+    def __init__(self, item: Dict, x: Tensor, model_kwargs: Dict):
+        self.item = item
+        self.x = x
+        self.model_kwargs = dict() if model_kwargs is None else model_kwargs
+        self.step = 0
+        self.noise = None
+        self.cache_keys = None
+
+
+def _cat_kwargs(kwargs_list: List[Dict]):
+    keys = set(kwargs_list[0].keys())
+    if any(set(kw.keys()) != keys for kw in kwargs_list):
+        raise ValueError('Model kwargs of inversion and generation should have the same keys to be batched')
+    out = dict()
+    for k in keys:
+        values = [kw[k] for kw in kwargs_list]
+        if all(v is None for v in values):
+            out[k] = None
+        elif all(isinstance(v, Tensor) for v in values):
+            out[k] = torch.cat(values, dim=0)
+        else:
+            raise ValueError(f'Cannot batch model kwarg `{k}` of types {[type(v) for v in values]}')
+    return out
+
+
+class InversionPipeline:
+    def __init__(self, diffuser: DDIM, model: nn.Module, noise_cache: NoiseCache = None):
+        """Pipelined DDIM inversion (image -> noise) and generation (noise -> image) over a stream of batches.
+
+        The inversion of batch k+1 is interleaved with the generation of batch k: in each step, the current
+        inversion and generation jobs are concatenated into one batch and evaluated by a single model call with
+        per-sample timesteps, so the model runs at twice the batch size and half the number of calls compared to
+        running them one after another. Noise of images found in `noise_cache` is loaded instead of inverted, e.g.,
+        when translating the same images to different target classes.
+
+        Args:
+            diffuser: A DDIM diffuser with eta=0.
+            model: The model.
+            noise_cache: Optional cache of inverted noise.
+
+        """
+        if diffuser.eta != 0.:
+            raise ValueError(f'DDIM inversion is only valid when eta=0, get {diffuser.eta}')
+        self.diffuser = diffuser
+        self.model = model
+        self.noise_cache = noise_cache
+        self.inv_seq = diffuser.respaced_seq[:-1].tolist()
+        self.inv_seq_next = diffuser.respaced_seq[1:].tolist()
+        self.gen_seq = list(reversed(diffuser.respaced_seq.tolist()))
+        self.gen_seq_prev = list(reversed([-1] + diffuser.respaced_seq[:-1].tolist()))
+
+    def _start_inversion(self, item: Dict):
+        img = item['img']
+        job = _Job(item, img, item.get('inversion_kwargs'))
+        if self.noise_cache is not None:
+            job.cache_keys = self.noise_cache.get_keys(img)
+            noise = self.noise_cache.load(job.cache_keys, device=img.device)
+            if noise is not None:
+                job.noise = noise
+                return None, job
+        if len(self.inv_seq) == 0:
+            job.noise = img
+            return None, job
+        return job, None
+
+    def _finish_inversion(self, job: _Job):
+        if self.noise_cache is not None:
+            self.noise_cache.save(job.cache_keys, job.x)
+        job.noise = job.x
+        return job
+
+    def run(self, items: Iterable[Dict], tqdm_kwargs: Dict = None):
+        """Invert and regenerate a stream of batches.
+
+        Args:
+            items: An iterable of dicts, each with `img` (Tensor of shape [B, C, H, W]), and optionally
+             `inversion_kwargs` and `generation_kwargs` passed to the model in the two stages (e.g., the class
+             labels of the source and target domain). Kwargs of the two stages must have the same keys.
+            tqdm_kwargs: Arguments of the progress bar, which counts model calls.
+
+        Yields:
+            Tuples of (item, noise, sample) in the order of `items`.
+
+        """
+        tqdm_kwargs = dict() if tqdm_kwargs is None else tqdm_kwargs
+        items = iter(items)
+        inv_job, gen_job, ready = None, None, deque()
+        exhausted = False
+        pbar = tqdm.tqdm(**tqdm_kwargs)
+        while True:
+            # fetch the next batch when the inversion stage is free and no noise is waiting for generation
+            while not exhausted and inv_job is None and len(ready) == 0:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                inv_job, cached_job = self._start_inversion(item)
+                if cached_job is not None:
+                    ready.append(cached_job)
+            if gen_job is None and len(ready) > 0:
+                job = ready.popleft()
+                gen_job = _Job(job.item, job.noise, job.item.get('generation_kwargs'))
+                gen_job.noise = job.noise
+            if inv_job is None and gen_job is None:
+                break
+
+            # evaluate the model on both jobs in one call
+            jobs = [job for job in (inv_job, gen_job) if job is not None]
+            ts = [
+                self.inv_seq[job.step] if job is inv_job else self.gen_seq[job.step]
+                for job in jobs
+            ]
+            x = torch.cat([job.x for job in jobs], dim=0)
+            t_batch = torch.cat([
+                torch.full((job.x.shape[0], ), t, device=x.device, dtype=torch.long)
+                for job, t in zip(jobs, ts)
+            ])
+            model_kwargs = _cat_kwargs([job.model_kwargs for job in jobs])
+            model_output = self.model(x, t_batch, **model_kwargs)
+            model_outputs = model_output.split([job.x.shape[0] for job in jobs], dim=0)
+            pbar.update(1)
+
+            if inv_job is not None:
+                step = inv_job.step
+                out = self.diffuser.denoise_inversion(
+                    model_outputs[0], inv_job.x, self.inv_seq[step], self.inv_seq_next[step],
+                )
+                inv_job.x = out['sample']
+                inv_job.step += 1
+                if inv_job.step == len(self.inv_seq):
+                    ready.append(self._finish_inversion(inv_job))
+                    inv_job = None
+            if gen_job is not None:
+                step = gen_job.step
+                out = self.diffuser.denoise(model_outputs[-1], gen_job.x, self.gen_seq[step], self.gen_seq_prev[step])
+                gen_job.x = out['sample']
+                gen_job.step += 1
+                if gen_job.step == len(self.gen_seq):
+                    yield gen_job.item, gen_job.noise, gen_job.x
+                    gen_job = None
+        pbar.close()
@@ -1,5 +1,8 @@
 import math
+from functools import lru_cache
+
 import torch
+from torch import Tensor
 
 
 def get_beta_schedule(
@@ -73,6 +76,69 @@ def get_respaced_seq(
     return seq
 
 
+class NoiseSchedule:
+    def __init__(self, betas: Tensor, device: torch.device = 'cpu'):
+        """Noise schedule of a diffusion process, i.e., betas and the quantities derived from them, on `device`.
+
+        The schedule is immutable: diffusers built with the same schedule share these Tensors (see
+        `get_noise_schedule()`), so they must not be modified in place. Respaced sequences are cached as well.
+
+        Args:
+            betas: A 1-D Tensor of beta schedule.
+            device: The device on which the Tensors are stored.
+
+        """
+        self.total_steps = len(betas)
+        self.device = device
+        alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+        self.betas = betas.to(device, torch.float)
+        self.alphas_cumprod = alphas_cumprod.to(device, torch.float)
+        self.sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod).sqrt()
+        self.log_snr = torch.log(alphas_cumprod / (1. - alphas_cumprod)).to(device, torch.float)
+        self._respaced_seqs = dict()
+
+    def get_respaced_seq(self, respace_type: str = 'uniform', respace_steps: int = 100):
+        """Same as `get_respaced_seq()`, but cached and on `self.device`."""
+        key = (respace_type, respace_steps)
+        if key not in self._respaced_seqs:
+            self._respaced_seqs[key] = get_respaced_seq(
+                total_steps=self.total_steps,
+                respace_type=respace_type,
+                respace_steps=respace_steps,
+            ).to(self.device)
+        return self._respaced_seqs[key]
+
+
+def get_noise_schedule(
+        total_steps: int = 1000,
+        beta_schedule: str = 'linear',
+        beta_start: float = 0.0001,
+        beta_end: float = 0.02,
+        device: torch.device = 'cpu',
+):
+    """Get the interned noise schedule of the given parameters.
+
+    Schedules are computed once for each set of parameters and device, and shared by all the diffusers in the
+    process, so building a diffuser (e.g., per request in a server, or per sampler in a script) is cheap.
+
+    Returns:
+        A `NoiseSchedule` object, which must not be modified.
+
+    """
+    return _get_noise_schedule(total_steps, beta_schedule, float(beta_start), float(beta_end), torch.device(device))
+
+
+@lru_cache(maxsize=32)
+def _get_noise_schedule(total_steps, beta_schedule, beta_start, beta_end, device):
+    betas = get_beta_schedule(
+        total_steps=total_steps,
+        beta_schedule=beta_schedule,
+        beta_start=beta_start,
+        beta_end=beta_end,
+    )
+    return NoiseSchedule(betas, device)
+
+
 def _test_betas():
     import matplotlib.pyplot as plt
     fig, ax = plt.subplots(1, 2, figsize=(10, 4))
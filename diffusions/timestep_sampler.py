@@ -0,0 +1,273 @@
+import math
+from typing import Callable, Dict, Tuple
+
+import torch
+from torch import Tensor
+
+
+class TimestepSampler:
+    # whether `update()` uses the losses, so that the training script can skip gathering them otherwise
+    requires_losses = False
+
+    def __init__(self, alphas_cumprod: Tensor, importance_weighted: bool = False):
+        """Base class of timestep samplers used in training.
+
+        A timestep sampler defines a distribution p(t) over the training timesteps. If `importance_weighted` is True,
+        each sample is returned with weight 1 / (T * p(t)), so that the weighted loss is an unbiased estimate of the
+        loss under uniform timesteps. Otherwise, the weights are all ones and the sampler changes the training
+        objective itself, which is the intended use of log-SNR and lognormal samplers.
+
+        Args:
+            alphas_cumprod: A 1-D Tensor of the diffuser's alpha_bar, e.g. `diffuser.alphas_cumprod`.
+            importance_weighted: Whether to return importance weights.
+
+        """
+        self.total_steps = len(alphas_cumprod)
+        self.alphas_cumprod = alphas_cumprod.detach().double().cpu()
+        self.importance_weighted = importance_weighted
+
+    def probs(self) -> Tensor:
+        """Return a 1-D Tensor of shape [T], the probability of each timestep."""
+        raise NotImplementedError
+
+    def sample(self, batch_size: int, device: torch.device = 'cpu') -> Tuple[Tensor, Tensor]:
+        """Sample timesteps for a batch.
+
+        Returns:
+            t: A Tensor of shape [batch_size], the sampled timesteps.
+            weights: A Tensor of shape [batch_size], the weights of each sample.
+
+        """
+        p = self.probs().to(device)
+        t = torch.multinomial(p, batch_size, replacement=True)
+        if self.importance_weighted:
+            weights = 1. / (self.total_steps * p[t])
+        else:
+            weights = torch.ones_like(p[t])
+        return t.long(), weights.float()
+
+    def update(self, t: Tensor, losses: Tensor):
+        """Update the sampler with the losses of sampled timesteps. Should be called with the same values on all
+        processes, e.g., after gathering, to keep the samplers in sync."""
+        pass
+
+    def get_log_sigmas(self):
+        """log(sigma_t), where sigma_t = sqrt((1 - alpha_bar) / alpha_bar), which is increasing in t."""
+        return 0.5 * (torch.log1p(-self.alphas_cumprod) - torch.log(self.alphas_cumprod))
+
+    def interval_probs(self, cdf) -> Tensor:
+        """Discretize a continuous distribution over log(sigma) onto timesteps.
+
+        Each timestep takes the mass between the midpoints to its neighbors in log(sigma).
+
+        """
+        log_sigmas = self.get_log_sigmas()
+        mids = (log_sigmas[1:] + log_sigmas[:-1]) / 2
+        inf = torch.tensor([math.inf], dtype=log_sigmas.dtype)
+        edges = torch.cat([-inf, mids, inf])
+        p = cdf(edges[1:]) - cdf(edges[:-1])
+        p = torch.clamp_min(p, 0.)
+        return (p / p.sum()).float()
+
+
+class UniformSampler(TimestepSampler):
+    def __init__(self, alphas_cumprod: Tensor):
+        """Sample timesteps uniformly, which is the default choice in DDPM."""
+        super().__init__(alphas_cumprod, importance_weighted=False)
+
+    def probs(self):
+        return torch.full((self.total_steps, ), 1. / self.total_steps)
+
+    def sample(self, batch_size: int, device: torch.device = 'cpu'):
+        t = torch.randint(self.total_steps, (batch_size, ), device=device).long()
+        weights = torch.ones((batch_size, ), device=device)
+        return t, weights
+
+
+class LossAwareSampler(TimestepSampler):
+    requires_losses = True
+
+    def __init__(self, alphas_cumprod: Tensor, history_per_term: int = 10, uniform_prob: float = 0.001):
+        """Importance sampling of timesteps according to the second moment of recent losses.
+
+        p(t) is proportional to sqrt(E[loss_t^2]), estimated from a history buffer of the latest `history_per_term`
+        losses of each timestep. Timesteps are sampled uniformly until the buffer is full. Importance weights are
+        returned, so the objective is unchanged while its variance is reduced.
+
+        The buffer of each timestep is a ring buffer, where the position of the next loss is given by the number of
+        losses seen so far modulo `history_per_term`, so that updating it is vectorized over the batch.
+
+        Args:
+            alphas_cumprod: A 1-D Tensor of the diffuser's alpha_bar.
+            history_per_term: Number of losses kept in the buffer for each timestep.
+            uniform_prob: Probability mass mixed from the uniform distribution.
+
+        References:
+            [1] Nichol, Alexander Quinn, and Prafulla Dhariwal. "Improved denoising diffusion probabilistic models."
+            In International Conference on Machine Learning, pp. 8162-8171. PMLR, 2021.
+
+        """
+        super().__init__(alphas_cumprod, importance_weighted=True)
+        self.history_per_term = history_per_term
+        self.uniform_prob = uniform_prob
+        self.loss_history = torch.zeros((self.total_steps, history_per_term), dtype=torch.float64)
+        self.loss_counts = torch.zeros((self.total_steps, ), dtype=torch.long)
+
+    def warmed_up(self):
+        return bool((self.loss_counts >= self.history_per_term).all())
+
+    def probs(self):
+        if not self.warmed_up():
+            return torch.full((self.total_steps, ), 1. / self.total_steps)
+        p = torch.sqrt(torch.mean(self.loss_history ** 2, dim=-1))
+        p = p / p.sum()
+        p = p * (1 - self.uniform_prob) + self.uniform_prob / self.total_steps
+        return p.float()
+
+    def update(self, t: Tensor, losses: Tensor):
+        t, losses = t.detach().cpu().long(), losses.detach().cpu().double()
+        # rank of each sample among the samples of the same timestep in this batch, in the original order
+        t_sorted, order = torch.sort(t, stable=True)
+        counts = torch.bincount(t_sorted, minlength=self.total_steps)
+        ranks = torch.arange(len(t_sorted)) - (torch.cumsum(counts, dim=0) - counts)[t_sorted]
+        # only the latest `history_per_term` losses of each timestep are kept, so that positions do not collide
+        keep = ranks >= counts[t_sorted] - self.history_per_term
+        t_sorted, ranks = t_sorted[keep], ranks[keep]
+        positions = (self.loss_counts[t_sorted] + ranks) % self.history_per_term
+        self.loss_history[t_sorted, positions] = losses[order][keep]
+        self.loss_counts += counts
+
+    def state_dict(self):
+        return dict(loss_history=self.loss_history, loss_counts=self.loss_counts)
+
+    def load_state_dict(self, state_dict: Dict):
+        self.loss_history = state_dict['loss_history'].to(torch.float64)
+        self.loss_counts = state_dict['loss_counts'].to(torch.long)
+
+
+class LogSNRSampler(TimestepSampler):
+    def __init__(self, alphas_cumprod: Tensor, logsnr_min: float = None, logsnr_max: float = None):
+        """Sample timesteps such that log-SNR is uniformly distributed in [logsnr_min, logsnr_max].
+
+        Args:
+            alphas_cumprod: A 1-D Tensor of the diffuser's alpha_bar.
+            logsnr_min: Minimum log-SNR. Default to the log-SNR of the last timestep.
+            logsnr_max: Maximum log-SNR. Default to the log-SNR of the first timestep.
+
+        References:
+            [1] Kingma, Diederik, Tim Salimans, Ben Poole, and Jonathan Ho. "Variational diffusion models."
+            Advances in neural information processing systems 34 (2021): 21696-21707.
+
+        """
+        super().__init__(alphas_cumprod, importance_weighted=False)
+        log_sigmas = self.get_log_sigmas()
+        # log(sigma) = -logsnr / 2
+        self.lo = log_sigmas[0].item() if logsnr_max is None else -logsnr_max / 2
+        self.hi = log_sigmas[-1].item() if logsnr_min is None else -logsnr_min / 2
+        if self.lo >= self.hi:
+            raise ValueError(f'Invalid log-SNR range: [{logsnr_min}, {logsnr_max}]')
+        self._probs = self.interval_probs(lambda x: torch.clamp((x - self.lo) / (self.hi - self.lo), 0., 1.))
+
+    def probs(self):
+        return self._probs
+
+
+class LogNormalSampler(TimestepSampler):
+    def __init__(self, alphas_cumprod: Tensor, p_mean: float = -1.2, p_std: float = 1.2):
+        """Sample timesteps such that log(sigma) follows a normal distribution N(p_mean, p_std^2), where
+        sigma = sqrt((1 - alpha_bar) / alpha_bar) is the noise level in EDM's formulation.
+
+        Args:
+            alphas_cumprod: A 1-D Tensor of the diffuser's alpha_bar.
+            p_mean: Mean of log(sigma).
+            p_std: Standard deviation of log(sigma).
+
+        References:
+            [1] Karras, Tero, Miika Aittala, Timo Aila, and Samuli Laine. "Elucidating the design space of
+            diffusion-based generative models." Advances in Neural Information Processing Systems 35 (2022):
+            26565-26577.
+
+        """
+        super().__init__(alphas_cumprod, importance_weighted=False)
+        self.p_mean = p_mean
+        self.p_std = p_std
+        self._probs = self.interval_probs(lambda x: 0.5 * (1 + torch.erf((x - p_mean) / (p_std * math.sqrt(2)))))
+
+    def probs(self):
+        return self._probs
+
+
+class LossHistogram:
+    def __init__(self, total_steps: int, n_bins: int = 10, device: torch.device = 'cpu'):
+        """Average training loss over equal-width bins of timesteps, accumulated between two reports.
+
+        The sums and counts are kept on `device` and updated with the local losses of each process, so updating
+        involves neither device-to-host copies nor communication. Losses of all processes are reduced only when a
+        report is due, by passing `reduce_fn` to `summary()`.
+
+        Args:
+            total_steps: Total number of timesteps.
+            n_bins: Number of bins.
+            device: Device of the accumulated sums and counts.
+
+        """
+        self.total_steps = total_steps
+        self.n_bins = n_bins
+        self.sums = torch.zeros((n_bins, ), dtype=torch.float64, device=device)
+        self.counts = torch.zeros((n_bins, ), dtype=torch.long, device=device)
+
+    def update(self, t: Tensor, losses: Tensor):
+        bins = (t.detach().long() * self.n_bins // self.total_steps).clamp(0, self.n_bins - 1).to(self.sums.device)
+        self.sums.index_add_(0, bins, losses.detach().double().to(self.sums.device))
+        self.counts.index_add_(0, bins, torch.ones_like(bins))
+
+    def summary(self, reset: bool = True, reduce_fn: Callable = None) -> Dict[str, float]:
+        """Return a dict mapping bin names like 't000-099' to the averaged loss of non-empty bins.
+
+        Args:
+            reset: Whether to reset the accumulated sums and counts.
+            reduce_fn: Function that sums a Tensor over processes, e.g., `partial(accelerator.reduce, reduction='sum')`.
+             Should be called on all processes if given.
+
+        """
+        sums, counts = self.sums, self.counts
+        if reduce_fn is not None:
+            sums, counts = reduce_fn(sums.clone()), reduce_fn(counts.clone())
+        sums, counts = sums.cpu(), counts.cpu()
+        status = dict()
+        width = self.total_steps / self.n_bins
+        n_digits = len(str(self.total_steps - 1))
+        for i in range(self.n_bins):
+            if counts[i] == 0:
+                continue
+            lo, hi = math.ceil(i * width), math.ceil((i + 1) * width) - 1
+            status[f't{lo:0>{n_digits}d}-{hi:0>{n_digits}d}'] = (sums[i] / counts[i]).item()
+        if reset:
+            self.sums.zero_()
+            self.counts.zero_()
+        return status
+
+
+def _test():
+    from diffusions.schedule import get_beta_schedule
+    betas = get_beta_schedule(total_steps=1000, beta_schedule='linear', beta_start=0.0001, beta_end=0.02)
+    alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+
+    for sampler in [
+        UniformSampler(alphas_cumprod),
+        LossAwareSampler(alphas_cumprod),
+        LogSNRSampler(alphas_cumprod),
+        LogNormalSampler(alphas_cumprod),
+    ]:
+        t, weights = sampler.sample(8)
+        sampler.update(t, torch.rand(8))
+        print(type(sampler).__name__, t.tolist(), weights.tolist())
+        assert torch.isclose(sampler.probs().sum(), torch.tensor(1.))
+
+    hist = LossHistogram(1000, n_bins=10)
+    hist.update(torch.tensor([0, 50, 999]), torch.tensor([1., 2., 3.]))
+    print(hist.summary())
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,96 @@
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import torch
+from torch import Tensor
+
+
+class TrajectoryRecorder:
+    def __init__(
+            self,
+            key: str = 'sample',
+            predicate: Callable[[int, Dict], bool] = None,
+            transform: Callable[[Tensor], Tensor] = None,
+            callback: Callable[[int, Tensor], Any] = None,
+    ):
+        """Record selected steps of a sampling trajectory on CPU.
+
+        Wrap the generator returned by `sample_loop()` of a diffuser with the recorder. For each step selected by
+        `predicate(step, out)`, `out[key]` is passed through `transform` on the device and copied to pinned CPU memory
+        asynchronously, so that only the current batch stays on the GPU and the copy overlaps with the next step.
+
+        The snapshots are either accumulated and returned by `get()` as a Tensor of shape [B, T, ...], or, if
+        `callback` is given, streamed to `callback(k, snapshot)` one by one, where k is the index of the snapshot.
+        A snapshot is passed to `callback` when the next one is recorded or the loop ends, by which time its copy has
+        most likely finished.
+
+        Args:
+            key: Key of the output to record, e.g., 'sample' or 'pred_x0'.
+            predicate: Select steps to record. Default to record all steps.
+            transform: Function applied to the selected Tensor before copying, e.g., clamping or gathering from
+             all processes. If it returns None, the step is not recorded on this process.
+            callback: Function that receives snapshots on CPU.
+
+        Examples:
+            >>> recorder = TrajectoryRecorder(key='pred_x0', predicate=lambda step, out: step % 10 == 0)
+            >>> trajectory = recorder.run(diffuser.sample_loop(model, init_noise))  # [B, T, C, H, W] on CPU
+
+        """
+        self.key = key
+        self.predicate = predicate
+        self.transform = transform
+        self.callback = callback
+        self.snapshots: List[Tuple[Tensor, Any]] = []
+        self.n_recorded = 0
+        self.n_snapshots = 0  # number of selected steps, including those not recorded on this process
+
+    @staticmethod
+    def _copy_to_cpu(x: Tensor):
+        if x.device.type != 'cuda':
+            return x.detach().cpu().clone(), None
+        buffer = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        buffer.copy_(x.detach(), non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return buffer, event
+
+    @staticmethod
+    def _wait(snapshot: Tuple[Tensor, Any]):
+        buffer, event = snapshot
+        if event is not None:
+            event.synchronize()
+        return buffer
+
+    def _flush(self):
+        # pass pending snapshots to callback
+        for snapshot in self.snapshots:
+            self.callback(self.n_recorded, self._wait(snapshot))
+            self.n_recorded += 1
+        self.snapshots = []
+
+    def __call__(self, sample_loop: Iterable[Dict]):
+        """Iterate over `sample_loop` and record the selected steps. Outputs are yielded unchanged."""
+        for step, out in enumerate(sample_loop):
+            if self.predicate is None or self.predicate(step, out):
+                self.n_snapshots += 1
+                x = out[self.key]
+                if self.transform is not None:
+                    x = self.transform(x)
+                if x is not None:
+                    if self.callback is not None:
+                        self._flush()
+                    self.snapshots.append(self._copy_to_cpu(x))
+            yield out
+        if self.callback is not None:
+            self._flush()
+
+    def run(self, sample_loop: Iterable[Dict]):
+        """Run `sample_loop` to the end, and return the recorded trajectory (None if streamed or nothing recorded)."""
+        for _ in self(sample_loop):
+            pass
+        return self.get()
+
+    def get(self):
+        """Return the recorded snapshots stacked to a Tensor of shape [B, T, ...], or None if nothing is recorded."""
+        if len(self.snapshots) == 0:
+            return None
+        return torch.stack([self._wait(snapshot) for snapshot in self.snapshots], dim=1)
@@ -16,6 +16,7 @@ from .nn import (
     normalization,
     timestep_embedding,
 )
+from ..modules import fuse_sequential, group_norm_silu
 
 
 def convert_module_to_f16(l):
@@ -240,6 +241,9 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = conv_nd(dims, channels, self.out_channels, 1)
 
+        # apply SiLU right after scale-shift norm, set by `fuse_norm_act`
+        self.fused_out_act = False
+
     def forward(self, x, emb):
         """
         Apply the block to a Tensor, conditioned on a timestep embedding.
@@ -267,13 +271,32 @@ class ResBlock(TimestepBlock):
         if self.use_scale_shift_norm:
             out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
             scale, shift = th.chunk(emb_out, 2, dim=1)
-            h = out_norm(h) * (1 + scale) + shift
+            if self.fused_out_act:
+                h = group_norm_silu(
+                    h, out_norm.num_groups, out_norm.weight, out_norm.bias, out_norm.eps,
+                    scale=scale, shift=shift, upcast=True,
+                )
+            else:
+                h = th.addcmul(shift, out_norm(h), 1 + scale)
             h = out_rest(h)
         else:
             h = h + emb_out
             h = self.out_layers(h)
         return self.skip_connection(x) + h
 
+    def fuse_norm_act(self):
+        """
+        Fuse the GroupNorm -> SiLU pairs. Parameter names are kept, so the
+        block stays compatible with existing checkpoints.
+        """
+        fuse_sequential(self.in_layers, upcast=True)
+        if self.use_scale_shift_norm:
+            # SiLU comes after scale-shift, which are fused together with the norm
+            self.fused_out_act = True
+            self.out_layers[1] = nn.Identity()
+        else:
+            fuse_sequential(self.out_layers, upcast=True)
+
 
 class AttentionBlock(nn.Module):
     """
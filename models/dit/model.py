@@ -15,6 +15,9 @@ import numpy as np
 import math
 from timm.models.vision_transformer import PatchEmbed, Attention, Mlp
 
+from ..tome import compute_merge
+from ..modules import checkpoint, get_checkpoint_flags
+
 
 def modulate(x, shift, scale):
     return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
@@ -114,11 +117,15 @@ class DiTBlock(nn.Module):
             nn.SiLU(),
             nn.Linear(hidden_size, 6 * hidden_size, bias=True)
         )
+        # token merging, see models.tome.apply_tome
+        self.tome_ratio = 0.
+        self.tome_stride = (2, 2)
 
     def forward(self, x, c):
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(modulate(self.norm1(x), shift_msa, scale_msa))
-        x = x + gate_mlp.unsqueeze(1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+        merge, unmerge, _ = compute_merge(x, self.tome_ratio, stride=self.tome_stride)
+        x = x + gate_msa.unsqueeze(1) * unmerge(self.attn(merge(modulate(self.norm1(x), shift_msa, scale_msa))))
+        x = x + gate_mlp.unsqueeze(1) * unmerge(self.mlp(merge(modulate(self.norm2(x), shift_mlp, scale_mlp))))
         return x
 
 
@@ -158,7 +165,12 @@ class DiT(nn.Module):
         class_dropout_prob=0.1,
         num_classes=1000,
         learn_sigma=True,
+        use_checkpoint=False,
     ):
+        """
+        use_checkpoint: gradient checkpointing of blocks, True / False for all / none of them,
+            an integer k for the first k blocks, or a list of booleans for each block.
+        """
         super().__init__()
         self.learn_sigma = learn_sigma
         self.in_channels = in_channels
@@ -178,6 +190,7 @@ class DiT(nn.Module):
             DiTBlock(hidden_size, num_heads, mlp_ratio=mlp_ratio) for _ in range(depth)
         ])
         self.final_layer = FinalLayer(hidden_size, patch_size, self.out_channels)
+        self.use_checkpoint = get_checkpoint_flags(use_checkpoint, depth)
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -245,8 +258,8 @@ class DiT(nn.Module):
         t = self.t_embedder(t)                   # (N, D)
         y = self.y_embedder(y, self.training)    # (N, D)
         c = t + y                                # (N, D)
-        for block in self.blocks:
-            x = block(x, c)                      # (N, T, D)
+        for block, ckpt in zip(self.blocks, self.use_checkpoint):
+            x = checkpoint(block, x, c, enabled=ckpt)  # (N, T, D)
         x = self.final_layer(x, c)                # (N, T, patch_size ** 2 * out_channels)
         x = self.unpatchify(x)                   # (N, out_channels, H, W)
         return x
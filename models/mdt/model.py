@@ -5,6 +5,9 @@ import numpy as np
 from timm.models.vision_transformer import PatchEmbed, Mlp
 from timm.models.layers import trunc_normal_
 
+from ..tome import compute_merge, do_nothing
+from ..modules import checkpoint, get_checkpoint_flags
+
 
 def modulate(x, shift, scale):
     return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
@@ -206,17 +209,24 @@ class MDTBlock(nn.Module):
             nn.Linear(hidden_size, 6 * hidden_size, bias=True)
         )
         self.skip_linear = nn.Linear(2 * hidden_size, hidden_size) if skip else None
+        # token merging, see models.tome.apply_tome
+        self.tome_ratio = 0.
+        self.tome_stride = (2, 2)
 
     def forward(self, x, c, skip=None, ids_keep=None):
         if self.skip_linear is not None:
             x = self.skip_linear(torch.cat([x, skip], dim=-1))
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.adaLN_modulation(
             c).chunk(6, dim=1)
-        x = x + gate_msa.unsqueeze(1) * self.attn(
-            modulate(self.norm1(x), shift_msa, scale_msa), ids_keep=ids_keep)
+        # token merging is disabled on masked tokens, since they no longer lie on a full grid
+        merge, unmerge = do_nothing, do_nothing
+        if ids_keep is None:
+            merge, unmerge, ids_keep = compute_merge(x, self.tome_ratio, stride=self.tome_stride)
+        x = x + gate_msa.unsqueeze(1) * unmerge(self.attn(
+            merge(modulate(self.norm1(x), shift_msa, scale_msa)), ids_keep=ids_keep))
         x = x + \
             gate_mlp.unsqueeze(
-                1) * self.mlp(modulate(self.norm2(x), shift_mlp, scale_mlp))
+                1) * unmerge(self.mlp(merge(modulate(self.norm2(x), shift_mlp, scale_mlp))))
         return x
 
 
@@ -262,7 +272,13 @@ class MDTv2(nn.Module):
         learn_sigma=True,
         mask_ratio=None,
         decode_layer=4,
+        use_checkpoint=False,
     ):
+        """
+        use_checkpoint: gradient checkpointing of blocks, True / False for all / none of them,
+            an integer k for the first k blocks, or a list of booleans for each block. Blocks are
+            ordered as en_inblocks, en_outblocks, de_blocks.
+        """
         super().__init__()
         self.learn_sigma = learn_sigma
         self.in_channels = in_channels
@@ -312,6 +328,8 @@ class MDTv2(nn.Module):
             self.mask_ratio = None
             self.decode_layer = int(decode_layer)
         print("mask ratio:", self.mask_ratio, "decode_layer:", self.decode_layer)
+        self.use_checkpoint = get_checkpoint_flags(
+            use_checkpoint, len(self.en_inblocks) + len(self.en_outblocks) + len(self.de_blocks))
         self.initialize_weights()
 
     def initialize_weights(self):
@@ -416,6 +434,11 @@ class MDTv2(nn.Module):
 
         return x_masked, mask, ids_restore, ids_keep
 
+    def tome_blocks(self):
+        """Blocks in the order of forward computation for token merging, see `models.tome.apply_tome()`. The
+        side-interpolater only runs in masked training, so its blocks are excluded."""
+        return [*self.en_inblocks, *self.en_outblocks, *self.de_blocks]
+
     def forward_side_interpolater(self, x, c, mask, ids_restore):
         # append mask tokens to sequence
         mask_tokens = self.mask_token.repeat(
@@ -470,18 +493,19 @@ class MDTv2(nn.Module):
         else:
             mask, ids_restore, ids_keep = None, None, None
 
+        ckpt_flags = iter(self.use_checkpoint)
         for block in self.en_inblocks:
             if masked_stage:
-                x = block(x, c, ids_keep=ids_keep)
+                x = checkpoint(block, x, c, ids_keep=ids_keep, enabled=next(ckpt_flags))
             else:
-                x = block(x, c, ids_keep=None)
+                x = checkpoint(block, x, c, ids_keep=None, enabled=next(ckpt_flags))
             skips.append(x)
 
         for block in self.en_outblocks:
             if masked_stage:
-                x = block(x, c, skip=skips.pop(), ids_keep=ids_keep)
+                x = checkpoint(block, x, c, skip=skips.pop(), ids_keep=ids_keep, enabled=next(ckpt_flags))
             else:
-                x = block(x, c, skip=skips.pop(), ids_keep=None)
+                x = checkpoint(block, x, c, skip=skips.pop(), ids_keep=None, enabled=next(ckpt_flags))
 
         if self.mask_ratio is not None and enable_mask:
             x = self.forward_side_interpolater(x, c, mask, ids_restore)
@@ -494,7 +518,7 @@ class MDTv2(nn.Module):
             block = self.de_blocks[i]
             this_skip = input_skip
 
-            x = block(x, c, skip=this_skip, ids_keep=None)
+            x = checkpoint(block, x, c, skip=this_skip, ids_keep=None, enabled=next(ckpt_flags))
 
         x = self.final_layer(x, c)
         x = self.unpatchify(x)  # (N, out_channels, H, W)
@@ -1,7 +1,10 @@
 import math
+from typing import List, Union
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import Tensor
 
 
@@ -37,6 +40,39 @@ def init_weights(init_type=None, gain=0.02):
     return init_func
 
 
+def checkpoint(func, *args, enabled: bool = True, **kwargs):
+    """Run func(*args, **kwargs) with activation checkpointing if enabled and gradients are required.
+
+    The non-reentrant implementation is used, which works with DDP, including `no_sync` micro-batching and
+    `find_unused_parameters=True`. RNG states are restored on recomputation, so dropout stays consistent.
+
+    """
+    if enabled and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(func, *args, use_reentrant=False, **kwargs)
+    return func(*args, **kwargs)
+
+
+def get_checkpoint_flags(use_checkpoint: Union[bool, int, List[bool]], n: int) -> List[bool]:
+    """Expand the `use_checkpoint` option of a model into a flag for each of its n stages / blocks.
+
+    Args:
+        use_checkpoint: True / False to checkpoint all / none of them, an integer k to checkpoint the first k of them
+         (in forward order), or a list of n booleans.
+        n: Number of stages / blocks.
+
+    """
+    if isinstance(use_checkpoint, bool):
+        return [use_checkpoint] * n
+    if isinstance(use_checkpoint, int):
+        if not 0 <= use_checkpoint <= n:
+            raise ValueError(f'Invalid use_checkpoint: {use_checkpoint}, should be in [0, {n}]')
+        return [i < use_checkpoint for i in range(n)]
+    use_checkpoint = [bool(f) for f in use_checkpoint]
+    if len(use_checkpoint) != n:
+        raise ValueError(f'Invalid use_checkpoint: expect {n} values, got {len(use_checkpoint)}')
+    return use_checkpoint
+
+
 class SinusoidalPosEmb(nn.Module):
     def __init__(self, dim: int):
         super().__init__()
@@ -110,6 +146,8 @@ class AdaGN(nn.Module):
             nn.SiLU(),
             nn.Linear(embed_dim, num_channels * 2),
         )
+        # apply SiLU after scale / shift, set by `fuse_norm_act`
+        self.fused_act = False
 
     def forward(self, X: Tensor, embed: Tensor):
         """
@@ -120,4 +158,162 @@ class AdaGN(nn.Module):
         ys, yb = torch.chunk(self.proj(embed), 2, dim=-1)
         ys = ys[:, :, None, None]
         yb = yb[:, :, None, None]
-        return self.gn(X) * (1 + ys) + yb
+        if self.fused_act:
+            return group_norm_silu(
+                X, self.gn.num_groups, self.gn.weight, self.gn.bias, self.gn.eps, scale=ys, shift=yb,
+            )
+        return torch.addcmul(yb, self.gn(X), 1 + ys)
+
+
+def _group_norm_silu(
+        X: Tensor, weight: Tensor, bias: Tensor, scale: Tensor, shift: Tensor,
+        num_groups: int, eps: float, upcast: bool, inplace: bool,
+):
+    out = F.group_norm(X.float() if upcast else X, num_groups, weight, bias, eps)
+    if upcast:
+        out = out.type(X.dtype)
+    if scale is not None:
+        out = torch.addcmul(shift, out, 1 + scale)
+    return F.silu(out, inplace=inplace)
+
+
+class _GroupNormSiLUFunction(torch.autograd.Function):
+    @staticmethod
+    @torch.cuda.amp.custom_fwd
+    def forward(ctx, X, weight, bias, scale, shift, num_groups, eps, upcast):
+        # only the input is saved, the normalized features are recomputed in backward
+        ctx.save_for_backward(X, weight, bias, scale, shift)
+        ctx.num_groups, ctx.eps, ctx.upcast = num_groups, eps, upcast
+        with torch.no_grad():
+            return _group_norm_silu(X, weight, bias, scale, shift, num_groups, eps, upcast, inplace=True)
+
+    @staticmethod
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_output):
+        inputs = [
+            None if t is None else t.detach().requires_grad_(need)
+            for t, need in zip(ctx.saved_tensors, ctx.needs_input_grad[:5])
+        ]
+        with torch.enable_grad():
+            out = _group_norm_silu(*inputs, ctx.num_groups, ctx.eps, ctx.upcast, inplace=False)
+        wrt = [t for t in inputs if t is not None and t.requires_grad]
+        grads = iter(torch.autograd.grad(out, wrt, grad_output) if wrt else [])
+        grads = [next(grads) if t is not None and t.requires_grad else None for t in inputs]
+        return (*grads, None, None, None)
+
+
+def group_norm_silu(
+        X: Tensor, num_groups: int, weight: Tensor = None, bias: Tensor = None, eps: float = 1e-5,
+        scale: Tensor = None, shift: Tensor = None, upcast: bool = False,
+):
+    """Fused SiLU(GroupNorm(X) * (1 + scale) + shift), where scale and shift are optional.
+
+    In training, the unfused ops store the normalized features (and the scaled / shifted features if given) for
+    backward, each of the same size as X. The fused op only stores X, which GroupNorm stores anyway, and recomputes
+    the normalization in the backward pass, trading a cheap elementwise recomputation for activation memory. In
+    inference, the activation is computed in place on the normalized features, so no intermediate tensor is allocated.
+
+    Args:
+        X: Input of shape [B, C, ...].
+        num_groups: Number of groups.
+        weight: Affine weight of GroupNorm of shape [C].
+        bias: Affine bias of GroupNorm of shape [C].
+        eps: Epsilon of GroupNorm.
+        scale: Scale broadcastable to X, e.g., [B, C, 1, 1] of AdaGN or the scale-shift norm of ADM.
+        shift: Shift broadcastable to X, required if `scale` is given.
+        upcast: Compute GroupNorm in float32 and cast back to the input dtype, like `GroupNorm32` in ADM.
+
+    """
+    tensors = [X, weight, bias, scale, shift]
+    if not torch.is_grad_enabled() or not any(t is not None and t.requires_grad for t in tensors):
+        return _group_norm_silu(*tensors, num_groups, eps, upcast, inplace=True)
+    return _GroupNormSiLUFunction.apply(*tensors, num_groups, eps, upcast)
+
+
+class GroupNormSiLU(nn.GroupNorm):
+    """GroupNorm followed by SiLU, computed by the fused op `group_norm_silu()`.
+
+    Parameters have the same names as nn.GroupNorm, so checkpoints can be loaded before or after the replacement.
+
+    Args:
+        upcast: Compute in float32 and cast back to the input dtype, like `GroupNorm32` in ADM.
+
+    """
+    def __init__(
+            self, num_groups: int, num_channels: int, eps: float = 1e-5, affine: bool = True, upcast: bool = False,
+    ):
+        super().__init__(num_groups, num_channels, eps=eps, affine=affine)
+        self.upcast = upcast
+
+    def forward(self, X: Tensor):
+        return group_norm_silu(X, self.num_groups, self.weight, self.bias, self.eps, upcast=self.upcast)
+
+    @classmethod
+    def from_groupnorm(cls, gn: nn.GroupNorm, upcast: bool = False):
+        """Build from an existing GroupNorm, sharing its parameters. """
+        fused = cls(gn.num_groups, gn.num_channels, eps=gn.eps, affine=False, upcast=upcast)
+        fused.affine = gn.affine
+        fused.weight, fused.bias = gn.weight, gn.bias
+        return fused
+
+
+def fuse_sequential(seq: nn.Sequential, upcast: bool = False):
+    """Replace (GroupNorm, SiLU) pairs in a nn.Sequential with (GroupNormSiLU, Identity) in place.
+
+    The indices of the remaining layers are unchanged, so the keys of state dict are kept.
+
+    """
+    for i in range(len(seq) - 1):
+        if (isinstance(seq[i], nn.GroupNorm) and not isinstance(seq[i], GroupNormSiLU)
+                and isinstance(seq[i+1], nn.SiLU)):
+            seq[i] = GroupNormSiLU.from_groupnorm(seq[i], upcast=upcast)
+            seq[i+1] = nn.Identity()
+    return seq
+
+
+def fuse_norm_act(model: nn.Module):
+    """Replace GroupNorm -> SiLU pairs in a model with fused modules in place.
+
+    The pattern is recognized inside nn.Sequential containers. Blocks whose normalization and activation are not
+    adjacent layers of a container (e.g., AdaGN or scale-shift norm) implement a `fuse_norm_act()` method to fuse
+    themselves. The model stays compatible with the original checkpoints.
+
+    """
+    for module in model.children():
+        if hasattr(module, 'fuse_norm_act'):
+            module.fuse_norm_act()
+        else:
+            fuse_norm_act(module)
+    if isinstance(model, nn.Sequential):
+        fuse_sequential(model)
+    return model
+
+
+def _test():
+    gn = nn.GroupNorm(4, 16)
+    nn.init.normal_(gn.weight)
+    nn.init.normal_(gn.bias)
+    X = torch.randn(2, 16, 8, 8)
+    seq = nn.Sequential(gn, nn.SiLU(), nn.Conv2d(16, 16, 3, padding=1))
+    out = seq(X)
+    keys = list(seq.state_dict().keys())
+    fuse_norm_act(seq)
+    print(seq)
+    assert list(seq.state_dict().keys()) == keys
+    assert torch.allclose(seq(X), out, atol=1e-5)
+    assert torch.allclose(seq.to(memory_format=torch.channels_last)(X), out, atol=1e-5)
+
+    # gradients of the fused op with scale / shift
+    X = torch.randn(2, 16, 8, 8, dtype=torch.float64, requires_grad=True)
+    scale = torch.randn(2, 16, 1, 1, dtype=torch.float64, requires_grad=True)
+    shift = torch.randn(2, 16, 1, 1, dtype=torch.float64, requires_grad=True)
+    weight = gn.weight.detach().double().requires_grad_(True)
+    bias = gn.bias.detach().double().requires_grad_(True)
+    assert torch.autograd.gradcheck(
+        lambda *args: group_norm_silu(args[0], 4, args[1], args[2], scale=args[3], shift=args[4]),
+        (X, weight, bias, scale, shift),
+    )
+
+
+if __name__ == '__main__':
+    _test()
@@ -2,6 +2,8 @@ import math
 import torch
 import torch.nn as nn
 
+from ..modules import GroupNormSiLU
+
 
 def get_timestep_embedding(timesteps, embedding_dim):
     """
@@ -110,17 +112,21 @@ class ResnetBlock(nn.Module):
                                                     kernel_size=1,
                                                     stride=1,
                                                     padding=0)
+        # norm1 / norm2 apply the nonlinearity themselves, set by `fuse_norm_act`
+        self.fused_norm_act = False
 
     def forward(self, x, temb):
         h = x
         h = self.norm1(h)
-        h = nonlinearity(h)
+        if not self.fused_norm_act:
+            h = nonlinearity(h)
         h = self.conv1(h)
 
         h = h + self.temb_proj(nonlinearity(temb))[:, :, None, None]
 
         h = self.norm2(h)
-        h = nonlinearity(h)
+        if not self.fused_norm_act:
+            h = nonlinearity(h)
         h = self.dropout(h)
         h = self.conv2(h)
 
@@ -132,6 +138,11 @@ class ResnetBlock(nn.Module):
 
         return x+h
 
+    def fuse_norm_act(self):
+        self.norm1 = GroupNormSiLU.from_groupnorm(self.norm1)
+        self.norm2 = GroupNormSiLU.from_groupnorm(self.norm2)
+        self.fused_norm_act = True
+
 
 class AttnBlock(nn.Module):
     def __init__(self, in_channels):
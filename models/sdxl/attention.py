@@ -10,6 +10,8 @@ from packaging import version
 from torch import nn
 from torch.utils.checkpoint import checkpoint
 
+from ..tome import compute_merge
+
 logpy = logging.getLogger(__name__)
 
 if version.parse(torch.__version__) >= version.parse("2.0.0"):
@@ -422,6 +424,10 @@ class BasicTransformerBlock(nn.Module):
         self.use_checkpoint = use_checkpoint
         if self.use_checkpoint:
             logpy.debug(f"{self.__class__.__name__} is using checkpointing")
+        # token merging, see models.tome.apply_tome
+        self.tome_ratio = 0.0
+        self.tome_stride = (2, 2)
+        self.tome_size = None
 
     def forward(
         self, x, context=None, additional_tokens=None, n_times_crossframe_attn_in_self=0
@@ -447,14 +453,19 @@ class BasicTransformerBlock(nn.Module):
     def _forward(
         self, x, context=None, additional_tokens=None, n_times_crossframe_attn_in_self=0
     ):
+        merge, unmerge, _ = compute_merge(
+            x, self.tome_ratio, self.tome_size, self.tome_stride
+        )
         x = (
-            self.attn1(
-                self.norm1(x),
-                context=context if self.disable_self_attn else None,
-                additional_tokens=additional_tokens,
-                n_times_crossframe_attn_in_self=n_times_crossframe_attn_in_self
-                if not self.disable_self_attn
-                else 0,
+            unmerge(
+                self.attn1(
+                    merge(self.norm1(x)),
+                    context=context if self.disable_self_attn else None,
+                    additional_tokens=additional_tokens,
+                    n_times_crossframe_attn_in_self=n_times_crossframe_attn_in_self
+                    if not self.disable_self_attn
+                    else 0,
+                )
             )
             + x
         )
@@ -566,6 +577,7 @@ class SpatialTransformer(nn.Module):
         for i, block in enumerate(self.transformer_blocks):
             if i > 0 and len(context) == 1:
                 i = 0  # use same context for each block
+            block.tome_size = (h, w)
             x = block(x, context=context[i])
         if self.use_linear:
             x = self.proj_out(x)
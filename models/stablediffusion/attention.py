@@ -7,6 +7,7 @@ from einops import rearrange, repeat
 from typing import Optional, Any
 
 from .modules import checkpoint as module_checkpoint
+from ..tome import compute_merge
 
 
 try:
@@ -209,12 +210,17 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
+        # token merging, see models.tome.apply_tome
+        self.tome_ratio = 0.
+        self.tome_stride = (2, 2)
+        self.tome_size = None
 
     def forward(self, x, context=None):
         return module_checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
 
     def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x), context=context if self.disable_self_attn else None) + x
+        merge, unmerge, _ = compute_merge(x, self.tome_ratio, self.tome_size, self.tome_stride)
+        x = unmerge(self.attn1(merge(self.norm1(x)), context=context if self.disable_self_attn else None)) + x
         x = self.attn2(self.norm2(x), context=context) + x
         x = self.ff(self.norm3(x)) + x
         return x
@@ -276,6 +282,7 @@ class SpatialTransformer(nn.Module):
         if self.use_linear:
             x = self.proj_in(x)
         for i, block in enumerate(self.transformer_blocks):
+            block.tome_size = (h, w)
             x = block(x, context=context[i])
         if self.use_linear:
             x = self.proj_out(x)
@@ -0,0 +1,200 @@
+import math
+from typing import Callable, List, Tuple, Union
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+def do_nothing(x: Tensor, mode: str = None):
+    return x
+
+
+def bipartite_soft_matching_2d(
+        metric: Tensor, h: int, w: int, r: int, sx: int = 2, sy: int = 2,
+) -> Tuple[Callable, Callable, Tensor]:
+    """Partition the tokens into src and dst sets, and merge the r most similar src tokens into dst.
+
+    The top-left token of every sy x sx window on the token grid is chosen as a dst token, so the partition is
+    deterministic and spatially uniform. Tokens merged away are restored by copying from the dst token they were
+    merged into, hence the sequence length seen by the wrapped layer is reduced from N to N - r.
+
+    Args:
+        metric: Tensor of shape [B, N, C] used to measure the similarity between tokens.
+        h: Height of the token grid.
+        w: Width of the token grid. Must satisfy h * w == N.
+        r: Number of tokens to remove.
+        sx: Stride of dst tokens along the width.
+        sy: Stride of dst tokens along the height.
+
+    Returns:
+        merge: Function mapping a tensor of shape [B, N, C'] to [B, N - r, C'].
+        unmerge: Function mapping a tensor of shape [B, N - r, C'] back to [B, N, C'].
+        ids_keep: Tensor of shape [B, N - r], original positions of the tokens after merging. None if r = 0.
+
+    References:
+        - Bolya, Daniel, Cheng-Yang Fu, Xiaoliang Dai, Peizhao Zhang, Christoph Feichtenhofer, and Judy Hoffman.
+          "Token merging: Your vit but faster." arXiv preprint arXiv:2210.09461 (2022).
+        - Bolya, Daniel, and Judy Hoffman. "Token merging for fast stable diffusion." In Proceedings of the IEEE/CVF
+          Conference on Computer Vision and Pattern Recognition, pp. 4598-4602. 2023.
+
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return do_nothing, do_nothing, None
+    if h * w != N:
+        raise ValueError(f'Invalid token grid: {h} x {w} does not match {N} tokens')
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+        num_dst = hsy * wsx
+        # mark the top-left token of each window as dst (-1) and others as src (0)
+        idx_buffer = torch.zeros(h, w, dtype=torch.int64, device=metric.device)
+        idx_buffer[:hsy*sy:sy, :wsx*sx:sx] = -1
+        # dst tokens come first after sorting
+        perm = idx_buffer.reshape(1, -1, 1).argsort(dim=1, stable=True)
+        a_idx = perm[:, num_dst:, :]  # src
+        b_idx = perm[:, :num_dst, :]  # dst
+
+        def split(x: Tensor):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+        r = min(a.shape[1], r)
+
+        # find the most similar dst token for each src token, and merge the r most similar edges
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:, :]  # unmerged src tokens
+        src_idx = edge_idx[:, :r, :]  # merged src tokens
+        dst_idx = torch.gather(node_idx[..., None], dim=1, index=src_idx)
+
+        a_idx = a_idx.expand(B, N - num_dst, 1)
+        unm_pos = torch.gather(a_idx, dim=1, index=unm_idx)
+        src_pos = torch.gather(a_idx, dim=1, index=src_idx)
+        ids_keep = torch.cat([unm_pos, b_idx.expand(B, num_dst, 1)], dim=1).squeeze(-1)
+
+    def merge(x: Tensor, mode: str = 'mean'):
+        src, dst = split(x)
+        C = x.shape[-1]
+        unm = torch.gather(src, dim=1, index=unm_idx.expand(B, N - num_dst - r, C))
+        src = torch.gather(src, dim=1, index=src_idx.expand(B, r, C))
+        dst = dst.scatter_reduce(1, dst_idx.expand(B, r, C), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: Tensor):
+        C = x.shape[-1]
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[:, :unm_len, :], x[:, unm_len:, :]
+        src = torch.gather(dst, dim=1, index=dst_idx.expand(B, r, C))
+        out = torch.zeros(B, N, C, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=1, index=b_idx.expand(B, num_dst, C), src=dst)
+        out.scatter_(dim=1, index=unm_pos.expand(B, unm_len, C), src=unm)
+        out.scatter_(dim=1, index=src_pos.expand(B, r, C), src=src)
+        return out
+
+    return merge, unmerge, ids_keep
+
+
+def compute_merge(
+        x: Tensor, ratio: float, size: Tuple[int, int] = None, stride: Tuple[int, int] = (2, 2),
+) -> Tuple[Callable, Callable, Tensor]:
+    """Build merge / unmerge functions that remove `ratio` of the tokens in x.
+
+    Args:
+        x: Tensor of shape [B, N, C].
+        ratio: Ratio of tokens to remove, in [0, 1).
+        size: (h, w) of the token grid. If None, the grid is assumed to be square.
+        stride: (sx, sy) of dst tokens.
+
+    """
+    N = x.shape[1]
+    r = int(N * ratio)
+    if r <= 0:
+        return do_nothing, do_nothing, None
+    if size is None:
+        h = w = int(math.sqrt(N))
+    else:
+        h, w = size
+    return bipartite_soft_matching_2d(x, h, w, r, sx=stride[0], sy=stride[1])
+
+
+def get_tome_blocks(model: nn.Module) -> List[nn.Module]:
+    """Collect the supported blocks of a model in the order of forward computation.
+
+    A model (or submodule) whose registration order differs from its forward order defines a `tome_blocks()` method
+    returning its blocks in forward order, which takes precedence over traversing its children. Otherwise, children are
+    traversed in registration order, which matches the forward order of the UNets of Stable Diffusion and of DiT.
+
+    """
+    if hasattr(model, 'tome_blocks'):
+        return list(model.tome_blocks())
+    if hasattr(model, 'tome_ratio'):
+        return [model]
+    return [block for child in model.children() for block in get_tome_blocks(child)]
+
+
+def apply_tome(model: nn.Module, ratio: Union[float, List[float]], stride: Tuple[int, int] = (2, 2)):
+    """Enable token merging on all the supported transformer blocks of a model.
+
+    Supported blocks are those having a `tome_ratio` attribute, i.e., BasicTransformerBlock of Stable Diffusion
+    (v1, v2 and XL), DiTBlock and MDTBlock. Merging is applied to self-attention only for Stable Diffusion, and to
+    both attention and mlp for DiT / MDT. Weights are untouched, so it is a pure inference option.
+
+    Args:
+        model: The model to patch.
+        ratio: Ratio of tokens to remove. A float is applied to all blocks, while a list specifies the ratio of
+         each block by depth, i.e., in the order of forward computation given by `get_tome_blocks()`. Missing entries
+         are treated as 0.
+        stride: (sx, sy) of dst tokens. Only one token out of each sy x sx window is kept as a dst token.
+
+    Returns:
+        The number of patched blocks.
+
+    """
+    # blocks not run at inference (e.g., the side-interpolater of MDTv2) are not given by `get_tome_blocks()`
+    for m in model.modules():
+        if hasattr(m, 'tome_ratio'):
+            m.tome_ratio = 0.
+    blocks = get_tome_blocks(model)
+    if isinstance(ratio, (int, float)):
+        ratio = [ratio] * len(blocks)
+    ratio = list(ratio)
+    if len(ratio) > len(blocks):
+        raise ValueError(f'Invalid ratio: got {len(ratio)} values for {len(blocks)} blocks')
+    ratio = ratio + [0.] * (len(blocks) - len(ratio))
+    for block, rt in zip(blocks, ratio):
+        if not 0 <= rt < 1:
+            raise ValueError(f'Invalid ratio: {rt}')
+        block.tome_ratio = float(rt)
+        block.tome_stride = tuple(stride)
+    return len(blocks)
+
+
+def remove_tome(model: nn.Module):
+    """Disable token merging on all the blocks of a model."""
+    return apply_tome(model, 0.)
+
+
+def _test():
+    B, h, w, C = 2, 8, 6, 16
+    x = torch.randn(B, h * w, C)
+    merge, unmerge, ids_keep = compute_merge(x, ratio=0.5, size=(h, w))
+    merged = merge(x)
+    print(merged.shape, ids_keep.shape)
+    assert merged.shape == (B, h * w - h * w // 2, C)
+    # unmerged tokens are kept as is
+    restored = unmerge(merged)
+    print(restored.shape)
+    unm_len = merged.shape[1] - (h // 2) * (w // 2)
+    assert torch.allclose(torch.gather(x, 1, ids_keep[:, :unm_len, None].expand(-1, -1, C)), merged[:, :unm_len])
+    assert torch.allclose(torch.gather(restored, 1, ids_keep[:, :unm_len, None].expand(-1, -1, C)), merged[:, :unm_len])
+
+
+if __name__ == '__main__':
+    _test()
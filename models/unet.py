@@ -1,10 +1,11 @@
-from typing import List
+from typing import List, Union
 
 import torch
 import torch.nn as nn
 from torch import Tensor
 
 from models.modules import SinusoidalPosEmb, SelfAttentionBlock, Downsample, Upsample
+from models.modules import checkpoint, get_checkpoint_flags
 
 
 class ResBlock(nn.Module):
@@ -54,10 +55,17 @@ class UNet(nn.Module):
             num_res_blocks: int = 2,
             n_heads: int = 1,
             dropout: float = 0.1,
+            use_checkpoint: Union[bool, int, List[bool]] = False,
     ):
+        """
+        Args:
+            use_checkpoint: Gradient checkpointing of each stage, see `models.modules.get_checkpoint_flags`.
+             Stages share the flag between the down and up paths, and the bottleneck follows the last stage.
+        """
         super().__init__()
         n_stages = len(dim_mults)
         dims = [dim]
+        self.use_checkpoint = get_checkpoint_flags(use_checkpoint, n_stages)
 
         # Time embeddings
         time_embed_dim = dim * 4
@@ -123,28 +131,29 @@ class UNet(nn.Module):
         X = self.first_conv(X)
         skips = [X]
 
-        for stage_blocks in self.down_blocks:
+        for stage_blocks, ckpt in zip(self.down_blocks, self.use_checkpoint):
             for blk in stage_blocks:  # noqa
                 if isinstance(blk, ResBlock):
-                    X = blk(X, time_embed)
+                    X = checkpoint(blk, X, time_embed, enabled=ckpt)
                     skips.append(X)
                 elif isinstance(blk, SelfAttentionBlock):
-                    X = blk(X)
+                    X = checkpoint(blk, X, enabled=ckpt)
                     skips[-1] = X
                 else:  # Downsample
                     X = blk(X)
                     skips.append(X)
 
-        X = self.bottleneck_block[0](X, time_embed)
-        X = self.bottleneck_block[1](X)
-        X = self.bottleneck_block[2](X, time_embed)
+        ckpt = self.use_checkpoint[-1]
+        X = checkpoint(self.bottleneck_block[0], X, time_embed, enabled=ckpt)
+        X = checkpoint(self.bottleneck_block[1], X, enabled=ckpt)
+        X = checkpoint(self.bottleneck_block[2], X, time_embed, enabled=ckpt)
 
-        for stage_blocks in self.up_blocks:
+        for stage_blocks, ckpt in zip(self.up_blocks, reversed(self.use_checkpoint)):
             for blk in stage_blocks:  # noqa
                 if isinstance(blk, ResBlock):
-                    X = blk(torch.cat((X, skips.pop()), dim=1), time_embed)
+                    X = checkpoint(blk, torch.cat((X, skips.pop()), dim=1), time_embed, enabled=ckpt)
                 elif isinstance(blk, SelfAttentionBlock):
-                    X = blk(X)
+                    X = checkpoint(blk, X, enabled=ckpt)
                 else:  # Upsample
                     X = blk(X)
 
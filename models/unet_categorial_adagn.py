@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Union
 from functools import partial
 
 import torch
@@ -6,7 +6,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
 
-from models.modules import SinusoidalPosEmb, SelfAttentionBlock, Downsample, Upsample, AdaGN
+from models.modules import SinusoidalPosEmb, SelfAttentionBlock, Downsample, Upsample, AdaGN, fuse_sequential
+from models.modules import checkpoint, get_checkpoint_flags
 
 
 class ResBlock(nn.Module):
@@ -61,6 +62,12 @@ class ResBlock(nn.Module):
         h = self.blk2(h)
         return h + self.shortcut(X)
 
+    def fuse_norm_act(self):
+        fuse_sequential(self.blk1)
+        # SiLU is applied inside AdaGN after scale / shift
+        self.adagn.fused_act = True
+        self.blk2[0] = nn.Identity()
+
 
 class ResBlockUpsample(ResBlock):
     def __init__(self, in_channels: int, out_channels: int, embed_dim: int, dropout: float = 0.1):
@@ -86,10 +93,17 @@ class UNetCategorialAdaGN(nn.Module):
             attn_head_dims: int = 64,
             resblock_updown: bool = True,
             dropout: float = 0.1,
+            use_checkpoint: Union[bool, int, List[bool]] = False,
     ):
+        """
+        Args:
+            use_checkpoint: Gradient checkpointing of each stage, see `models.modules.get_checkpoint_flags`.
+             Stages share the flag between the down and up paths, and the bottleneck follows the last stage.
+        """
         super().__init__()
         n_stages = len(dim_mults)
         dims = [dim]
+        self.use_checkpoint = get_checkpoint_flags(use_checkpoint, n_stages)
 
         # Time embeddings
         embed_dim = dim * 4
@@ -176,31 +190,32 @@ class UNetCategorialAdaGN(nn.Module):
         X = self.first_conv(X)
         skips = [X]
 
-        for stage_blocks in self.down_blocks:
+        for stage_blocks, ckpt in zip(self.down_blocks, self.use_checkpoint):
             for blk in stage_blocks:  # noqa
                 if isinstance(blk, ResBlock):
-                    X = blk(X, time_embed)
+                    X = checkpoint(blk, X, time_embed, enabled=ckpt)
                     skips.append(X)
                 elif isinstance(blk, SelfAttentionBlock):
-                    X = blk(X)
+                    X = checkpoint(blk, X, enabled=ckpt)
                     skips[-1] = X
                 else:
                     X = blk(X)
                     skips.append(X)
 
-        X = self.bottleneck_block[0](X, time_embed)
-        X = self.bottleneck_block[1](X)
-        X = self.bottleneck_block[2](X, time_embed)
+        ckpt = self.use_checkpoint[-1]
+        X = checkpoint(self.bottleneck_block[0], X, time_embed, enabled=ckpt)
+        X = checkpoint(self.bottleneck_block[1], X, enabled=ckpt)
+        X = checkpoint(self.bottleneck_block[2], X, time_embed, enabled=ckpt)
 
-        for stage_blocks in self.up_blocks:
+        for stage_blocks, ckpt in zip(self.up_blocks, reversed(self.use_checkpoint)):
             for blk in stage_blocks:  # noqa
                 if isinstance(blk, ResBlockUpsample):
-                    X = blk(X, time_embed)
+                    X = checkpoint(blk, X, time_embed, enabled=ckpt)
                 elif isinstance(blk, ResBlock):
                     X = torch.cat((X, skips.pop()), dim=1)
-                    X = blk(X, time_embed)
+                    X = checkpoint(blk, X, time_embed, enabled=ckpt)
                 elif isinstance(blk, SelfAttentionBlock):
-                    X = blk(X)
+                    X = checkpoint(blk, X, enabled=ckpt)
                 else:
                     X = blk(X)
 
@@ -0,0 +1,83 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from omegaconf import OmegaConf
+
+import torch
+
+from utils.logger import get_logger
+from utils.evaluate import build_feature_extractor, get_ref_stats
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', type=str, required=True,
+        help='Path to configuration file, whose `data` field specifies the dataset',
+    )
+    parser.add_argument(
+        '--split', type=str, default='train',
+        help='Split of the dataset',
+    )
+    parser.add_argument(
+        '--feature_extractor', type=str, default='inception',
+        help='Feature extractor. Could be `inception`, `tiny` or import path of a custom class',
+    )
+    parser.add_argument(
+        '--keep_features', action='store_true', default=False,
+        help='Save features along with the statistics, which are required by precision / recall',
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=os.path.join('cache', 'ref_stats'),
+        help='Path to directory of the cache',
+    )
+    parser.add_argument(
+        '--recompute', action='store_true', default=False,
+        help='Recompute the statistics even if a valid cache exists',
+    )
+    parser.add_argument(
+        '--batch_size', type=int, default=256,
+        help='Batch size',
+    )
+    parser.add_argument(
+        '--num_workers', type=int, default=4,
+        help='Number of dataloader workers',
+    )
+    return parser
+
+
+def main():
+    # PARSE ARGS AND CONFIGS
+    args, unknown_args = get_parser().parse_known_args()
+    unknown_args = [(a[2:] if a.startswith('--') else a) for a in unknown_args]
+    unknown_args = [f'{k}={v}' for k, v in zip(unknown_args[::2], unknown_args[1::2])]
+    conf = OmegaConf.load(args.config)
+    conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(unknown_args))
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logger = get_logger(use_tqdm_handler=True)
+
+    # BUILD FEATURE EXTRACTOR
+    extractor = build_feature_extractor(args.feature_extractor).to(device)
+
+    # COMPUTE OR LOAD REFERENCE STATISTICS
+    ref_stats = get_ref_stats(
+        data_conf=conf.data,
+        extractor=extractor,
+        split=args.split,
+        cache_dir=args.cache_dir,
+        keep_features=args.keep_features,
+        recompute=args.recompute,
+        logger=logger,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        device=device,
+    )
+    logger.info(f'Dimension of features: {ref_stats["mu"].shape[0]}')
+    logger.info(f'Fingerprint of dataset: {ref_stats["meta"]["fingerprint"]}')
+
+
+if __name__ == '__main__':
+    main()
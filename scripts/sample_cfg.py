@@ -2,18 +2,24 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import json
 import math
 import argparse
+from functools import partial
 from omegaconf import OmegaConf
 
 import torch
 import accelerate
-from torchvision.utils import save_image
 
 import diffusions
 from utils.logger import get_logger
 from utils.load import load_weights
+from utils.writer import ImageWriter, ArrayWriter, Manifest, get_shard_indices
+from utils.evaluate import Evaluator, build_feature_extractor, load_stats, get_ref_stats
+from utils.autotune import parse_batch_size, autotune_batch_size, make_sample_probe
 from utils.misc import image_norm_to_float, instantiate_from_config, amortize
+from models.modules import fuse_norm_act
+from models.tome import apply_tome
 
 
 def get_parser():
@@ -35,6 +41,15 @@ def get_parser():
         help='Guidance scale. 0 for unconditional generation, '
              '1 for non-guided generation, >1 for guided generation',
     )
+    parser.add_argument(
+        '--guidance_interval', type=float, nargs=2, default=[0., 1.],
+        help='Range of normalized timesteps (t / total_steps) where guidance is applied. '
+             'Outside the range, the unconditional branch is skipped',
+    )
+    parser.add_argument(
+        '--guidance_scaling', type=str, default='constant', choices=['constant', 'linear', 'power-cos'],
+        help='Scaling of guidance scale over timesteps',
+    )
     parser.add_argument(
         '--class_ids', type=int, nargs='+', default=None,
         help='Which class IDs to sample. '
@@ -49,8 +64,55 @@ def get_parser():
         help='Path to directory saving samples',
     )
     parser.add_argument(
-        '--batch_size', type=int, default=500,
-        help='Batch size on each process',
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into memory-mapped arrays `samples.npy` and `labels.npy` '
+             'in save_dir, where samples of the i-th class in class_ids are at [i * n_samples_each_class, ...)',
+    )
+    parser.add_argument(
+        '--sharded_output', action='store_true', default=False,
+        help='Each process saves its own samples instead of gathering them to the main process',
+    )
+    parser.add_argument(
+        '--batch_size', type=parse_batch_size, default=500,
+        help='Batch size on each process. Use `auto` to find the throughput-optimal batch size that fits in memory',
+    )
+    parser.add_argument(
+        '--channels_last', action='store_true', default=False,
+        help='Convert the model to channels_last memory format',
+    )
+    parser.add_argument(
+        '--fuse_norm_act', action='store_true', default=False,
+        help='Fuse GroupNorm and SiLU layers of the model',
+    )
+    # arguments for evaluation
+    parser.add_argument(
+        '--eval', action='store_true', default=False,
+        help='Evaluate samples on the fly. Images are not saved unless --save_images is set',
+    )
+    parser.add_argument(
+        '--metrics', type=str, nargs='+', default=['fid', 'is'], choices=['fid', 'is', 'pr'],
+        help='Metrics to evaluate, pr stands for precision / recall',
+    )
+    parser.add_argument(
+        '--feature_extractor', type=str, default='inception',
+        help='Feature extractor for evaluation. Could be `inception`, `tiny` or import path of a custom class',
+    )
+    parser.add_argument(
+        '--ref_stats', type=str, default=None,
+        help='Path to reference statistics (npz file containing mu, sigma and optionally features). '
+             'If not provided, will load or compute the cached statistics of the dataset in the config',
+    )
+    parser.add_argument(
+        '--ref_split', type=str, default='train',
+        help='Split of the dataset used as reference when --ref_stats is not provided',
+    )
+    parser.add_argument(
+        '--save_images', action='store_true', default=False,
+        help='Save images when --eval is set',
     )
     # arguments for all diffusers
     parser.add_argument(
@@ -75,6 +137,12 @@ def get_parser():
         '--ddim_eta', type=float, default=0.0,
         help='Parameter eta in DDIM sampling',
     )
+    # arguments for transformer models
+    parser.add_argument(
+        '--tome_ratio', type=float, nargs='+', default=None,
+        help='Ratio of tokens to merge in each transformer block (DiT, MDT). '
+             'Either a single value for all blocks or one value per block by depth',
+    )
     return parser
 
 
@@ -120,6 +188,8 @@ if __name__ == '__main__':
             respace_steps=args.respace_steps or conf.diffusion.params.total_steps,
             device=device,
             guidance_scale=args.guidance_scale,
+            guidance_interval=args.guidance_interval,
+            guidance_scaling=args.guidance_scaling,
         )
     elif args.sampler == 'ddim':
         diffuser = diffusions.ddim.DDIMCFG(
@@ -133,6 +203,8 @@ if __name__ == '__main__':
             eta=args.ddim_eta,
             device=device,
             guidance_scale=args.guidance_scale,
+            guidance_interval=args.guidance_interval,
+            guidance_scaling=args.guidance_scaling,
         )
     else:
         raise ValueError(f'Unknown sampler: {args.sampler}')
@@ -147,12 +219,98 @@ if __name__ == '__main__':
     logger.info(f'Successfully load model from {args.weights}')
     logger.info('=' * 50)
 
+    # TOKEN MERGING
+    if args.tome_ratio is not None:
+        tome_ratio = args.tome_ratio[0] if len(args.tome_ratio) == 1 else args.tome_ratio
+        n_blocks = apply_tome(model, tome_ratio)
+        logger.info(f'Enable token merging on {n_blocks} blocks with ratio {args.tome_ratio}')
+
+    # OPTIMIZE MODEL
+    if args.fuse_norm_act:
+        fuse_norm_act(model)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
+
     # PREPARE FOR DISTRIBUTED MODE AND MIXED PRECISION
     model = accelerator.prepare(model)
     model.eval()
 
+    # TUNE BATCH SIZE
+    if args.batch_size == 'auto':
+        img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
+        probe_fn = make_sample_probe(
+            model=accelerator.unwrap_model(model), img_shape=img_shape, device=device,
+            total_steps=conf.diffusion.params.total_steps, n_forward=2,
+            model_kwargs_fn=lambda bs: dict(y=torch.zeros((bs, ), dtype=torch.long, device=device)),
+        )
+        batch_size = autotune_batch_size(
+            fn=probe_fn, device=device,
+            max_batch_size=math.ceil(args.n_samples_each_class / accelerator.num_processes),
+            key=dict(
+                task='sample', sampler=f'{args.sampler}_cfg', model=OmegaConf.to_container(conf.model),
+                img_shape=img_shape, mixed_precision=str(accelerator.mixed_precision),
+                channels_last=args.channels_last, fuse_norm_act=args.fuse_norm_act,
+                tome_ratio=args.tome_ratio,
+            ),
+            write_cache=accelerator.is_main_process, logger=logger,
+        )
+        # use the same batch size on all processes
+        args.batch_size = int(accelerator.gather(torch.tensor([batch_size], device=device)).min().item())
+        logger.info(f'Batch size per process: {args.batch_size}')
+
+    # BUILD EVALUATOR
+    evaluator = None
+    if args.eval:
+        extractor = build_feature_extractor(args.feature_extractor).to(device)
+        if args.ref_stats is not None:
+            ref_stats = load_stats(args.ref_stats)
+        else:
+            ref_kwargs = dict(
+                data_conf=conf.data, extractor=extractor, split=args.ref_split,
+                keep_features='pr' in args.metrics, device=device,
+            )
+            # compute on the main process, then load the cache on other processes
+            if accelerator.is_main_process:
+                get_ref_stats(**ref_kwargs, logger=logger)
+            accelerator.wait_for_everyone()
+            ref_stats = get_ref_stats(**ref_kwargs)
+        evaluator = Evaluator(extractor, metrics=args.metrics, ref_stats=ref_stats)
+        logger.info(f'Evaluate {args.metrics} with feature extractor {extractor.name}')
+    save_images = not args.eval or args.save_images
+
     accelerator.wait_for_everyone()
 
+    def save_fold(samples: torch.Tensor, c: int, ci: int, offset: int, bs: int, bspp: int):
+        # c is the class ID and ci is its position in class_ids
+        # offset is the index of the first sample of this fold in class c
+        if args.sharded_output:
+            indices = get_shard_indices(offset, bs, bspp, accelerator.process_index)
+            samples = samples[:len(indices)]
+        else:
+            samples = accelerator.gather(samples)[:bs]
+            indices = range(offset, offset + bs)
+            if not accelerator.is_main_process:
+                return
+        # the global index of a sample is its position in the output, i.e., ci * n_samples_each_class + index, for
+        # both the npy file and the manifest of image files
+        global_indices = [ci * args.n_samples_each_class + index for index in indices]
+        if array_writer is not None:
+            array_writer.write(global_indices, samples, labels=[c] * len(indices))
+            if manifest is not None:
+                # record the rows only after they are flushed to disk, so that a resumed job never trusts rows
+                # that were not written
+                array_writer.flush()
+                for global_index in global_indices:
+                    manifest.add(global_index, 'samples.npy', label=c)
+            return
+        for x, index, global_index in zip(samples.cpu(), indices, global_indices):
+            filename = os.path.join(f'class{c}', f'{index}.{args.image_format}')
+            callback = None if manifest is None else partial(manifest.add, global_index, filename, label=c)
+            image_writer.save(
+                image_norm_to_float(x), os.path.join(args.save_dir, filename),
+                nrow=1, callback=callback,
+            )
+
     @torch.no_grad()
     def sample():
         img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
@@ -162,29 +320,58 @@ if __name__ == '__main__':
             class_ids = range(conf.data.num_classes)
         logger.info(f'Will sample {args.n_samples_each_class} images for each of the following class IDs: {class_ids}')
 
-        for c in class_ids:
-            os.makedirs(os.path.join(args.save_dir, f'class{c}'), exist_ok=True)
+        for ci, c in enumerate(class_ids):
+            if save_images and array_writer is None:
+                os.makedirs(os.path.join(args.save_dir, f'class{c}'), exist_ok=True)
             idx = 0
             logger.info(f'Sampling class {c}')
             folds = amortize(args.n_samples_each_class, bspp * accelerator.num_processes)
             for i, bs in enumerate(folds):
-                init_noise = torch.randn((bs, *img_shape), device=device)
-                labels = torch.full((bs, ), fill_value=c, device=device)
+                init_noise = torch.randn((bspp, *img_shape), device=device)
+                labels = torch.full((bspp, ), fill_value=c, device=device)
                 samples = diffuser.sample(
                     model=accelerator.unwrap_model(model), init_noise=init_noise, model_kwargs=dict(y=labels),
                     tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process),
                 ).clamp(-1, 1)
-                samples = accelerator.gather(samples)[:bs]
-                if accelerator.is_main_process:
-                    for x in samples:
-                        x = image_norm_to_float(x).cpu()
-                        save_image(x, os.path.join(args.save_dir, f'class{c}', f'{idx}.png'), nrow=1)
-                        idx += 1
+                if evaluator is not None:
+                    outputs = evaluator.extract(samples)
+                    outputs = {k: accelerator.gather(v)[:bs] for k, v in outputs.items()}
+                    if accelerator.is_main_process:
+                        evaluator.update_features(outputs)
+                if save_images:
+                    save_fold(samples, c, ci, idx, bs, bspp)
+                idx += bs
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
+    manifest = Manifest(args.save_dir, rank=accelerator.process_index) if args.sharded_output else None
+    array_writer = None
+    if args.output_format == 'npy':
+        n_classes = conf.data.num_classes if args.class_ids is None else len(args.class_ids)
+        array_writer = ArrayWriter(
+            args.save_dir, n_classes * args.n_samples_each_class, with_labels=True,
+            is_main_process=accelerator.is_main_process,
+            sync_fn=accelerator.wait_for_everyone if args.sharded_output else None,
+        )
     sample()
+    if evaluator is not None and accelerator.is_main_process:
+        results = evaluator.compute()
+        for k, v in results.items():
+            logger.info(f'{k}: {v:.4f}')
+        with open(os.path.join(args.save_dir, 'metrics.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f'Metrics are saved to {os.path.join(args.save_dir, "metrics.json")}')
+    image_writer.close()
+    if array_writer is not None:
+        array_writer.close()
+    if manifest is not None:
+        manifest.close()
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            n_records = Manifest.merge(args.save_dir)
+            logger.info(f'Manifest of {n_records} samples is saved to {os.path.join(args.save_dir, "manifest.jsonl")}')
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
@@ -8,11 +8,11 @@ from omegaconf import OmegaConf
 
 import torch
 import accelerate
-from torchvision.utils import save_image
 
 import diffusions
 from utils.logger import get_logger
 from utils.load import load_weights
+from utils.writer import ImageWriter, ArrayWriter
 from utils.misc import image_norm_to_float, instantiate_from_config, amortize
 
 
@@ -54,6 +54,14 @@ def get_parser():
         '--clip_model', type=str, default='openai/clip-vit-large-patch14',
         help='Name of CLIP model',
     )
+    parser.add_argument(
+        '--clip_fp16', action='store_true',
+        help='Run CLIP in half precision',
+    )
+    parser.add_argument(
+        '--n_cutouts', type=int, default=0,
+        help='Number of random cutouts of each image fed to CLIP. Use the whole image if 0',
+    )
     parser.add_argument(
         '--n_samples', type=int, required=True,
         help='Number of samples',
@@ -62,6 +70,14 @@ def get_parser():
         '--save_dir', type=str, required=True,
         help='Path to directory saving samples',
     )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
     parser.add_argument(
         '--batch_size', type=int, default=500,
         help='Batch size on each process',
@@ -107,6 +123,8 @@ def main():
         'device': device,
         'guidance_weight': args.guidance_weight,
         'clip_pretrained': args.clip_model,
+        'clip_dtype': 'float16' if args.clip_fp16 else 'float32',
+        'n_cutouts': args.n_cutouts,
     })
     diffuser = diffusions.CLIPGuidance(**diffusion_params)
     logger.info('=' * 19 + ' Model Info ' + '=' * 19)
@@ -130,6 +148,7 @@ def main():
     @torch.no_grad()
     def sample():
         idx = 0
+        array_writer = ArrayWriter(args.save_dir, args.n_samples) if args.output_format == 'npy' else None
         img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
         bspp = min(args.batch_size, math.ceil(args.n_samples / accelerator.num_processes))
         folds = amortize(args.n_samples, bspp * accelerator.num_processes)
@@ -140,11 +159,16 @@ def main():
                 tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process)
             ).clamp(-1, 1)
             samples = accelerator.gather(samples)[:bs]
-            if accelerator.is_main_process:
-                for x in samples:
-                    x = image_norm_to_float(x).cpu()
-                    save_image(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=1)
+            if accelerator.is_main_process and array_writer is not None:
+                array_writer.write(range(idx, idx + bs), samples)
+                idx += bs
+            elif accelerator.is_main_process:
+                for x in samples.cpu():
+                    x = image_norm_to_float(x)
+                    image_writer.save(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=1)
                     idx += 1
+        if array_writer is not None:
+            array_writer.close()
         with open(os.path.join(args.save_dir, 'description.txt'), 'w') as f:
             f.write(args.text)
 
@@ -155,7 +179,9 @@ def main():
     diffuser.set_text(args.text)
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
     sample()
+    image_writer.close()
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
@@ -10,12 +10,12 @@ import torch
 import accelerate
 import torchvision.transforms as T
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 
 import diffusions
 from datasets import ImageDir
 from utils.logger import get_logger
-from utils.load import load_weights
+from utils.load import load_weights, get_weights_fingerprint
+from utils.writer import ImageWriter, ArrayWriter
 from utils.misc import image_norm_to_float, instantiate_from_config
 
 
@@ -57,10 +57,23 @@ def get_parser():
         '--save_dir', type=str, required=True,
         help='Path to directory saving samples',
     )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
     parser.add_argument(
         '--batch_size', type=int, default=32,
         help='Batch size on each process',
     )
+    parser.add_argument(
+        '--noise_cache_dir', type=str, default=None,
+        help='Path to directory caching the noise inverted from images in domain A. '
+             'Translating the same images to other classes loads the noise instead of inverting again',
+    )
     return parser
 
 
@@ -133,34 +146,52 @@ def main():
         dataloader = DataLoader(dataset=dataset, batch_size=bspp, num_workers=4, pin_memory=True, prefetch_factor=2)
         dataloader = accelerator.prepare(dataloader)  # type: ignore
         logger.info(f'Found {len(dataset)} images in {args.input_dir}')
+        array_writer = ArrayWriter(args.save_dir, len(dataset)) if args.output_format == 'npy' else None
+        # build pipeline, where inversion of the next batch is batched with generation of the current batch
+        noise_cache = None
+        if args.noise_cache_dir is not None:
+            noise_cache = diffusions.NoiseCache(args.noise_cache_dir, namespace=dict(
+                weights=get_weights_fingerprint(args.weights), model=OmegaConf.to_container(conf.model),
+                respaced_seq=diffuser.respaced_seq.tolist(), class_A=args.class_A,
+                mixed_precision=str(accelerator.mixed_precision),
+            ))
+        pipeline = diffusions.InversionPipeline(diffuser, accelerator.unwrap_model(model), noise_cache)
+
+        def get_items():
+            for X in dataloader:  # noqa
+                X = X[0].float() if isinstance(X, (tuple, list)) else X.float()
+                yA = torch.full((X.shape[0], ), args.class_A, device=device).long()
+                yB = torch.full((X.shape[0], ), args.class_B, device=device).long()
+                yield dict(img=X, inversion_kwargs=dict(y=yA), generation_kwargs=dict(y=yB))
+
         # sampling
         idx = 0
-        for i, X in enumerate(dataloader):
-            X = X[0].float() if isinstance(X, (tuple, list)) else X.float()
-            yA = torch.full((X.shape[0], ), args.class_A, device=device).long()
-            yB = torch.full((X.shape[0], ), args.class_B, device=device).long()
-            noise = diffuser.sample_inversion(
-                model=accelerator.unwrap_model(model), img=X, model_kwargs=dict(y=yA),
-                tqdm_kwargs=dict(desc=f'img2noise {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
-            )
-            tX = diffuser.sample(
-                model=model, init_noise=noise, model_kwargs=dict(y=yB),
-                tqdm_kwargs=dict(desc=f'noise2img {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
-            )
-            X = accelerator.gather_for_metrics(X)
-            tX = accelerator.gather_for_metrics(tX)
-            if accelerator.is_main_process:
-                for x, tx in zip(X, tX):
-                    x = image_norm_to_float(x).cpu()
-                    tx = image_norm_to_float(tx).cpu()
-                    save_image([x, tx], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
+        for item, _, tX in pipeline.run(
+                get_items(), tqdm_kwargs=dict(desc='img2noise2img', disable=not accelerator.is_main_process),
+        ):
+            # gather_for_metrics() cannot be used because the pipeline lags behind the dataloader, so drop the
+            # samples duplicated by the dataloader to even out the last batch manually
+            X = accelerator.gather(item['img'])[:len(dataset) - idx]
+            tX = accelerator.gather(tX)[:len(dataset) - idx]
+            if accelerator.is_main_process and array_writer is not None:
+                array_writer.write(range(idx, idx + len(X)), torch.stack([X, tX], dim=1).clamp(-1, 1))
+                idx += len(X)
+            elif accelerator.is_main_process:
+                for x, tx in zip(X.cpu(), tX.cpu()):
+                    x = image_norm_to_float(x)
+                    tx = image_norm_to_float(tx)
+                    image_writer.save([x, tx], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
                     idx += 1
+        if array_writer is not None:
+            array_writer.close()
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
     translate()
+    image_writer.close()
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
@@ -10,12 +10,12 @@ import torch
 import accelerate
 import torchvision.transforms as T
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 
 import diffusions
 from datasets import ImageDir
 from utils.logger import get_logger
 from utils.load import load_weights
+from utils.writer import ImageWriter, ArrayWriter
 from utils.misc import image_norm_to_float, instantiate_from_config
 
 
@@ -62,6 +62,14 @@ def get_parser():
         '--save_dir', type=str, required=True,
         help='Path to directory saving samples',
     )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
     parser.add_argument(
         '--batch_size', type=int, default=32,
         help='Batch size on each process',
@@ -142,6 +150,7 @@ def main():
         dataloader = DataLoader(dataset=dataset, batch_size=bspp, num_workers=4, pin_memory=True, prefetch_factor=2)
         dataloader = accelerator.prepare(dataloader)  # type: ignore
         logger.info(f'Found {len(dataset)} images in {args.input_dir}')
+        array_writer = ArrayWriter(args.save_dir, len(dataset)) if args.output_format == 'npy' else None
         # sampling
         idx = 0
         for i, X in enumerate(dataloader):
@@ -152,19 +161,27 @@ def main():
                 model=accelerator.unwrap_model(model), init_noise=init_noise,
                 tqdm_kwargs=dict(desc=f'Fold {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
             ).clamp(-1, 1)
+            X = accelerator.gather_for_metrics(X)
             out = accelerator.gather_for_metrics(out)
-            if accelerator.is_main_process:
-                for x, o in zip(X, out):
-                    x = image_norm_to_float(x).cpu()
-                    o = image_norm_to_float(o).cpu()
-                    save_image([x, o], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
+            if accelerator.is_main_process and array_writer is not None:
+                array_writer.write(range(idx, idx + len(out)), torch.stack([X, out], dim=1))
+                idx += len(out)
+            elif accelerator.is_main_process:
+                for x, o in zip(X.cpu(), out.cpu()):
+                    x = image_norm_to_float(x)
+                    o = image_norm_to_float(o)
+                    image_writer.save([x, o], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
                     idx += 1
+        if array_writer is not None:
+            array_writer.close()
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
     sample()
+    image_writer.close()
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
@@ -11,12 +11,12 @@ import torch
 import accelerate
 import torchvision.transforms as T
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 
 import diffusions
 from datasets import ImageDir
 from utils.logger import get_logger
 from utils.load import load_weights
+from utils.writer import ImageWriter, ArrayWriter
 from utils.mask import DatasetWithMask
 from utils.misc import image_norm_to_float, instantiate_from_config
 
@@ -67,6 +67,14 @@ def get_parser():
         '--save_dir', type=str, required=True,
         help='Path to directory saving samples',
     )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
     parser.add_argument(
         '--batch_size', type=int, default=32,
         help='Batch size on each process',
@@ -141,17 +149,19 @@ def main():
             T.Normalize([0.5] * 3, [0.5] * 3),
         ])
         dataset = ImageDir(root=args.input_dir, transform=transforms)
-        dataset = DatasetWithMask(dataset=dataset, mask_type='brush')
+        dataset = DatasetWithMask(dataset=dataset, mask_type='brush', lazy_mask=True)
         bspp = min(args.batch_size, math.ceil(len(dataset) / accelerator.num_processes))
         dataloader = DataLoader(dataset=dataset, batch_size=bspp, num_workers=4, pin_memory=True, prefetch_factor=2)
         dataloader = accelerator.prepare(dataloader)  # type: ignore
         logger.info(f'Found {len(dataset)} images in {args.input_dir}')
+        array_writer = ArrayWriter(args.save_dir, len(dataset)) if args.output_format == 'npy' else None
         # sampling
         idx = 0
         sample_fn = diffuser.sample
         if args.resample:
             sample_fn = partial(diffuser.resample, resample_r=args.resample_r, resample_j=args.resample_j)
-        for i, (X, mask) in enumerate(dataloader):
+        for i, (X, items) in enumerate(dataloader):
+            mask = dataset.mask_generator.sample_batch(X.shape[-2], X.shape[-1], items, device=device)
             init_noise = torch.randn_like(X)
             masked_image = X * mask
             diffuser.set_mask_and_image(masked_image, mask.float())
@@ -159,20 +169,29 @@ def main():
                 model=accelerator.unwrap_model(model), init_noise=init_noise,
                 tqdm_kwargs=dict(desc=f'Fold {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
             ).clamp(-1, 1)
+            masked_image = accelerator.gather_for_metrics(masked_image)
+            X = accelerator.gather_for_metrics(X)
             recX = accelerator.gather_for_metrics(recX)
-            if accelerator.is_main_process:
-                for m, x, r in zip(masked_image, X, recX):
-                    m = image_norm_to_float(m).cpu()
-                    x = image_norm_to_float(x).cpu()
-                    r = image_norm_to_float(r).cpu()
-                    save_image([m, x, r], os.path.join(args.save_dir, f'{idx}.png'), nrow=3)
+            if accelerator.is_main_process and array_writer is not None:
+                array_writer.write(range(idx, idx + len(recX)), torch.stack([masked_image, X, recX], dim=1))
+                idx += len(recX)
+            elif accelerator.is_main_process:
+                for m, x, r in zip(masked_image.cpu(), X.cpu(), recX.cpu()):
+                    m = image_norm_to_float(m)
+                    x = image_norm_to_float(x)
+                    r = image_norm_to_float(r)
+                    image_writer.save([m, x, r], os.path.join(args.save_dir, f'{idx}.png'), nrow=3)
                     idx += 1
+        if array_writer is not None:
+            array_writer.close()
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
     sample()
+    image_writer.close()
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
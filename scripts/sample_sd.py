@@ -0,0 +1,298 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import argparse
+from functools import partial
+from collections import defaultdict
+from omegaconf import OmegaConf
+
+import torch
+import accelerate
+
+import diffusions
+from utils.logger import get_logger
+from utils.load import load_weights
+from utils.writer import ImageWriter, Manifest
+from utils.misc import image_norm_to_float, instantiate_from_config, SampleGenerator
+from models.tome import apply_tome
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', type=str, required=True,
+        help='Path to inference configuration file of Stable Diffusion v1.5 or SDXL',
+    )
+    parser.add_argument(
+        '--weights', type=str, required=True,
+        help='Path to pretrained model weights',
+    )
+    parser.add_argument(
+        '--prompts', type=str, required=True,
+        help='Path to a JSONL file, each line is a json object with key `prompt`, and optionally `negative`, '
+             '`seed`, `height`, `width`, `steps` and `cfg`, which override the defaults given by arguments',
+    )
+    parser.add_argument(
+        '--save_dir', type=str, required=True,
+        help='Path to directory saving samples',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=2022,
+        help='Base random seed of rows without `seed`',
+    )
+    parser.add_argument(
+        '--negative_prompt', type=str, default='',
+        help='Default negative prompt',
+    )
+    parser.add_argument(
+        '--height', type=int, default=512,
+        help='Default image height',
+    )
+    parser.add_argument(
+        '--width', type=int, default=512,
+        help='Default image width',
+    )
+    parser.add_argument(
+        '--guidance_scale', type=float, default=7.5,
+        help='Default guidance scale',
+    )
+    parser.add_argument(
+        '--guidance_interval', type=float, nargs=2, default=[0., 1.],
+        help='Range of normalized timesteps (t / total_steps) where guidance is applied',
+    )
+    parser.add_argument(
+        '--guidance_scaling', type=str, default='constant', choices=['constant', 'linear', 'power-cos'],
+        help='Scaling of guidance scale over timesteps',
+    )
+    parser.add_argument(
+        '--dedup_rows', action='store_true', default=False,
+        help='Evaluate the model only once for identical rows in a batch, e.g., rows of a prompt grid sharing the '
+             'same seed and prompt, or the same seed and negative prompt at the first step',
+    )
+    parser.add_argument(
+        '--sampler', type=str, choices=['ddpm', 'ddim'], default='ddim',
+        help='Type of sampler',
+    )
+    parser.add_argument(
+        '--respace_type', type=str, default='uniform-leading',
+        help='Type of respaced timestep sequence',
+    )
+    parser.add_argument(
+        '--respace_steps', type=int, default=50,
+        help='Default length of respaced timestep sequence',
+    )
+    parser.add_argument(
+        '--ddim_eta', type=float, default=0.0,
+        help='Parameter eta in DDIM sampling',
+    )
+    parser.add_argument(
+        '--batch_size', type=int, default=4,
+        help='Batch size on each process',
+    )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--skip_existing', action='store_true', default=False,
+        help='Skip rows whose images are recorded in the manifest of save_dir, e.g., when resuming an interrupted job',
+    )
+    parser.add_argument(
+        '--tome_ratio', type=float, default=0.0,
+        help='Ratio of tokens to merge in transformer blocks of the UNet',
+    )
+    parser.add_argument(
+        '--low_vram', action='store_true', default=False,
+        help='Keep only the running component (text encoder, UNet or VAE) on GPU',
+    )
+    return parser
+
+
+def load_prompts(path: str, args):
+    """Load rows of the prompt file and fill in the defaults. The index of a row is its line number."""
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if 'prompt' not in row:
+                raise ValueError(f'Invalid row {len(rows)}: key `prompt` is required')
+            index = len(rows)
+            row = dict(
+                index=index,
+                prompt=row['prompt'],
+                negative=row.get('negative', args.negative_prompt),
+                seed=int(row.get('seed', SampleGenerator.get_seed(args.seed, index))),
+                height=int(row.get('height', args.height)),
+                width=int(row.get('width', args.width)),
+                steps=int(row.get('steps', args.respace_steps)),
+                cfg=float(row.get('cfg', args.guidance_scale)),
+            )
+            if row['height'] % 8 != 0 or row['width'] % 8 != 0:
+                raise ValueError(f'Invalid size of row {index}: {row["height"]}x{row["width"]}')
+            rows.append(row)
+    return rows
+
+
+def get_buckets(rows):
+    """Group rows that can be sampled in the same batch, i.e., with the same latent shape and number of steps.
+    Rows with different guidance scales are co-batched with a per-row guidance scale Tensor."""
+    buckets = defaultdict(list)
+    for row in rows:
+        buckets[(row['height'], row['width'], row['steps'])].append(row)
+    return buckets
+
+
+def main():
+    # PARSE ARGS AND CONFIGS
+    args, unknown_args = get_parser().parse_known_args()
+    unknown_args = [(a[2:] if a.startswith('--') else a) for a in unknown_args]
+    unknown_args = [f'{k}={v}' for k, v in zip(unknown_args[::2], unknown_args[1::2])]
+    conf = OmegaConf.load(args.config)
+    conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(unknown_args))
+
+    # INITIALIZE ACCELERATOR
+    accelerator = accelerate.Accelerator()
+    device = accelerator.device
+    print(f'Process {accelerator.process_index} using device: {device}')
+    accelerator.wait_for_everyone()
+
+    # INITIALIZE LOGGER
+    logger = get_logger(
+        use_tqdm_handler=True,
+        is_main_process=accelerator.is_main_process,
+    )
+
+    # SET SEED
+    accelerate.utils.set_seed(args.seed, device_specific=True)
+    logger.info('=' * 19 + ' System Info ' + '=' * 18)
+    logger.info(f'Number of processes: {accelerator.num_processes}')
+    logger.info(f'Distributed type: {accelerator.distributed_type}')
+    logger.info(f'Mixed precision: {accelerator.mixed_precision}')
+
+    accelerator.wait_for_everyone()
+
+    # BUILD MODEL
+    is_sdxl = conf.model.target.startswith('models.sdxl.')
+    model = instantiate_from_config(conf.model, low_vram_shift_enabled=args.low_vram)
+
+    # LOAD WEIGHTS
+    weights = load_weights(args.weights)
+    model.load_state_dict(weights)
+    logger.info(f'Successfully load model from {args.weights}')
+    logger.info('=' * 50)
+    model.to(device).eval()
+    apply_tome(model, args.tome_ratio)
+
+    # BUILD DIFFUSER
+    diffusion_params = OmegaConf.to_container(conf.diffusion.params)
+    diffusion_params.update(
+        respace_type=args.respace_type,
+        respace_steps=args.respace_steps,
+        guidance_interval=args.guidance_interval,
+        guidance_scaling=args.guidance_scaling,
+        dedup_rows=args.dedup_rows,
+        cond_kwarg='condition_dict' if is_sdxl else 'text_embed',
+        device=device,
+    )
+    if args.sampler == 'ddpm':
+        diffuser = diffusions.DDPMCFG(**diffusion_params)
+    elif args.sampler == 'ddim':
+        diffuser = diffusions.DDIMCFG(**diffusion_params, eta=args.ddim_eta)
+    else:
+        raise ValueError(f'Unknown sampler: {args.sampler}')
+
+    def get_diffuser(steps: int):
+        # a view of the diffuser with the number of steps of the bucket, sharing the noise schedule
+        return diffuser.with_options(respace_type=args.respace_type, respace_steps=steps)
+
+    def encode_text(texts, H: int, W: int):
+        # encode each unique text only once, then index the embeddings back to rows
+        unique_texts = list(dict.fromkeys(texts))
+        inverse = torch.tensor([unique_texts.index(text) for text in texts], device=device)
+        if is_sdxl:
+            embeds = model.conditioner_forward(text=unique_texts, H=H, W=W)
+            return {k: v[inverse] if isinstance(v, torch.Tensor) else v for k, v in embeds.items()}
+        return model.text_encoder_encode(unique_texts)[inverse]
+
+    def get_filename(row):
+        return f'{row["index"]}.{args.image_format}'
+
+    @torch.no_grad()
+    def sample_batch(rows, H: int, W: int, steps: int, desc: str):
+        cond = encode_text([row['prompt'] for row in rows], H, W)
+        uncond = encode_text([row['negative'] for row in rows], H, W)
+        generator = SampleGenerator.from_seeds([row['seed'] for row in rows], device)
+        init_noise = generator.randn((4, H // 8, W // 8))
+        guidance_scale = torch.tensor([row['cfg'] for row in rows], device=device)
+        bucket_diffuser = get_diffuser(steps)
+        with bucket_diffuser.use_generator(generator), accelerator.autocast():
+            samples = bucket_diffuser.sample(
+                model=model, init_noise=init_noise,
+                uncond_conditioning=uncond,
+                model_kwargs={bucket_diffuser.cond_kwarg: cond},
+                tqdm_kwargs=dict(desc=desc, disable=not accelerator.is_main_process),
+                guidance_scale=guidance_scale,
+            )
+            samples = model.decode_latent(samples).clamp(-1, 1)
+        for x, row in zip(samples.float().cpu(), rows):
+            filename = get_filename(row)
+            info = {k: v for k, v in row.items() if k != 'index'}
+            image_writer.save(
+                image_norm_to_float(x), os.path.join(args.save_dir, filename),
+                nrow=1, callback=partial(manifest.add, row['index'], filename, **info),
+            )
+
+    def sample():
+        rows = load_prompts(args.prompts, args)
+        logger.info(f'Loaded {len(rows)} prompts from {args.prompts}')
+        if args.skip_existing:
+            rows = [row for row in rows if row['index'] not in completed]
+            logger.info(f'{len(rows)} prompts remain after skipping completed images')
+        buckets = get_buckets(rows)
+        logger.info(f'Grouped into {len(buckets)} buckets by (height, width, steps)')
+        # rows of each bucket are distributed to processes in a round-robin fashion, and each process saves its own
+        # samples, so no communication is needed and processes never wait for each other
+        for bi, ((H, W, steps), bucket_rows) in enumerate(sorted(buckets.items())):
+            rank_rows = bucket_rows[accelerator.process_index::accelerator.num_processes]
+            logger.info(f'Bucket {bi}/{len(buckets)}: {len(bucket_rows)} rows, {H}x{W}, {steps} steps')
+            for i in range(0, len(rank_rows), args.batch_size):
+                sample_batch(
+                    rank_rows[i:i + args.batch_size], H, W, steps,
+                    desc=f'Bucket {bi}/{len(buckets)} batch {i // args.batch_size}',
+                )
+
+    # START SAMPLING
+    logger.info('Start sampling...')
+    os.makedirs(args.save_dir, exist_ok=True)
+    logger.info(f'Samples will be saved to {args.save_dir}')
+    completed = set()
+    if args.skip_existing:
+        # collect progress of the previous run, including the part files left by an interrupted run, before they
+        # are overwritten. Only images recorded in the manifest are trusted, since files of a killed run may be
+        # partially written
+        if accelerator.is_main_process:
+            Manifest.merge(args.save_dir, include_existing=True)
+        accelerator.wait_for_everyone()
+        completed = {
+            record['index'] for record in Manifest.load(args.save_dir)
+            if os.path.isfile(os.path.join(args.save_dir, record['file']))
+        }
+    image_writer = ImageWriter(image_format=args.image_format)
+    manifest = Manifest(args.save_dir, rank=accelerator.process_index)
+    sample()
+    image_writer.close()
+    manifest.close()
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        n_records = Manifest.merge(args.save_dir, include_existing=args.skip_existing)
+        logger.info(f'Manifest of {n_records} samples is saved to {os.path.join(args.save_dir, "manifest.jsonl")}')
+    logger.info(f'Sampled images are saved to {args.save_dir}')
+    logger.info('End of sampling')
+
+
+if __name__ == '__main__':
+    main()
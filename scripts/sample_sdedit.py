@@ -11,12 +11,12 @@ import torch
 import accelerate
 import torchvision.transforms as T
 from torch.utils.data import DataLoader
-from torchvision.utils import save_image
 
 import diffusions
 from datasets import ImageDir
 from utils.logger import get_logger
 from utils.load import load_weights
+from utils.writer import ImageWriter, ArrayWriter
 from utils.misc import instantiate_from_config
 
 
@@ -58,6 +58,14 @@ def get_parser():
         '--save_dir', type=str, required=True,
         help='Path to the directory to save samples',
     )
+    parser.add_argument(
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
     parser.add_argument(
         '--batch_size', type=int, default=32,
         help='Batch size on each process',
@@ -135,6 +143,7 @@ def main():
         dataloader = DataLoader(dataset=dataset, batch_size=bspp, num_workers=4, pin_memory=True, prefetch_factor=2)
         dataloader = accelerator.prepare(dataloader)  # type: ignore
         logger.info(f'Found {len(dataset)} images in {args.input_dir}')
+        array_writer = ArrayWriter(args.save_dir, len(dataset)) if args.output_format == 'npy' else None
         # sampling
         idx = 0
         assert 0 <= args.edit_steps < len(diffuser.respaced_seq)
@@ -159,19 +168,27 @@ def main():
             img = accelerator.gather_for_metrics(img)
             noised_img = accelerator.gather_for_metrics(noised_img)
             edited_img = accelerator.gather_for_metrics(edited_img)
-            if accelerator.is_main_process:
-                for im, nim, eim in zip(img, noised_img, edited_img):
-                    save_image(
+            if accelerator.is_main_process and array_writer is not None:
+                samples = torch.stack([img, noised_img, edited_img], dim=1).clamp(-1, 1)
+                array_writer.write(range(idx, idx + len(img)), samples)
+                idx += len(img)
+            elif accelerator.is_main_process:
+                for im, nim, eim in zip(img.cpu(), noised_img.cpu(), edited_img.cpu()):
+                    image_writer.save(
                         [im, nim, eim], os.path.join(args.save_dir, f'{idx}.png'),
                         nrow=3, normalize=True, value_range=(-1, 1),
                     )
                     idx += 1
+        if array_writer is not None:
+            array_writer.close()
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    image_writer = ImageWriter(image_format=args.image_format)
     sample()
+    image_writer.close()
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
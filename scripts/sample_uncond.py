@@ -2,21 +2,26 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import json
 import math
 import argparse
+from functools import partial
 from omegaconf import OmegaConf
 
 import torch
 import accelerate
 import torchvision.transforms as T
-from torchvision.utils import save_image
 from torch.utils.data import DataLoader, Subset
 
 import diffusions
 from datasets import ImageDir
 from utils.logger import get_logger
-from utils.load import load_weights
-from utils.misc import image_norm_to_float, instantiate_from_config, amortize
+from utils.load import load_weights, get_weights_fingerprint
+from utils.writer import ImageWriter, ArrayWriter, Manifest, get_shard_indices
+from utils.evaluate import Evaluator, build_feature_extractor, load_stats, get_ref_stats
+from utils.autotune import parse_batch_size, autotune_batch_size, make_sample_probe
+from utils.misc import image_norm_to_float, instantiate_from_config, amortize, SampleGenerator
+from models.modules import fuse_norm_act
 
 
 COMPATIBLE_SAMPLER_MODE = dict(
@@ -50,8 +55,60 @@ def get_parser():
         help='Path to directory saving samples',
     )
     parser.add_argument(
-        '--batch_size', type=int, default=500,
-        help='Batch size on each process',
+        '--image_format', type=str, default='png', choices=['png', 'jpg', 'webp'],
+        help='Format of saved images',
+    )
+    parser.add_argument(
+        '--output_format', type=str, default='image', choices=['image', 'npy'],
+        help='Save samples as individual images, or into a memory-mapped uint8 array `samples.npy` in save_dir',
+    )
+    parser.add_argument(
+        '--sharded_output', action='store_true', default=False,
+        help='Each process saves its own samples instead of gathering them to the main process. '
+             'Not supported in reconstruction mode',
+    )
+    parser.add_argument(
+        '--resumable', action='store_true', default=False,
+        help='Seed the noise of each sample by its global index and record the progress in save_dir, '
+             'so that an interrupted job can be resumed by running the same command. Only supported in sample mode',
+    )
+    parser.add_argument(
+        '--batch_size', type=parse_batch_size, default=500,
+        help='Batch size on each process. Use `auto` to find the throughput-optimal batch size that fits in memory',
+    )
+    parser.add_argument(
+        '--channels_last', action='store_true', default=False,
+        help='Convert the model to channels_last memory format',
+    )
+    parser.add_argument(
+        '--fuse_norm_act', action='store_true', default=False,
+        help='Fuse GroupNorm and SiLU layers of the model',
+    )
+    # arguments for evaluation
+    parser.add_argument(
+        '--eval', action='store_true', default=False,
+        help='Evaluate samples on the fly. Images are not saved unless --save_images is set',
+    )
+    parser.add_argument(
+        '--metrics', type=str, nargs='+', default=['fid', 'is'], choices=['fid', 'is', 'pr'],
+        help='Metrics to evaluate, pr stands for precision / recall',
+    )
+    parser.add_argument(
+        '--feature_extractor', type=str, default='inception',
+        help='Feature extractor for evaluation. Could be `inception`, `tiny` or import path of a custom class',
+    )
+    parser.add_argument(
+        '--ref_stats', type=str, default=None,
+        help='Path to reference statistics (npz file containing mu, sigma and optionally features). '
+             'If not provided, will load or compute the cached statistics of the dataset in the config',
+    )
+    parser.add_argument(
+        '--ref_split', type=str, default='train',
+        help='Split of the dataset used as reference when --ref_stats is not provided',
+    )
+    parser.add_argument(
+        '--save_images', action='store_true', default=False,
+        help='Save images when --eval is set',
     )
     # arguments for all diffusers
     parser.add_argument(
@@ -104,6 +161,10 @@ def get_parser():
         '--input_dir', type=str, required=False,
         help='Path to the directory containing input images',
     )
+    parser.add_argument(
+        '--noise_cache_dir', type=str, default=None,
+        help='Path to directory caching the noise inverted from input images',
+    )
     return parser
 
 
@@ -169,30 +230,134 @@ def main():
     logger.info(f'Successfully load model from {args.weights}')
     logger.info('=' * 50)
 
+    # OPTIMIZE MODEL
+    if args.fuse_norm_act:
+        fuse_norm_act(model)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
+
     # PREPARE FOR DISTRIBUTED MODE AND MIXED PRECISION
     model = accelerator.prepare(model)
     model.eval()
 
+    # TUNE BATCH SIZE
+    if args.batch_size == 'auto':
+        img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
+        probe_fn = make_sample_probe(
+            model=accelerator.unwrap_model(model), img_shape=img_shape, device=device,
+            total_steps=conf.diffusion.params.total_steps, n_forward=1,
+        )
+        batch_size = autotune_batch_size(
+            fn=probe_fn, device=device,
+            max_batch_size=math.ceil(args.n_samples / accelerator.num_processes),
+            key=dict(
+                task='sample', sampler=args.sampler, model=OmegaConf.to_container(conf.model),
+                img_shape=img_shape, mixed_precision=str(accelerator.mixed_precision),
+                channels_last=args.channels_last, fuse_norm_act=args.fuse_norm_act,
+            ),
+            write_cache=accelerator.is_main_process, logger=logger,
+        )
+        # use the same batch size on all processes
+        args.batch_size = int(accelerator.gather(torch.tensor([batch_size], device=device)).min().item())
+        logger.info(f'Batch size per process: {args.batch_size}')
+
+    # BUILD EVALUATOR
+    evaluator = None
+    if args.eval:
+        extractor = build_feature_extractor(args.feature_extractor).to(device)
+        if args.ref_stats is not None:
+            ref_stats = load_stats(args.ref_stats)
+        else:
+            ref_kwargs = dict(
+                data_conf=conf.data, extractor=extractor, split=args.ref_split,
+                keep_features='pr' in args.metrics, device=device,
+            )
+            # compute on the main process, then load the cache on other processes
+            if accelerator.is_main_process:
+                get_ref_stats(**ref_kwargs, logger=logger)
+            accelerator.wait_for_everyone()
+            ref_stats = get_ref_stats(**ref_kwargs)
+        evaluator = Evaluator(extractor, metrics=args.metrics, ref_stats=ref_stats)
+        logger.info(f'Evaluate {args.metrics} with feature extractor {extractor.name}')
+    save_images = not args.eval or args.save_images
+
     accelerator.wait_for_everyone()
 
+    def save_fold(samples: torch.Tensor, fold_indices, bspp: int, nrow: int = 1, gathered: bool = False):
+        # fold_indices are the global indices of samples in this fold, in the order of accelerator.gather()
+        # samples are already gathered to the main process if `gathered` is True
+        bs = len(fold_indices)
+        if args.sharded_output:
+            positions = get_shard_indices(0, bs, bspp, accelerator.process_index)
+            indices = [fold_indices[p] for p in positions]
+            samples = samples[:len(indices)]
+        else:
+            if not gathered:
+                samples = accelerator.gather(samples)[:bs]
+            indices = fold_indices
+            if not accelerator.is_main_process:
+                return
+        if array_writer is not None:
+            seeds = [SampleGenerator.get_seed(args.seed, index) for index in indices] if args.resumable else None
+            array_writer.write(indices, samples, seeds=seeds)
+            if manifest is not None:
+                # record the rows only after they are flushed to disk, so that a resumed job never trusts rows
+                # that were not written
+                array_writer.flush()
+                for index in indices:
+                    manifest.add(index, 'samples.npy')
+            return
+        for x, index in zip(samples.cpu(), indices):
+            filename = f'{index}.{args.image_format}'
+            callback = None if manifest is None else partial(manifest.add, index, filename)
+            image_writer.save(
+                image_norm_to_float(x), os.path.join(args.save_dir, filename),
+                nrow=nrow, callback=callback,
+            )
+
     @torch.no_grad()
     def sample():
-        idx = 0
         img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
-        bspp = min(args.batch_size, math.ceil(args.n_samples / accelerator.num_processes))
-        folds = amortize(args.n_samples, bspp * accelerator.num_processes)
+        indices = [index for index in range(args.n_samples) if index not in completed]
+        if len(indices) < args.n_samples:
+            logger.info(f'Skip {args.n_samples - len(indices)} completed samples')
+        if len(indices) == 0:
+            return
+        bspp = min(args.batch_size, math.ceil(len(indices) / accelerator.num_processes))
+        folds = amortize(len(indices), bspp * accelerator.num_processes)
+        offset = 0
         for i, bs in enumerate(folds):
-            init_noise = torch.randn((bspp, *img_shape), device=device)
-            samples = diffuser.sample(
-                model=accelerator.unwrap_model(model), init_noise=init_noise,
-                tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process),
-            ).clamp(-1, 1)
-            samples = accelerator.gather(samples)[:bs]
-            if accelerator.is_main_process:
-                for x in samples:
-                    x = image_norm_to_float(x).cpu()
-                    save_image(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=1)
-                    idx += 1
+            fold_indices = indices[offset:offset + bs]
+            offset += bs
+            generator = None
+            if args.resumable:
+                # pad the last fold with the last index, padded samples are discarded
+                start = accelerator.process_index * bspp
+                rank_indices = [fold_indices[min(p, bs - 1)] for p in range(start, start + bspp)]
+                generator = SampleGenerator(args.seed, rank_indices, device)
+                init_noise = generator.randn(img_shape)
+            else:
+                init_noise = torch.randn((bspp, *img_shape), device=device)
+            with diffuser.use_generator(generator):
+                samples = diffuser.sample(
+                    model=accelerator.unwrap_model(model), init_noise=init_noise,
+                    tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process),
+                ).clamp(-1, 1)
+            if evaluator is not None:
+                outputs = evaluator.extract(samples)
+                outputs = {k: accelerator.gather(v)[:bs] for k, v in outputs.items()}
+                if accelerator.is_main_process:
+                    evaluator.update_features(outputs)
+            if save_images:
+                save_fold(samples, fold_indices, bspp)
+
+    def gather_snapshot(x: torch.Tensor, bs: int):
+        # gather each snapshot of the trajectory to the main process, so that the whole trajectory is never on GPU
+        x = x.clamp(-1, 1)
+        if args.sharded_output:
+            return x
+        x = accelerator.gather(x)[:bs]
+        return x if accelerator.is_main_process else None
 
     @torch.no_grad()
     def sample_denoise():
@@ -207,17 +372,14 @@ def main():
                 model=accelerator.unwrap_model(model), init_noise=init_noise,
                 tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process),
             )
-            samples = [
-                out['sample'] for timestep, out in enumerate(sample_loop)
-                if (len(diffuser.respaced_seq) - timestep - 1) % freq == 0
-            ]
-            samples = torch.stack(samples, dim=1).clamp(-1, 1)
-            samples = accelerator.gather(samples)[:bs]
-            if accelerator.is_main_process:
-                for x in samples:
-                    x = image_norm_to_float(x).cpu()
-                    save_image(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=len(x))
-                    idx += 1
+            recorder = diffusions.TrajectoryRecorder(
+                key='sample',
+                predicate=lambda timestep, out: (len(diffuser.respaced_seq) - timestep - 1) % freq == 0,
+                transform=partial(gather_snapshot, bs=bs),
+            )
+            samples = recorder.run(sample_loop)
+            save_fold(samples, range(idx, idx + bs), bspp, nrow=recorder.n_snapshots, gathered=not args.sharded_output)
+            idx += bs
 
     @torch.no_grad()
     def sample_progressive():
@@ -232,48 +394,55 @@ def main():
                 model=accelerator.unwrap_model(model), init_noise=init_noise,
                 tqdm_kwargs=dict(desc=f'Fold {i}/{len(folds)}', disable=not accelerator.is_main_process),
             )
-            samples = [
-                out['pred_x0'] for timestep, out in enumerate(sample_loop)
-                if (len(diffuser.respaced_seq) - timestep - 1) % freq == 0
-            ]
-            samples = torch.stack(samples, dim=1).clamp(-1, 1)
-            samples = accelerator.gather(samples)[:bs]
-            if accelerator.is_main_process:
-                for x in samples:
-                    x = image_norm_to_float(x).cpu()
-                    save_image(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=len(x))
-                    idx += 1
+            recorder = diffusions.TrajectoryRecorder(
+                key='pred_x0',
+                predicate=lambda timestep, out: (len(diffuser.respaced_seq) - timestep - 1) % freq == 0,
+                transform=partial(gather_snapshot, bs=bs),
+            )
+            samples = recorder.run(sample_loop)
+            save_fold(samples, range(idx, idx + bs), bspp, nrow=recorder.n_snapshots, gathered=not args.sharded_output)
+            idx += bs
 
     @torch.no_grad()
     def sample_interpolate():
         idx = 0
         img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
-        bspp = min(args.batch_size, math.ceil(args.n_samples / accelerator.num_processes))
+        # each fold samples the whole interpolation grid of bspp pairs, i.e., bspp * n_interpolate images
+        bspp = max(1, args.batch_size // args.n_interpolate)
+        bspp = min(bspp, math.ceil(args.n_samples / accelerator.num_processes))
 
         def slerp(t, z1, z2):  # noqa
-            theta = torch.acos(torch.sum(z1 * z2) / (torch.linalg.norm(z1) * torch.linalg.norm(z2)))
-            return torch.sin((1 - t) * theta) / torch.sin(theta) * z1 + torch.sin(t * theta) / torch.sin(theta) * z2
+            """Spherical interpolation between each pair in z1 and z2 of shape [B, ...] at t of shape [T], returns a
+            Tensor of shape [B, T, ...]. """
+            flat1, flat2 = z1.flatten(1), z2.flatten(1)
+            cos = torch.sum(flat1 * flat2, dim=1) / (torch.linalg.norm(flat1, dim=1) * torch.linalg.norm(flat2, dim=1))
+            theta = torch.acos(cos.clamp(-1, 1))[:, None]
+            w1 = torch.sin((1 - t[None, :]) * theta) / torch.sin(theta)
+            w2 = torch.sin(t[None, :] * theta) / torch.sin(theta)
+            out = w1[:, :, None] * flat1[:, None, :] + w2[:, :, None] * flat2[:, None, :]
+            return out.reshape(z1.shape[0], t.shape[0], *z1.shape[1:])
 
+        ts = torch.linspace(0, 1, args.n_interpolate, device=device)
         folds = amortize(args.n_samples, bspp * accelerator.num_processes)
         for i, bs in enumerate(folds):
             z1 = torch.randn((bspp, *img_shape), device=device)
             z2 = torch.randn((bspp, *img_shape), device=device)
-            samples = torch.stack([
+            init_noise = slerp(ts, z1, z2).flatten(0, 1)
+            # a grid larger than the batch size (i.e., n_interpolate > batch_size) is sampled in chunks
+            chunks = init_noise.split(args.batch_size)
+            samples = torch.cat([
                 diffuser.sample(
-                    model=accelerator.unwrap_model(model), init_noise=slerp(t, z1, z2),
+                    model=accelerator.unwrap_model(model), init_noise=chunk,
                     tqdm_kwargs=dict(
-                        desc=f'Fold {i}/{len(folds)}, interp {j}/{args.n_interpolate}',
+                        desc=f'Fold {i}/{len(folds)}' + (f', chunk {j}/{len(chunks)}' if len(chunks) > 1 else ''),
                         disable=not accelerator.is_main_process,
                     ),
                 ).clamp(-1, 1)
-                for j, t in enumerate(torch.linspace(0, 1, args.n_interpolate))
-            ], dim=1)
-            samples = accelerator.gather(samples)[:bs]
-            if accelerator.is_main_process:
-                for x in samples:
-                    x = image_norm_to_float(x).cpu()
-                    save_image(x, os.path.join(args.save_dir, f'{idx}.png'), nrow=len(x))
-                    idx += 1
+                for j, chunk in enumerate(chunks)
+            ], dim=0)
+            samples = samples.reshape(bspp, args.n_interpolate, *img_shape)
+            save_fold(samples, range(idx, idx + bs), bspp, nrow=samples.shape[1])
+            idx += bs
 
     @torch.no_grad()
     def sample_reconstruction():
@@ -290,31 +459,72 @@ def main():
         bspp = min(args.batch_size, math.ceil(len(dataset) / accelerator.num_processes))
         dataloader = DataLoader(dataset=dataset, batch_size=bspp, num_workers=4, pin_memory=True, prefetch_factor=2)
         dataloader = accelerator.prepare(dataloader)  # type: ignore
+        rec_writer = None
+        if args.output_format == 'npy':
+            rec_writer = ArrayWriter(args.save_dir, len(dataset))
+        # build pipeline, where inversion of the next batch is batched with generation of the current batch
+        noise_cache = None
+        if args.noise_cache_dir is not None:
+            noise_cache = diffusions.NoiseCache(args.noise_cache_dir, namespace=dict(
+                weights=get_weights_fingerprint(args.weights), model=OmegaConf.to_container(conf.model),
+                respaced_seq=diffuser.respaced_seq.tolist(), mixed_precision=str(accelerator.mixed_precision),
+            ))
+        pipeline = diffusions.InversionPipeline(diffuser, accelerator.unwrap_model(model), noise_cache)
+        items = (
+            dict(img=X[0].float() if isinstance(X, (tuple, list)) else X.float())
+            for X in dataloader
+        )
         # sampling
         idx = 0
-        for i, X in enumerate(dataloader):
-            X = X[0].float() if isinstance(X, (tuple, list)) else X.float()
-            noise = diffuser.sample_inversion(
-                model=accelerator.unwrap_model(model), img=X,
-                tqdm_kwargs=dict(desc=f'img2noise {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
-            )
-            recX = diffuser.sample(
-                model=accelerator.unwrap_model(model), init_noise=noise,
-                tqdm_kwargs=dict(desc=f'noise2img {i}/{len(dataloader)}', disable=not accelerator.is_main_process),
-            )
-            X = accelerator.gather_for_metrics(X)
-            recX = accelerator.gather_for_metrics(recX)
-            if accelerator.is_main_process:
-                for x, r in zip(X, recX):
-                    x = image_norm_to_float(x).cpu()
-                    r = image_norm_to_float(r).cpu()
-                    save_image([x, r], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
+        for item, _, recX in pipeline.run(
+                items, tqdm_kwargs=dict(desc='img2noise2img', disable=not accelerator.is_main_process),
+        ):
+            # gather_for_metrics() cannot be used because the pipeline lags behind the dataloader, so drop the
+            # samples duplicated by the dataloader to even out the last batch manually
+            X = accelerator.gather(item['img'])[:len(dataset) - idx]
+            recX = accelerator.gather(recX)[:len(dataset) - idx]
+            if accelerator.is_main_process and rec_writer is not None:
+                rec_writer.write(range(idx, idx + len(X)), torch.stack([X, recX.clamp(-1, 1)], dim=1))
+                idx += len(X)
+            elif accelerator.is_main_process:
+                for x, r in zip(X.cpu(), recX.cpu()):
+                    x = image_norm_to_float(x)
+                    r = image_norm_to_float(r)
+                    image_writer.save([x, r], os.path.join(args.save_dir, f'{idx}.png'), nrow=2)
                     idx += 1
+        if rec_writer is not None:
+            rec_writer.close()
 
     # START SAMPLING
     logger.info('Start sampling...')
     os.makedirs(args.save_dir, exist_ok=True)
     logger.info(f'Samples will be saved to {args.save_dir}')
+    if args.sharded_output and args.mode == 'reconstruction':
+        raise ValueError('Sharded output is not supported in `reconstruction` mode')
+    if args.resumable and (args.mode != 'sample' or args.eval):
+        raise ValueError('Resumable sampling is only supported in `sample` mode without evaluation')
+    completed = set()
+    if args.resumable:
+        # collect progress of the previous run
+        if accelerator.is_main_process:
+            Manifest.merge(args.save_dir, include_existing=True)
+        accelerator.wait_for_everyone()
+        completed = {
+            record['index'] for record in Manifest.load(args.save_dir)
+            if os.path.isfile(os.path.join(args.save_dir, record['file']))
+        }
+    image_writer = ImageWriter(image_format=args.image_format)
+    manifest = None
+    if args.sharded_output or args.resumable:
+        manifest = Manifest(args.save_dir, rank=accelerator.process_index)
+    array_writer = None
+    if args.output_format == 'npy' and args.mode != 'reconstruction':
+        array_writer = ArrayWriter(
+            args.save_dir, args.n_samples,
+            with_seeds=args.resumable, exist_ok=args.resumable,
+            is_main_process=accelerator.is_main_process,
+            sync_fn=accelerator.wait_for_everyone if args.sharded_output else None,
+        )
     compatible_mode = COMPATIBLE_SAMPLER_MODE[args.sampler]
     if args.mode not in compatible_mode:
         logger.warning(
@@ -322,6 +532,9 @@ def main():
             f'unexpected behavior may occur.'
         )
 
+    if args.eval and args.mode != 'sample':
+        raise ValueError(f'Evaluation is only supported in `sample` mode, got {args.mode}')
+
     if args.mode == 'sample':
         sample()
     elif args.mode == 'denoise':
@@ -336,6 +549,22 @@ def main():
         sample_reconstruction()
     else:
         raise ValueError(f'Unknown mode: {args.mode}')
+    if evaluator is not None and accelerator.is_main_process:
+        results = evaluator.compute()
+        for k, v in results.items():
+            logger.info(f'{k}: {v:.4f}')
+        with open(os.path.join(args.save_dir, 'metrics.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f'Metrics are saved to {os.path.join(args.save_dir, "metrics.json")}')
+    image_writer.close()
+    if array_writer is not None:
+        array_writer.close()
+    if manifest is not None:
+        manifest.close()
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            n_records = Manifest.merge(args.save_dir, include_existing=args.resumable)
+            logger.info(f'Manifest of {n_records} samples is saved to {os.path.join(args.save_dir, "manifest.jsonl")}')
     logger.info(f'Sampled images are saved to {args.save_dir}')
     logger.info('End of sampling')
 
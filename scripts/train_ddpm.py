@@ -4,6 +4,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import math
 import argparse
+from functools import partial
 from omegaconf import OmegaConf
 from contextlib import nullcontext
 
@@ -13,7 +14,11 @@ from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
 from models import EMA
+from diffusions.timestep_sampler import UniformSampler, LossHistogram
+from models.modules import fuse_norm_act
 from utils.logger import StatusTracker, get_logger
+from utils.profiler import StepProfiler
+from utils.autotune import autotune_batch_size, make_train_probe, params_size_mb
 from utils.misc import create_exp_dir, find_resume_checkpoint, instantiate_from_config
 from utils.misc import get_time_str, check_freq, amortize, get_data_generator, AverageMeter
 
@@ -114,8 +119,23 @@ def main():
     # BUILD DIFFUSER
     diffuser = instantiate_from_config(conf.diffusion, device=device)
 
+    # BUILD TIMESTEP SAMPLER
+    if conf.train.get('timestep_sampler', None) is not None:
+        timestep_sampler = instantiate_from_config(
+            conf.train.timestep_sampler, alphas_cumprod=diffuser.alphas_cumprod,
+        )
+    else:
+        timestep_sampler = UniformSampler(diffuser.alphas_cumprod)
+    loss_histogram = LossHistogram(conf.diffusion.params.total_steps, device=device)
+    logger.info(f'Timestep sampler: {type(timestep_sampler).__name__}')
+    logger.info(f'Loss weighting: {diffuser.loss_weighting}')
+
     # BUILD MODEL AND OPTIMIZERS
     model = instantiate_from_config(conf.model)
+    if conf.train.get('fuse_norm_act', False):
+        fuse_norm_act(model)
+    if conf.train.get('channels_last', False):
+        model.to(memory_format=torch.channels_last)
     ema = EMA(model.parameters(), decay=conf.train.ema_decay, gradual=conf.train.ema_gradual)
     optimizer = instantiate_from_config(conf.train.optim, params=model.parameters())
     step = 0
@@ -137,6 +157,8 @@ def main():
         # load meta information
         ckpt_meta = torch.load(os.path.join(ckpt_path, 'meta.pt'), map_location='cpu')
         step = ckpt_meta['step'] + 1
+        if 'timestep_sampler' in ckpt_meta and hasattr(timestep_sampler, 'load_state_dict'):
+            timestep_sampler.load_state_dict(ckpt_meta['timestep_sampler'])
 
     @accelerator.on_main_process
     def save_ckpt(save_path: str):
@@ -153,7 +175,10 @@ def main():
         # save optimizer
         accelerator.save(dict(optimizer=optimizer.state_dict()), os.path.join(save_path, 'optimizer.pt'))
         # save meta information
-        accelerator.save(dict(step=step), os.path.join(save_path, 'meta.pt'))
+        meta = dict(step=step)
+        if hasattr(timestep_sampler, 'state_dict'):
+            meta['timestep_sampler'] = timestep_sampler.state_dict()
+        accelerator.save(meta, os.path.join(save_path, 'meta.pt'))
 
     # RESUME TRAINING
     if args.resume is not None:
@@ -166,6 +191,31 @@ def main():
     model, optimizer, train_loader = accelerator.prepare(model, optimizer, train_loader)  # type: ignore
     ema.to(device)
 
+    # TUNE MICRO BATCH SIZE
+    if micro_batch == 'auto':
+        img_shape = (conf.data.img_channels, conf.data.params.img_size, conf.data.params.img_size)
+        probe_fn = make_train_probe(
+            model=accelerator.unwrap_model(model), diffuser=diffuser, img_shape=img_shape, device=device,
+        )
+        micro_batch = autotune_batch_size(
+            fn=probe_fn, device=device, max_batch_size=batch_size_per_process,
+            key=dict(
+                task='train', model=OmegaConf.to_container(conf.model), img_shape=img_shape,
+                mixed_precision=str(accelerator.mixed_precision),
+                channels_last=conf.train.get('channels_last', False),
+                fuse_norm_act=conf.train.get('fuse_norm_act', False),
+            ),
+            # states of Adam-like optimizers are allocated at the first step, after probing
+            reserved_mb=2 * params_size_mb(model),
+            write_cache=accelerator.is_main_process, logger=logger,
+        )
+        # use the same micro batch size on all processes
+        micro_batch = int(accelerator.gather(torch.tensor([micro_batch], device=device)).min().item())
+        logger.info(f'Micro batch size: {micro_batch}')
+
+    # INITIALIZE PROFILER
+    profiler = StepProfiler(enabled=conf.train.get('profile', False), device=device)
+
     accelerator.wait_for_everyone()
 
     def run_step(_batch):
@@ -173,19 +223,37 @@ def main():
         _batch = _batch[0] if isinstance(_batch, (tuple, list)) else _batch
         batch_size = _batch.shape[0]
         loss_meter = AverageMeter()
+        all_t, all_losses = [], []
         for i in range(0, batch_size, micro_batch):
             X = _batch[i:i+micro_batch].float()
-            t = torch.randint(conf.diffusion.params.total_steps, (X.shape[0], ), device=device).long()
+            t, weights = timestep_sampler.sample(X.shape[0], device=device)
             loss_scale = X.shape[0] / batch_size
             no_sync = (i + micro_batch) < batch_size
             cm = accelerator.no_sync(model) if no_sync else nullcontext()
             with cm:
-                loss = diffuser.loss_func(model, x0=X, t=t)
-                accelerator.backward(loss * loss_scale)
+                with profiler.phase('fwd'):
+                    losses = diffuser.loss_func(model, x0=X, t=t, reduction='none')
+                    loss = (losses * weights).mean()
+                # gradients are all-reduced over processes in the backward pass of the last micro batch, overlapped
+                # with computation, so it is timed separately to expose the communication cost
+                with profiler.phase('bwd' if no_sync else 'bwd_sync'):
+                    accelerator.backward(loss * loss_scale)
             loss_meter.update(loss.item(), X.shape[0])
-        accelerator.clip_grad_norm_(model.parameters(), max_norm=conf.train.clip_grad_norm)
-        optimizer.step()
-        ema.update(model.parameters())
+            all_t.append(t)
+            all_losses.append(losses.detach())
+        # the loss histogram accumulates local losses on device, and is reduced over processes only when logging
+        all_t, all_losses = torch.cat(all_t), torch.cat(all_losses).float()
+        loss_histogram.update(all_t, all_losses)
+        # update timestep sampler with losses from all processes, only if it uses them
+        if timestep_sampler.requires_losses:
+            with profiler.phase('sync'):
+                all_t = accelerator.gather(all_t)
+                all_losses = accelerator.gather(all_losses)
+            timestep_sampler.update(all_t, all_losses)
+        with profiler.phase('optim_ema'):
+            accelerator.clip_grad_norm_(model.parameters(), max_norm=conf.train.clip_grad_norm)
+            optimizer.step()
+            ema.update(model.parameters())
         return dict(
             loss=loss_meter.avg,
             lr=optimizer.param_groups[0]['lr'],
@@ -224,12 +292,20 @@ def main():
     )
     while step < conf.train.n_steps:
         # get a batch of data
-        batch = next(train_data_generator)
+        with profiler.phase('data', host=True):
+            batch = next(train_data_generator)
         # run a step
         model.train()
         train_status = run_step(batch)
         status_tracker.track_status('Train', train_status, step)
-        accelerator.wait_for_everyone()
+        if check_freq(conf.train.print_freq, step):
+            loss_t = loss_histogram.summary(reduce_fn=partial(accelerator.reduce, reduction='sum'))
+            status_tracker.track_status('Train/loss_t', loss_t, step)
+        with profiler.phase('sync'):
+            accelerator.wait_for_everyone()
+        profiler.step(conf.train.batch_size)
+        if profiler.enabled and check_freq(conf.train.print_freq, step):
+            status_tracker.track_status('Perf', profiler.summary(), step)
 
         model.eval()
         # save checkpoint
@@ -43,7 +43,7 @@ def build_model(conf_model, weights_path):
 
 
 @st.cache_resource
-def build_diffuser(conf_diffusion, sampler, device, var_type, respace_type, respace_steps, cfg_scale):
+def build_diffuser(conf_diffusion, sampler, device, var_type, respace_type, respace_steps):
     if sampler == "DDPM":
         conf_diffusion["target"] = "diffusions.DDPMCFG"
     elif sampler == "DDIM":
@@ -53,7 +53,6 @@ def build_diffuser(conf_diffusion, sampler, device, var_type, respace_type, resp
         var_type=var_type or conf_diffusion["params"].get("var_type", None),
         respace_type=None if respace_steps is None else respace_type,
         respace_steps=respace_steps,
-        guidance_scale=cfg_scale,
         cond_kwarg="y",
         device=device,
     )
@@ -73,7 +72,7 @@ def main(
 
     # BUILD DIFFUSER
     conf_diffusion = OmegaConf.to_container(conf.diffusion)
-    diffuser = build_diffuser(conf_diffusion, sampler, device, var_type, respace_type, respace_steps, cfg_scale)
+    diffuser = build_diffuser(conf_diffusion, sampler, device, var_type, respace_type, respace_steps)
 
     # BUILD MODEL & LOAD WEIGHTS
     conf_model = OmegaConf.to_container(conf.model)
@@ -98,6 +97,7 @@ def main(
                 model=model, init_noise=init_noise,
                 model_kwargs=dict(y=y),
                 tqdm_kwargs=dict(desc=f'Fold {i}/{batch_count}'),
+                guidance_scale=cfg_scale,
             )
             if is_latent:
                 samples = model.decode_latent(samples).clamp(-1, 1)
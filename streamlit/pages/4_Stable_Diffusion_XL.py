@@ -13,6 +13,7 @@ import streamlit as st
 
 from utils.load import load_weights
 from utils.misc import instantiate_from_config, image_norm_to_uint8
+from models.tome import apply_tome
 
 logpy = logging.getLogger("models.sdxl.attention")
 logpy.setLevel(logging.ERROR)
@@ -33,7 +34,7 @@ def build_model(conf_model, weights_path, low_vram=False):
 
 
 @st.cache_resource
-def build_diffuser(conf_diffusion, sampler, device, respace_type, respace_steps, cfg_scale):
+def build_diffuser(conf_diffusion, sampler, device, respace_type, respace_steps, cfg_interval, cfg_scaling):
     if sampler == "DDPM":
         conf_diffusion["target"] = "diffusions.DDPMCFG"
     elif sampler == "DDIM":
@@ -43,7 +44,8 @@ def build_diffuser(conf_diffusion, sampler, device, respace_type, respace_steps,
         cond_kwarg="condition_dict",
         respace_type=None if respace_steps is None else respace_type,
         respace_steps=respace_steps,
-        guidance_scale=cfg_scale,
+        guidance_interval=cfg_interval,
+        guidance_scaling=cfg_scaling,
         device=device,
     )
     return diffuser
@@ -51,7 +53,8 @@ def build_diffuser(conf_diffusion, sampler, device, respace_type, respace_steps,
 
 def main(
         st_components, conf, weights_path, seed, sampler, respace_type, respace_steps, offset_noise,
-        pos_prompt, neg_prompt, height, width, cfg_scale, batch_size, batch_count, low_vram,
+        pos_prompt, neg_prompt, height, width, cfg_scale, cfg_interval, cfg_scaling,
+        batch_size, batch_count, low_vram, tome_ratio,
 ):
     # SYSTEM SETUP
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -62,12 +65,15 @@ def main(
 
     # BUILD DIFFUSER
     conf_diffusion = OmegaConf.to_container(conf.diffusion)
-    diffuser = build_diffuser(conf_diffusion, sampler, device, respace_type, respace_steps, cfg_scale)
+    diffuser = build_diffuser(
+        conf_diffusion, sampler, device, respace_type, respace_steps, cfg_interval, cfg_scaling,
+    )
 
     # BUILD MODEL & LOAD WEIGHTS
     conf_model = OmegaConf.to_container(conf.model)
     model = build_model(conf_model, weights_path, low_vram)
     model.to(device).eval()
+    apply_tome(model, tome_ratio)
 
     # START SAMPLING
     start_time = time.time()
@@ -88,6 +94,7 @@ def main(
                 uncond_conditioning=uncond_dict,
                 model_kwargs=dict(condition_dict=cond_dict),
                 tqdm_kwargs=dict(desc=f'Fold {i}/{batch_count}'),
+                guidance_scale=cfg_scale,
             )
             samples = model.decode_latent(samples).clamp(-1, 1)
             samples = image_norm_to_uint8(samples)
@@ -192,6 +199,12 @@ def streamlit():
         with expander_advanced_options:
             respace_type = st.selectbox("Respace type", options=["uniform-linspace", "uniform-leading", "uniform-trailing"])
             offset_noise = st.slider("Offset noise", min_value=0.0, max_value=0.1, value=0.0, step=0.01)
+            cfg_interval = st.slider(
+                "CFG interval (normalized timesteps)", min_value=0.0, max_value=1.0, value=(0.0, 1.0), step=0.05,
+                help="Guidance is applied only in this range of t / T. Outside it, the unconditional pass is skipped.",
+            )
+            cfg_scaling = st.selectbox("CFG scaling", options=["constant", "linear", "power-cos"])
+            tome_ratio = st.slider("Token merging ratio", min_value=0.0, max_value=0.75, value=0.0, step=0.05)
             low_vram = st.checkbox("Low vram")
 
     # GENERATE IMAGES
@@ -215,9 +228,12 @@ def streamlit():
             height=height,
             width=width,
             cfg_scale=cfg_scale,
+            cfg_interval=cfg_interval,
+            cfg_scaling=cfg_scaling,
             batch_size=batch_size,
             batch_count=batch_count,
             low_vram=low_vram,
+            tome_ratio=tome_ratio,
         )
 
 
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import hashlib
+import platform
+from typing import Callable, Dict
+
+import torch
+import torch.nn as nn
+
+
+def hardware_fingerprint(device: torch.device):
+    """Describe the hardware and software that affect the memory usage and speed of a model."""
+    device = torch.device(device)
+    fingerprint = dict(device_type=device.type, torch=torch.__version__)
+    if device.type == 'cuda':
+        props = torch.cuda.get_device_properties(device)
+        fingerprint.update(
+            name=props.name, total_memory=props.total_memory,
+            capability=f'{props.major}.{props.minor}', cuda=torch.version.cuda,
+        )
+    else:
+        fingerprint.update(name=platform.processor() or platform.machine(), cpu_count=os.cpu_count())
+    return fingerprint
+
+
+def parse_batch_size(s: str):
+    """Argument type of batch size, either a positive integer or `auto`."""
+    if s == 'auto':
+        return s
+    if not s.isdigit() or int(s) <= 0:
+        raise ValueError(f'Invalid batch size: {s}')
+    return int(s)
+
+
+def is_oom_error(e: BaseException):
+    if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def probe_batch_sizes(
+        fn: Callable[[int], None],
+        device: torch.device,
+        max_batch_size: int,
+        min_batch_size: int = 1,
+        mem_fraction: float = 0.9,
+        reserved_mb: float = 0.,
+        n_warmup: int = 1,
+        n_iters: int = 3,
+        tolerance: float = 0.02,
+        logger=None,
+):
+    """Find the throughput-optimal batch size under a memory limit.
+
+    `fn(bs)` is called at batch sizes doubling from `min_batch_size` to `max_batch_size`, and the probing stops at
+    the first batch size that runs out of memory or whose peak memory exceeds `mem_fraction` of the device memory.
+    Among the batch sizes that fit, the smallest one whose throughput is within `tolerance` of the best is chosen,
+    because larger batches beyond the saturation point only cost memory. Memory is only checked on CUDA devices.
+
+    Args:
+        fn: Function that runs one iteration (e.g., a denoising step or a training step) with batch size `bs`.
+        device: The device on which `fn` runs.
+        max_batch_size: Maximum batch size to probe.
+        min_batch_size: Minimum batch size to probe.
+        mem_fraction: Fraction of the device memory allowed to use. The rest is left as headroom for the
+         fragmentation of the caching allocator and tensors not created by `fn`.
+        reserved_mb: Memory (MB) that will be allocated later but not by `fn`, e.g., the optimizer states.
+        n_warmup: Number of warmup iterations for each batch size.
+        n_iters: Number of timed iterations for each batch size.
+        tolerance: Relative tolerance of throughput when choosing the batch size.
+        logger: Logger to print the probing results.
+
+    Returns:
+        A dict with the chosen `batch_size` and the results of all `probes`.
+
+    """
+    device = torch.device(device)
+    use_cuda = device.type == 'cuda'
+    mem_limit = torch.cuda.get_device_properties(device).total_memory * mem_fraction if use_cuda else None
+
+    candidates = []
+    bs = min_batch_size
+    while bs < max_batch_size:
+        candidates.append(bs)
+        bs *= 2
+    candidates.append(max_batch_size)
+
+    probes = []
+    for bs in candidates:
+        if use_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        oom = False
+        try:
+            for _ in range(n_warmup):
+                fn(bs)
+            _synchronize(device)
+            start = time.perf_counter()
+            for _ in range(n_iters):
+                fn(bs)
+            _synchronize(device)
+            elapsed = (time.perf_counter() - start) / n_iters
+        except Exception as e:  # noqa
+            if not is_oom_error(e):
+                raise
+            oom = True
+        # release the memory held by the exception outside the except clause
+        if oom:
+            if use_cuda:
+                torch.cuda.empty_cache()
+            if logger is not None:
+                logger.info(f'Batch size {bs}: out of memory')
+            break
+        peak_mem = torch.cuda.max_memory_allocated(device) if use_cuda else 0
+        probe = dict(batch_size=bs, img_per_sec=bs / elapsed, peak_mem_mb=peak_mem / 1024 ** 2)
+        if logger is not None:
+            logger.info(f'Batch size {bs}: {probe["img_per_sec"]:.2f} img/s, peak memory {probe["peak_mem_mb"]:.0f} MB')
+        if use_cuda and peak_mem + reserved_mb * 1024 ** 2 > mem_limit:
+            break
+        probes.append(probe)
+    if use_cuda:
+        torch.cuda.empty_cache()
+
+    if len(probes) == 0:
+        raise RuntimeError(f'Batch size {min_batch_size} does not fit in the memory of {device}')
+    best = max(p['img_per_sec'] for p in probes)
+    batch_size = min(p['batch_size'] for p in probes if p['img_per_sec'] >= (1 - tolerance) * best)
+    return dict(batch_size=batch_size, probes=probes)
+
+
+def autotune_batch_size(
+        fn: Callable[[int], None],
+        key: Dict,
+        device: torch.device,
+        max_batch_size: int,
+        cache_dir: str = os.path.join('cache', 'autotune'),
+        recompute: bool = False,
+        write_cache: bool = True,
+        logger=None,
+        **probe_kwargs,
+):
+    """Find the throughput-optimal batch size by `probe_batch_sizes()`, with a cache.
+
+    The results are cached in `{cache_dir}/batch_size.json`, keyed by `key` (which should identify everything that
+    affects the memory and speed, e.g., model config, resolution, dtype and sampler), the hardware fingerprint, and
+    the probing arguments.
+
+    Args:
+        fn: Function that runs one iteration with batch size `bs`.
+        key: A json-serializable dict identifying the workload.
+        device: The device on which `fn` runs.
+        max_batch_size: Maximum batch size to probe.
+        cache_dir: Path to the cache directory.
+        recompute: Probe again even if a cached result exists.
+        write_cache: Whether to write the result to the cache, e.g., only on the main process.
+        logger: Logger to print information.
+        probe_kwargs: Other arguments passed to `probe_batch_sizes()`.
+
+    """
+    full_key = dict(key=key, hardware=hardware_fingerprint(device), max_batch_size=max_batch_size, **probe_kwargs)
+    key_hash = hashlib.sha1(json.dumps(full_key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, 'batch_size.json')
+
+    def load_cache():
+        if not os.path.isfile(cache_path):
+            return dict()
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+
+    if not recompute:
+        cached = load_cache().get(key_hash)
+        if cached is not None:
+            if logger is not None:
+                logger.info(f'Load tuned batch size {cached["batch_size"]} from {cache_path}')
+            return cached['batch_size']
+
+    if logger is not None:
+        logger.info(f'Tuning batch size on {full_key["hardware"]["name"]}...')
+    result = probe_batch_sizes(fn, device, max_batch_size, logger=logger, **probe_kwargs)
+    if logger is not None:
+        logger.info(f'Tuned batch size: {result["batch_size"]}')
+
+    if write_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache = load_cache()
+        cache[key_hash] = dict(key=full_key, **result)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2, default=str)
+        os.replace(tmp_path, cache_path)
+    return result['batch_size']
+
+
+def make_sample_probe(
+        model: nn.Module,
+        img_shape,
+        device: torch.device,
+        total_steps: int = 1000,
+        n_forward: int = 1,
+        model_kwargs_fn: Callable[[int], Dict] = None,
+):
+    """Build a probe running one denoising step, i.e., `n_forward` model evaluations on a batch of noise.
+
+    Classifier-free guidance evaluates the conditional and unconditional branches one after another in the samplers
+    of this repo, so use `n_forward=2` for it: the cost per image doubles while the peak memory does not.
+
+    Args:
+        model: The model.
+        img_shape: Shape of a sample, e.g., (C, H, W).
+        device: The device on which the model runs.
+        total_steps: Total number of timesteps.
+        n_forward: Number of model evaluations per denoising step.
+        model_kwargs_fn: Function that returns additional arguments passed to the model for batch size `bs`.
+
+    """
+    @torch.no_grad()
+    def fn(bs: int):
+        x = torch.randn((bs, *img_shape), device=device)
+        t = torch.randint(0, total_steps, (bs, ), device=device).long()
+        model_kwargs = dict() if model_kwargs_fn is None else model_kwargs_fn(bs)
+        for _ in range(n_forward):
+            model(x, t, **model_kwargs)
+    return fn
+
+
+def make_train_probe(
+        model: nn.Module,
+        diffuser,
+        img_shape,
+        device: torch.device,
+        model_kwargs_fn: Callable[[int], Dict] = None,
+):
+    """Build a probe running the forward and backward pass of the training loss.
+
+    Pass the unwrapped model in distributed mode, so that probing does not trigger gradient synchronization.
+
+    Args:
+        model: The model.
+        diffuser: The diffuser providing `loss_func()` and `total_steps`.
+        img_shape: Shape of a sample, e.g., (C, H, W).
+        device: The device on which the model runs.
+        model_kwargs_fn: Function that returns additional arguments passed to the model for batch size `bs`.
+
+    """
+    def fn(bs: int):
+        x0 = torch.rand((bs, *img_shape), device=device) * 2 - 1
+        t = torch.randint(0, diffuser.total_steps, (bs, ), device=device).long()
+        model_kwargs = dict() if model_kwargs_fn is None else model_kwargs_fn(bs)
+        loss = diffuser.loss_func(model, x0=x0, t=t, model_kwargs=model_kwargs)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    return fn
+
+
+def params_size_mb(model: nn.Module):
+    """Total size of parameters in MB."""
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 1024 ** 2
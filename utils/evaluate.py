@@ -0,0 +1,475 @@
+import os
+import copy
+import json
+import hashlib
+import importlib
+from typing import Dict, List, Sequence
+
+import tqdm
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.transforms as T
+from torch import Tensor
+from torch.utils.data import Dataset, DataLoader
+
+from utils.misc import instantiate_from_config
+
+try:
+    from torch_fidelity.feature_extractor_inceptionv3 import FeatureExtractorInceptionV3
+    TORCH_FIDELITY_IS_AVAILABLE = True
+except ImportError:
+    TORCH_FIDELITY_IS_AVAILABLE = False
+
+
+SUPPORTED_METRICS = ['fid', 'is', 'pr']
+
+
+class InceptionV3FeatureExtractor(nn.Module):
+    def __init__(self):
+        """The InceptionV3 network used by the original TensorFlow implementation of FID and IS.
+
+        The ported weights from torch-fidelity are used, so the results are consistent with the numbers reported in
+        the docs. Input images are expected to be in [-1, 1].
+
+        """
+        super().__init__()
+        if not TORCH_FIDELITY_IS_AVAILABLE:
+            raise ImportError('torch-fidelity is required for InceptionV3FeatureExtractor')
+        self.name = 'inception-v3-compat'
+        self.feature_dim = 2048
+        self.net = FeatureExtractorInceptionV3(
+            name='inception-v3-compat', features_list=['2048', 'logits_unbiased'],
+        )
+        self.net.eval()
+
+    @torch.no_grad()
+    def forward(self, images: Tensor) -> Dict[str, Tensor]:
+        if images.shape[1] == 1:
+            images = images.repeat(1, 3, 1, 1)
+        images = ((images.float().clamp(-1, 1) + 1) / 2 * 255).round().to(dtype=torch.uint8)
+        features, logits = self.net(images)
+        return dict(features=features.float(), logits=logits.float())
+
+
+class TinyFeatureExtractor(nn.Module):
+    def __init__(self, feature_dim: int = 64, num_classes: int = 10, seed: int = 0):
+        """A small randomly initialized network as a stand-in for InceptionV3.
+
+        The weights are fixed by `seed`, so the features are deterministic and can be used to test the evaluation
+        pipeline offline and on CPU. The metrics are NOT comparable with those computed by InceptionV3.
+
+        """
+        super().__init__()
+        self.name = f'tiny-{feature_dim}-{seed}'
+        self.feature_dim = feature_dim
+        generator_state = torch.random.get_rng_state()
+        torch.manual_seed(seed)
+        self.net = nn.Sequential(
+            nn.Conv2d(3, 32, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.Conv2d(32, feature_dim, 3, stride=2, padding=1),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1),
+            nn.Flatten(),
+        )
+        self.fc = nn.Linear(feature_dim, num_classes)
+        torch.random.set_rng_state(generator_state)
+        self.eval()
+
+    @torch.no_grad()
+    def forward(self, images: Tensor) -> Dict[str, Tensor]:
+        if images.shape[1] == 1:
+            images = images.repeat(1, 3, 1, 1)
+        features = self.net(images.float())
+        return dict(features=features, logits=self.fc(features))
+
+
+def build_feature_extractor(name: str) -> nn.Module:
+    """Build a feature extractor by name.
+
+    Args:
+        name: 'inception', 'tiny', or the import path of a custom nn.Module class, e.g. `mypackage.MyExtractor`.
+         A custom extractor should take images in [-1, 1] and return a dict with `features` of shape [B, D] and
+         optionally `logits` of shape [B, K] (required by IS). It should also have a `name` attribute, which is used
+         to key the cached reference statistics.
+
+    """
+    if name == 'inception':
+        return InceptionV3FeatureExtractor()
+    elif name == 'tiny':
+        return TinyFeatureExtractor()
+    elif '.' in name:
+        module, cls = name.rsplit('.', 1)
+        return getattr(importlib.import_module(module, package=None), cls)()
+    else:
+        raise ValueError(f'Invalid feature extractor: {name}')
+
+
+class FeatureStats:
+    def __init__(self, keep_features: bool = False):
+        """Running mean and covariance of features, accumulated in float64.
+
+        Args:
+            keep_features: Whether to keep all the features on CPU, which is required by precision / recall.
+
+        """
+        self.keep_features = keep_features
+        self.n = 0
+        self.sum = None
+        self.sum_outer = None
+        self.features = []
+
+    def update(self, features: Tensor):
+        features = features.detach().reshape(features.shape[0], -1).double()
+        if self.sum is None:
+            self.sum = torch.zeros(features.shape[1], dtype=torch.float64, device=features.device)
+            self.sum_outer = torch.zeros(
+                features.shape[1], features.shape[1], dtype=torch.float64, device=features.device,
+            )
+        self.sum += features.sum(dim=0)
+        self.sum_outer += features.T @ features
+        self.n += features.shape[0]
+        if self.keep_features:
+            self.features.append(features.float().cpu())
+
+    def get_mean_cov(self):
+        if self.n < 2:
+            raise ValueError(f'Invalid number of features: {self.n}, at least 2 are required')
+        mu = self.sum / self.n
+        sigma = (self.sum_outer - self.n * torch.outer(mu, mu)) / (self.n - 1)
+        return mu, sigma
+
+    def get_features(self):
+        if not self.keep_features:
+            raise ValueError('Features are not kept, set keep_features=True')
+        return torch.cat(self.features, dim=0)
+
+
+def save_stats(path: str, mu: Tensor, sigma: Tensor, features: Tensor = None, **meta):
+    """Save statistics to an npz file, compatible with the format of pytorch-fid and clean-fid."""
+    arrays = dict(mu=mu.cpu().numpy(), sigma=sigma.cpu().numpy())
+    if features is not None:
+        arrays['features'] = features.cpu().numpy()
+    if meta:
+        arrays['meta'] = np.array(json.dumps(meta))
+    np.savez(path, **arrays)
+
+
+def load_stats(path: str) -> Dict:
+    """Load statistics saved by `save_stats()` or by pytorch-fid / clean-fid."""
+    with np.load(path) as f:
+        stats = dict(mu=torch.from_numpy(f['mu']).double(), sigma=torch.from_numpy(f['sigma']).double())
+        if 'features' in f:
+            stats['features'] = torch.from_numpy(f['features']).float()
+        if 'meta' in f:
+            stats['meta'] = json.loads(str(f['meta']))
+    return stats
+
+
+def dataset_fingerprint(dataset: Dataset) -> str:
+    """Hash of the content of a dataset, used to detect stale reference statistics.
+
+    For datasets built on a list of image files (`img_paths`), the relative paths and file sizes are hashed. For
+    datasets wrapping torchvision datasets (e.g., CIFAR-10 and MNIST), the raw data array is hashed.
+
+    """
+    h = hashlib.sha1()
+    h.update(f'{type(dataset).__name__}:{len(dataset)}\n'.encode())
+    candidates = [dataset] + [v for v in vars(dataset).values() if isinstance(v, Dataset)]
+    for obj in candidates:
+        img_paths = getattr(obj, 'img_paths', None)
+        if img_paths is not None:
+            root = os.path.commonpath(img_paths) if len(img_paths) > 1 else ''
+            for p in img_paths:
+                h.update(f'{os.path.relpath(p, root) if root else p}:{os.path.getsize(p)}\n'.encode())
+            return h.hexdigest()
+        data = getattr(obj, 'data', None)
+        if data is not None:
+            data = data.numpy() if isinstance(data, Tensor) else np.asarray(data)
+            h.update(np.ascontiguousarray(data).tobytes())
+            return h.hexdigest()
+    raise ValueError(f'Invalid dataset: cannot fingerprint {type(dataset).__name__}')
+
+
+def _make_deterministic(transform):
+    """Remove random flipping and replace random cropping with center cropping."""
+    if not isinstance(transform, T.Compose):
+        return transform
+    transforms = []
+    for t in transform.transforms:
+        if isinstance(t, T.RandomHorizontalFlip):
+            continue
+        if isinstance(t, T.RandomCrop):
+            t = T.CenterCrop(t.size)
+        transforms.append(t)
+    return T.Compose(transforms)
+
+
+def build_ref_dataset(data_conf, split: str = 'train') -> Dataset:
+    """Build a dataset from the data configuration with a deterministic transform, for computing reference
+    statistics."""
+    dataset = instantiate_from_config(copy.deepcopy(data_conf), split=split)
+    if not hasattr(dataset, 'get_transform'):
+        return dataset
+    transform = _make_deterministic(dataset.get_transform())
+    for obj in [dataset] + [v for v in vars(dataset).values() if isinstance(v, Dataset)]:
+        if hasattr(obj, 'transform'):
+            obj.transform = transform
+    return dataset
+
+
+def get_ref_stats_name(data_conf, split: str, extractor_name: str) -> str:
+    """Name of the cached reference statistics, keyed by (dataset class, split, img_size, transform_type,
+    feature extractor)."""
+    dataset_name = data_conf['target'].rsplit('.', 1)[-1]
+    params = data_conf.get('params', dict())
+    img_size = params.get('img_size', None)
+    transform_type = params.get('transform_type', 'default')
+    return f'{dataset_name}-{split}-{img_size}-{transform_type}-{extractor_name}'
+
+
+@torch.no_grad()
+def compute_ref_stats(
+        dataset: Dataset,
+        extractor: nn.Module,
+        batch_size: int = 256,
+        num_workers: int = 4,
+        keep_features: bool = False,
+        device: torch.device = 'cpu',
+        max_samples: int = None,
+):
+    """Compute mean and covariance (and optionally features) of a dataset.
+
+    Returns:
+        A dict with `mu`, `sigma` and optionally `features`.
+
+    """
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    stats = FeatureStats(keep_features=keep_features)
+    for X in tqdm.tqdm(dataloader, desc='Computing reference statistics', leave=False):
+        X = X[0] if isinstance(X, (tuple, list)) else X
+        if max_samples is not None:
+            X = X[:max_samples - stats.n]
+        stats.update(extractor(X.to(device))['features'])
+        if max_samples is not None and stats.n >= max_samples:
+            break
+    mu, sigma = stats.get_mean_cov()
+    ref_stats = dict(mu=mu.cpu(), sigma=sigma.cpu())
+    if keep_features:
+        ref_stats['features'] = stats.get_features()
+    return ref_stats
+
+
+def get_ref_stats(
+        data_conf,
+        extractor: nn.Module,
+        split: str = 'train',
+        cache_dir: str = os.path.join('cache', 'ref_stats'),
+        keep_features: bool = False,
+        recompute: bool = False,
+        logger=None,
+        **kwargs,
+) -> Dict:
+    """Load cached reference statistics of a dataset, or compute and cache them if missing or stale.
+
+    The cache is keyed by `get_ref_stats_name()`, and the fingerprint of the dataset is saved along with the
+    statistics. If the fingerprint does not match the current dataset (e.g., files are added or removed), the cache
+    is regarded as stale and is recomputed.
+
+    Args:
+        data_conf: The `data` field in configuration files.
+        extractor: The feature extractor.
+        split: Split of the dataset.
+        cache_dir: Directory of the cache.
+        keep_features: Whether features are required (by precision / recall).
+        recompute: Recompute even if a valid cache exists.
+        logger: Logger to print messages. Default to print nothing.
+        kwargs: Other arguments passed to `compute_ref_stats()`.
+
+    """
+    dataset = build_ref_dataset(data_conf, split=split)
+    fingerprint = dataset_fingerprint(dataset)
+    path = os.path.join(cache_dir, f'{get_ref_stats_name(data_conf, split, extractor.name)}.npz')
+    if os.path.isfile(path) and not recompute:
+        ref_stats = load_stats(path)
+        if ref_stats.get('meta', dict()).get('fingerprint') != fingerprint:
+            if logger is not None:
+                logger.warning(f'Reference statistics in {path} are stale, recomputing')
+        elif keep_features and 'features' not in ref_stats:
+            if logger is not None:
+                logger.info(f'Reference statistics in {path} do not contain features, recomputing')
+        else:
+            if logger is not None:
+                logger.info(f'Load reference statistics from {path}')
+            return ref_stats
+    ref_stats = compute_ref_stats(dataset, extractor, keep_features=keep_features, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_stats(
+        path, ref_stats['mu'], ref_stats['sigma'], ref_stats.get('features'),
+        fingerprint=fingerprint, n_samples=len(dataset), extractor=extractor.name,
+    )
+    ref_stats['meta'] = dict(fingerprint=fingerprint)
+    if logger is not None:
+        logger.info(f'Reference statistics are saved to {path}')
+    return ref_stats
+
+
+def frechet_distance(mu1: Tensor, sigma1: Tensor, mu2: Tensor, sigma2: Tensor) -> float:
+    """Frechet distance between two Gaussians.
+
+    tr(sqrt(sigma1 @ sigma2)) is computed as the sum of square roots of the eigenvalues of the symmetric matrix
+    sqrt(sigma1) @ sigma2 @ sqrt(sigma1), which avoids scipy and works on GPU.
+
+    """
+    mu1, sigma1, mu2, sigma2 = [x.double() for x in (mu1, sigma1, mu2.to(mu1.device), sigma2.to(mu1.device))]
+    eigvals, eigvecs = torch.linalg.eigh(sigma1)
+    sqrt_sigma1 = (eigvecs * eigvals.clamp_min(0).sqrt()) @ eigvecs.T
+    M = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    tr_covmean = torch.linalg.eigvalsh((M + M.T) / 2).clamp_min(0).sqrt().sum()
+    fid = (mu1 - mu2).square().sum() + torch.trace(sigma1) + torch.trace(sigma2) - 2 * tr_covmean
+    return fid.item()
+
+
+def inception_score(logits: Tensor, n_splits: int = 10):
+    """Inception score and its standard deviation over splits."""
+    probs = F.softmax(logits.double(), dim=1)
+    scores = []
+    for p in probs.chunk(n_splits, dim=0):
+        kl = p * (torch.log(p + 1e-12) - torch.log(p.mean(dim=0, keepdim=True) + 1e-12))
+        scores.append(torch.exp(kl.sum(dim=1).mean()))
+    scores = torch.stack(scores)
+    return scores.mean().item(), scores.std().item() if len(scores) > 1 else 0.
+
+
+def _knn_radii(features: Tensor, k: int, batch_size: int):
+    radii = []
+    for x in features.split(batch_size):
+        d = torch.cdist(x, features)
+        radii.append(d.kthvalue(k + 1, dim=1).values)  # the nearest one is itself
+    return torch.cat(radii)
+
+
+def _coverage(query: Tensor, support: Tensor, radii: Tensor, batch_size: int):
+    inside = []
+    for x in query.split(batch_size):
+        d = torch.cdist(x, support)
+        inside.append((d <= radii[None, :]).any(dim=1))
+    return torch.cat(inside).float().mean().item()
+
+
+def precision_recall(real: Tensor, fake: Tensor, k: int = 3, batch_size: int = 10000):
+    """Improved precision and recall based on k-nearest-neighbor manifolds.
+
+    References:
+        [1] Kynkäänniemi, Tuomas, Tero Karras, Samuli Laine, Jaakko Lehtinen, and Timo Aila. "Improved precision and
+        recall metric for assessing generative models." Advances in Neural Information Processing Systems 32 (2019).
+
+    """
+    fake = fake.to(real.device)
+    real_radii = _knn_radii(real, k, batch_size)
+    fake_radii = _knn_radii(fake, k, batch_size)
+    precision = _coverage(fake, real, real_radii, batch_size)
+    recall = _coverage(real, fake, fake_radii, batch_size)
+    return precision, recall
+
+
+class Evaluator:
+    def __init__(
+            self,
+            extractor: nn.Module,
+            metrics: Sequence[str] = ('fid', ),
+            ref_stats: Dict = None,
+            is_splits: int = 10,
+            pr_k: int = 3,
+    ):
+        """Evaluate generated images on the fly.
+
+        Images are fed into the feature extractor batch by batch, and only the running statistics (plus logits for
+        IS, and features for precision / recall) are kept, so there is no need to save images to disk.
+
+        Args:
+            extractor: The feature extractor, see `build_feature_extractor()`.
+            metrics: A subset of ['fid', 'is', 'pr'].
+            ref_stats: Reference statistics loaded by `load_stats()`. Required by FID (`mu`, `sigma`) and precision /
+             recall (`features`).
+            is_splits: Number of splits for IS.
+            pr_k: Number of nearest neighbors for precision / recall.
+
+        """
+        for m in metrics:
+            if m not in SUPPORTED_METRICS:
+                raise ValueError(f'Invalid metric: {m}')
+        if 'fid' in metrics and ref_stats is None:
+            raise ValueError('Reference statistics are required by FID')
+        if 'pr' in metrics and (ref_stats is None or 'features' not in ref_stats):
+            raise ValueError('Reference features are required by precision / recall')
+        self.extractor = extractor
+        self.metrics = list(metrics)
+        self.ref_stats = ref_stats
+        self.is_splits = is_splits
+        self.pr_k = pr_k
+        self.stats = FeatureStats(keep_features='pr' in metrics)
+        self.logits: List[Tensor] = []
+
+    @torch.no_grad()
+    def extract(self, images: Tensor) -> Dict[str, Tensor]:
+        """Extract features (and logits) of a batch of images in [-1, 1]."""
+        return self.extractor(images)
+
+    def update_features(self, outputs: Dict[str, Tensor]):
+        """Update the statistics with outputs of `extract()`, e.g., after gathering from all processes."""
+        self.stats.update(outputs['features'])
+        if 'is' in self.metrics:
+            if outputs.get('logits') is None:
+                raise ValueError('The feature extractor does not output logits, which are required by IS')
+            self.logits.append(outputs['logits'].detach().float().cpu())
+
+    def update(self, images: Tensor):
+        self.update_features(self.extract(images))
+
+    def compute(self) -> Dict[str, float]:
+        results = dict()
+        if 'fid' in self.metrics:
+            mu, sigma = self.stats.get_mean_cov()
+            results['fid'] = frechet_distance(mu, sigma, self.ref_stats['mu'], self.ref_stats['sigma'])
+        if 'is' in self.metrics:
+            results['is'], results['is_std'] = inception_score(torch.cat(self.logits), self.is_splits)
+        if 'pr' in self.metrics:
+            results['precision'], results['recall'] = precision_recall(
+                self.ref_stats['features'], self.stats.get_features(), k=self.pr_k,
+            )
+        return results
+
+
+def _test():
+    import os
+    import tempfile
+
+    extractor = build_feature_extractor('tiny')
+    # reference statistics
+    ref = FeatureStats(keep_features=True)
+    for _ in range(4):
+        ref.update(extractor(torch.rand(64, 3, 32, 32) * 2 - 1)['features'])
+    mu, sigma = ref.get_mean_cov()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        save_stats(os.path.join(tmpdir, 'ref.npz'), mu, sigma, ref.get_features(), extractor=extractor.name)
+        ref_stats = load_stats(os.path.join(tmpdir, 'ref.npz'))
+    print(ref_stats['meta'])
+
+    # the running mean / covariance matches the batch version
+    feats = ref.get_features().double()
+    assert torch.allclose(mu, feats.mean(dim=0))
+    assert torch.allclose(sigma, torch.cov(feats.T), atol=1e-6)
+    # fid of identical distributions is zero
+    assert abs(frechet_distance(mu, sigma, mu, sigma)) < 1e-6
+
+    evaluator = Evaluator(extractor, metrics=['fid', 'is', 'pr'], ref_stats=ref_stats)
+    for _ in range(4):
+        evaluator.update(torch.rand(64, 3, 32, 32) * 2 - 1)
+    print(evaluator.compute())
+
+
+if __name__ == '__main__':
+    _test()
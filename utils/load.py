@@ -17,3 +17,11 @@ def load_weights(path: str):
         elif 'model' in weights:
             weights = weights['model']                  # saved by this repo
     return weights
+
+
+def get_weights_fingerprint(path: str):
+    """Identify the content of a weights file by its absolute path, size and modification time, e.g., as part of a
+    cache key, so that a file overwritten at the same path (like a rolling 'latest' checkpoint) is not mistaken for
+    the old one."""
+    stat = os.stat(path)
+    return dict(path=os.path.abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
@@ -1,7 +1,7 @@
 import os
 import math
-from PIL import Image, ImageDraw
-from typing import Tuple, List, Union
+from PIL import Image
+from typing import Tuple, List, Sequence, Union
 
 import torch
 from torch.utils.data import Dataset
@@ -25,8 +25,17 @@ class DatasetWithMask(Dataset):
             brush_angle_range: float = 2 * math.pi / 15,
             brush_width_ratio: Tuple[float, float] = (0.02, 0.1),
             is_train: bool = False,
+            lazy_mask: bool = False,
     ):
+        """
+        Args:
+            lazy_mask: If True, return (image, item) instead of (image, mask), and leave the masks to be generated
+             batch-wise by `mask_generator.sample_batch()`, e.g., on GPU after loading a batch.
+            Other arguments are passed to `MaskGenerator`.
+
+        """
         self.dataset = dataset
+        self.lazy_mask = lazy_mask
         self.mask_generator = MaskGenerator(
             mask_type=mask_type,
             dir_path=dir_path,
@@ -48,6 +57,8 @@ class DatasetWithMask(Dataset):
     def __getitem__(self, item):
         image = self.dataset[item]
         image = image[0] if isinstance(image, (tuple, list)) else image
+        if self.lazy_mask:
+            return image, item
         C, H, W = image.shape
         mask = self.mask_generator.sample(int(H), int(W), item)
         return image, mask
@@ -143,79 +154,122 @@ class MaskGenerator:
                     if os.path.splitext(file)[1].lower() in img_ext:
                         self.mask_paths.append(os.path.join(curdir, file))
             self.mask_paths = sorted(self.mask_paths)
+            # preload mask images into memory, which are resized to each requested size once and cached
+            self.mask_images = []
+            for path in self.mask_paths:
+                with Image.open(path) as img:
+                    self.mask_images.append(img.copy())
+        self.dir_cache = dict()
 
     def sample(self, H: int, W: int, item: int = None):
-        if isinstance(item, torch.Tensor):
-            item = item.item()
-        if self.is_train is False and item is not None:
-            rndgn = torch.Generator()
-            rndgn.manual_seed(item + 3407)
-        else:
-            rndgn = torch.default_generator
-
-        mask = torch.ones((1, H, W), dtype=torch.bool)
-        for t in self.mask_type:
-            if t == 'dir':
-                m = self._sample_dir(H, W, rndgn)
-            elif t == 'center':
-                m = self._sample_center(H, W, rndgn)
-            elif t == 'rect':
-                m = self._sample_rectangles(H, W, rndgn)
-            elif t == 'brush':
-                m = self._sample_brushes(H, W, rndgn)
-            elif t == 'half':
-                m = self._sample_half(H, W, rndgn)
-            elif t == 'every-second-line':
-                m = self._sample_every_second_line(H, W)
-            elif t == 'sr2x':
-                m = self._sample_sr2x(H, W)
+        """Sample a mask of shape [1, H, W], where True denotes known areas and False denotes holes."""
+        return self.sample_batch(H, W, [item])[0]
+
+    def sample_batch(
+            self, H: int, W: int,
+            items: Union[int, Sequence[int], torch.Tensor],
+            device: torch.device = 'cpu',
+    ):
+        """Sample a batch of masks of shape [B, 1, H, W] directly on `device`.
+
+        Random parameters (number, positions and sizes of shapes) are drawn per item from the same generator in the
+        same order as `sample()`, so the masks of an item are the same whether it is sampled alone or in a batch.
+        Rectangles and brushstrokes of the whole batch are then rasterized together with vectorized tensor ops.
+
+        Args:
+            H: Height of the masks.
+            W: Width of the masks.
+            items: Indices of the items used for seeding when `is_train` is False, or the batch size.
+            device: The device on which the masks are rasterized.
+
+        """
+        if isinstance(items, int):
+            items = [None] * items
+        elif isinstance(items, torch.Tensor):
+            items = items.tolist()
+        B = len(items)
+
+        boxes, segments, dir_masks = [], [], []
+        pattern = torch.ones((1, H, W), dtype=torch.bool, device=device)
+        for b, item in enumerate(items):
+            if self.is_train is False and item is not None:
+                rndgn = torch.Generator()
+                rndgn.manual_seed(item + 3407)
             else:
-                raise ValueError(f'mask type {t} is not supported')
-            mask = torch.logical_and(mask, m)
+                rndgn = torch.default_generator
+            for t in self.mask_type:
+                if t == 'dir':
+                    dir_masks.append(self._sample_dir(H, W, rndgn))
+                elif t == 'center':
+                    boxes.extend([(b, *box) for box in self._sample_center(H, W, rndgn)])
+                elif t == 'rect':
+                    boxes.extend([(b, *box) for box in self._sample_rectangles(H, W, rndgn)])
+                elif t == 'brush':
+                    segments.extend([(b, *seg) for seg in self._sample_brushes(H, W, rndgn)])
+                elif t == 'half':
+                    boxes.extend([(b, *box) for box in self._sample_half(H, W, rndgn)])
+                elif t not in ['every-second-line', 'sr2x']:
+                    raise ValueError(f'mask type {t} is not supported')
+        if 'every-second-line' in self.mask_type:
+            pattern[:, ::2, :] = False
+        if 'sr2x' in self.mask_type:
+            pattern[:, ::2, :] = False
+            pattern[:, :, ::2] = False
+
+        holes = torch.zeros((B, H * W), device=device)
+        if len(boxes) > 0:
+            _rasterize_boxes(holes, torch.tensor(boxes, device=device), H, W)
+        if len(segments) > 0:
+            _rasterize_segments(holes, torch.tensor(segments, dtype=torch.float, device=device), H, W)
+        mask = (holes == 0).reshape(B, 1, H, W) & pattern
+        if len(dir_masks) > 0:
+            mask = mask & torch.stack(dir_masks).to(device)
         return mask
 
     def _sample_dir(self, H: int, W: int, rndgn: torch.Generator):
-        path = self.mask_paths[torch.randint(0, len(self.mask_paths), (1, ), generator=rndgn).item()]
-        mask = Image.open(path)
-        mask = T.Resize((H, W))(mask)
-        mask = T.ToTensor()(mask)
-        if self.dir_invert_color:
-            mask = torch.where(mask < 0.5, 1., 0.).bool()
-        else:
-            mask = torch.where(mask < 0.5, 0., 1.).bool()
-        return mask
+        index = torch.randint(0, len(self.mask_paths), (1, ), generator=rndgn).item()
+        if (index, H, W) not in self.dir_cache:
+            mask = T.Resize((H, W))(self.mask_images[index])
+            mask = T.ToTensor()(mask)
+            if self.dir_invert_color:
+                mask = torch.where(mask < 0.5, 1., 0.).bool()
+            else:
+                mask = torch.where(mask < 0.5, 0., 1.).bool()
+            self.dir_cache[(index, H, W)] = mask[:1]
+        return self.dir_cache[(index, H, W)]
 
     def _sample_center(self, H: int, W: int, rndgn: torch.Generator):
-        mask = torch.ones((1, H, W)).float()
+        """Returns a list of holes (y0, y1, x0, x1)."""
         min_ratio, max_ratio = self.center_length_ratio
         ratio = torch.rand((1, ), generator=rndgn).item() * (max_ratio - min_ratio) + min_ratio
         h, w = int(ratio * H), int(ratio * W)
-        mask[:, H//2-h//2:H//2+h//2, W//2-w//2:W//2+w//2] = 0.
-        return mask.bool()
+        return [(H//2-h//2, H//2+h//2, W//2-w//2, W//2+w//2)]
 
     def _sample_rectangles(self, H: int, W: int, rndgn: torch.Generator):
+        """Returns a list of holes (y0, y1, x0, x1)."""
         min_num, max_num = self.rect_num
         min_ratio, max_ratio = self.rect_length_ratio
         n_rect = torch.randint(min_num, max_num + 1, (1, ), generator=rndgn).item()
         min_h, max_h = int(min_ratio * H), int(max_ratio * H)
         min_w, max_w = int(min_ratio * W), int(max_ratio * W)
-        mask = torch.ones((1, H, W)).float()
+        boxes = []
         for i in range(n_rect):
             h = torch.randint(min_h, max_h + 1, (1, ), generator=rndgn).item()
             w = torch.randint(min_w, max_w + 1, (1, ), generator=rndgn).item()
             y = torch.randint(0, H - h + 1, (1, ), generator=rndgn).item()
             x = torch.randint(0, W - w + 1, (1, ), generator=rndgn).item()
-            mask[:, y:y+h, x:x+w] = 0.
-        return mask.bool()
+            boxes.append((y, y + h, x, x + w))
+        return boxes
 
     def _sample_brushes(self, H: int, W: int, rndgn: torch.Generator):
+        """Returns a list of line segments (x0, y0, x1, y1, radius) with round caps."""
         min_num, max_num = self.brush_num
         min_n_vertex, max_n_vertex = self.brush_n_vertex
         min_width = int(self.brush_width_ratio[0] * min(H, W))
         max_width = int(self.brush_width_ratio[1] * min(H, W))
         n_brush = torch.randint(min_num, max_num + 1, (1, ), generator=rndgn).item()
         average_radius = math.sqrt(H * H + W * W) / 8
-        mask = Image.new('L', (W, H), 255)
+        brushes, flips = [], []
         for i in range(n_brush):
             n_vertex = torch.randint(min_n_vertex, max_n_vertex + 1, (1, ), generator=rndgn).item()
             width = torch.randint(min_width, max_width + 1, (1, ), generator=rndgn).item()
@@ -236,51 +290,66 @@ class MaskGenerator:
                 new_x = min(max(vertex[-1][0] + r * math.cos(angle), 0), W)
                 new_y = min(max(vertex[-1][1] + r * math.sin(angle), 0), H)
                 vertex.append((new_x, new_y))
-            draw = ImageDraw.Draw(mask)
-            draw.line(vertex, fill=0, width=width)
-            for v in vertex:
-                draw.ellipse((v[0] - width // 2,
-                              v[1] - width // 2,
-                              v[0] + width // 2,
-                              v[1] + width // 2), fill=0)
-            if torch.rand(1, generator=rndgn) > 0.5:
-                mask = mask.transpose(Image.Transpose.FLIP_LEFT_RIGHT)  # noqa
-            if torch.rand(1, generator=rndgn) > 0.5:
-                mask = mask.transpose(Image.Transpose.FLIP_TOP_BOTTOM)  # noqa
-        if torch.rand(1, generator=rndgn) > 0.5:
-            mask = mask.transpose(Image.Transpose.FLIP_LEFT_RIGHT)      # noqa
-        if torch.rand(1, generator=rndgn) > 0.5:
-            mask = mask.transpose(Image.Transpose.FLIP_TOP_BOTTOM)      # noqa
-        mask = T.ToTensor()(mask)
-        mask = torch.where(mask < 0.5, 0., 1.).bool()
-        return mask
+            brushes.append((vertex, width))
+            # the whole mask drawn so far is flipped after each brush
+            flips.append((torch.rand(1, generator=rndgn).item() > 0.5, torch.rand(1, generator=rndgn).item() > 0.5))
+        flips.append((torch.rand(1, generator=rndgn).item() > 0.5, torch.rand(1, generator=rndgn).item() > 0.5))
+
+        segments = []
+        for i, (vertex, width) in enumerate(brushes):
+            # a brush is flipped by all the flips after it, which are composed into one
+            flip_lr = sum(f[0] for f in flips[i:]) % 2 == 1
+            flip_tb = sum(f[1] for f in flips[i:]) % 2 == 1
+            vertex = [(W - 1 - x if flip_lr else x, H - 1 - y if flip_tb else y) for x, y in vertex]
+            for (x0, y0), (x1, y1) in zip(vertex[:-1], vertex[1:]):
+                segments.append((x0, y0, x1, y1, width / 2))
+        return segments
 
     @staticmethod
     def _sample_half(H: int, W: int, rndgn: torch.Generator):
-        mask = torch.ones((1, H, W)).float()
+        """Returns a list of holes (y0, y1, x0, x1)."""
         direction = torch.randint(0, 4, (1, ), generator=rndgn).item()
         if direction == 0:
-            mask[:, :H//2, :] = 0.
+            return [(0, H//2, 0, W)]
         elif direction == 1:
-            mask[:, H//2:, :] = 0.
+            return [(H//2, H, 0, W)]
         elif direction == 2:
-            mask[:, :, :W//2] = 0.
+            return [(0, H, 0, W//2)]
         else:
-            mask[:, :, W//2:] = 0.
-        return mask.bool()
-
-    @staticmethod
-    def _sample_every_second_line(H: int, W: int):
-        mask = torch.ones((1, H, W)).float()
-        mask[:, ::2, :] = 0.
-        return mask.bool()
-
-    @staticmethod
-    def _sample_sr2x(H: int, W: int):
-        mask = torch.ones((1, H, W)).float()
-        mask[:, ::2, :] = 0.
-        mask[:, :, ::2] = 0.
-        return mask.bool()
+            return [(0, H, W//2, W)]
+
+
+def _rasterize_boxes(holes: torch.Tensor, boxes: torch.Tensor, H: int, W: int, max_elements: int = 2 ** 24):
+    """Accumulate coverage of boxes [N, 5] (batch index, y0, y1, x0, x1) into holes [B, H*W] in place."""
+    ys = torch.arange(H, device=holes.device)
+    xs = torch.arange(W, device=holes.device)
+    for chunk in boxes.split(max(1, max_elements // (H * W))):
+        b, y0, y1, x0, x1 = chunk.unbind(dim=1)
+        inside_y = (ys[None, :] >= y0[:, None]) & (ys[None, :] < y1[:, None])
+        inside_x = (xs[None, :] >= x0[:, None]) & (xs[None, :] < x1[:, None])
+        covered = inside_y[:, :, None] & inside_x[:, None, :]
+        holes.index_add_(0, b, covered.reshape(len(chunk), H * W).float())
+
+
+def _rasterize_segments(holes: torch.Tensor, segments: torch.Tensor, H: int, W: int, max_elements: int = 2 ** 23):
+    """Accumulate coverage of segments [S, 6] (batch index, x0, y0, x1, y1, radius) into holes [B, H*W] in place.
+
+    A pixel is covered if its distance to the segment is within the radius, i.e., a line with round caps.
+    """
+    ys, xs = torch.meshgrid(
+        torch.arange(H, device=holes.device, dtype=torch.float),
+        torch.arange(W, device=holes.device, dtype=torch.float),
+        indexing='ij',
+    )
+    ys, xs = ys.reshape(1, -1), xs.reshape(1, -1)
+    for chunk in segments.split(max(1, max_elements // (H * W))):
+        b, x0, y0, x1, y1, radius = [v[:, None] for v in chunk.unbind(dim=1)]
+        dx, dy = x1 - x0, y1 - y0
+        px, py = xs - x0, ys - y0
+        t = ((px * dx + py * dy) / (dx * dx + dy * dy).clamp_min(1e-12)).clamp(0, 1)
+        dist2 = (px - t * dx) ** 2 + (py - t * dy) ** 2
+        covered = dist2 <= radius ** 2
+        holes.index_add_(0, b[:, 0].long(), covered.float())
 
 
 def _test(**kwargs):
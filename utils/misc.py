@@ -75,6 +75,53 @@ def instantiate_from_config(conf, **extra_params):
     return cls(**params)
 
 
+class SampleGenerator:
+    def __init__(self, seed: int, indices, device: torch.device = 'cpu'):
+        """Random number generators for each sample in a batch.
+
+        Each sample has its own generator seeded by (seed, global index of the sample), so the random numbers of a
+        sample do not depend on the batch size, the number of processes, or the other samples in the batch.
+
+        Args:
+            seed: The base random seed.
+            indices: Global indices of samples in the batch.
+            device: Device of the generated tensors.
+
+        """
+        self.device = device
+        self.generators = [
+            torch.Generator(device=device).manual_seed(self.get_seed(seed, index))
+            for index in indices
+        ]
+
+    @classmethod
+    def from_seeds(cls, seeds, device: torch.device = 'cpu'):
+        """Random number generators seeded directly by the given per-sample seeds."""
+        generator = cls(0, [], device)
+        generator.generators = [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+        return generator
+
+    @staticmethod
+    def get_seed(seed: int, index: int):
+        """The seed of the sample with global index `index`. """
+        return seed * 2 ** 32 + int(index)
+
+    def __len__(self):
+        return len(self.generators)
+
+    def randn(self, shape, dtype: torch.dtype = torch.float32):
+        """Draw a Tensor of shape [len(self), *shape] from the standard normal distribution."""
+        return torch.stack([
+            torch.randn(shape, generator=g, device=self.device, dtype=dtype)
+            for g in self.generators
+        ], dim=0)
+
+    def randn_like(self, x: torch.Tensor):
+        if x.shape[0] != len(self):
+            raise ValueError(f'Invalid batch size: {x.shape[0]}, expected {len(self)}')
+        return self.randn(x.shape[1:], dtype=x.dtype).to(x.device)
+
+
 class AverageMeter:
     """
     Computes and stores the average and current value
@@ -0,0 +1,126 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict
+
+import torch
+
+
+class StepProfiler:
+    def __init__(self, enabled: bool = False, device: torch.device = None, data_ready_ms: float = 1.0):
+        """Measure the time breakdown and throughput of training steps.
+
+        GPU work is timed with CUDA events, which are only synchronized when `summary()` is called, so profiling
+        does not stall the pipeline. Phases that happen on the host (e.g., fetching data) are timed with the wall
+        clock. Throughput only counts the time between the first phase of a step and `step()`, so that periodic
+        work such as sampling and checkpointing is excluded. When disabled, `phase()` returns a null context and all
+        other methods are no-ops.
+
+        CUDA events are recorded on the current stream, so communication launched on other streams and overlapped
+        with computation (e.g., the gradient all-reduce of DDP in the backward pass) is counted only as far as it
+        delays the phase that launches it, and cannot be separated from computation within that phase.
+
+        Args:
+            enabled: Whether to enable profiling.
+            device: The device on which the model runs.
+            data_ready_ms: A batch is counted as ready (i.e., already prefetched by the dataloader workers) if it is
+             fetched within this time.
+
+        """
+        self.enabled = enabled
+        self.use_cuda = (
+            enabled and torch.cuda.is_available() and
+            device is not None and torch.device(device).type == 'cuda'
+        )
+        self.data_ready_ms = data_ready_ms
+        self.reset()
+
+    def reset(self):
+        self.cuda_events = defaultdict(list)
+        self.host_ms = defaultdict(float)
+        self.n_steps = 0
+        self.n_images = 0
+        self.n_data_ready = 0
+        self.n_data_fetch = 0
+        self.elapsed = 0.
+        self.step_start = None
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def phase(self, name: str, host: bool = False):
+        """Context manager timing a phase. Time of the same phase is accumulated within a step.
+
+        Args:
+            name: Name of the phase.
+            host: Time on the host with the wall clock instead of CUDA events.
+
+        """
+        if not self.enabled:
+            return nullcontext()
+        if self.step_start is None:
+            self.step_start = time.perf_counter()
+        if host or not self.use_cuda:
+            return self._host_phase(name)
+        return self._cuda_phase(name)
+
+    @contextmanager
+    def _host_phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        elapsed = (time.perf_counter() - start) * 1000
+        self.host_ms[name] += elapsed
+        if name == 'data':
+            self.n_data_fetch += 1
+            self.n_data_ready += int(elapsed <= self.data_ready_ms)
+
+    @contextmanager
+    def _cuda_phase(self, name: str):
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record()
+        yield
+        end.record()
+        self.cuda_events[name].append((start, end))
+
+    def step(self, n_images: int):
+        """Mark the end of a step.
+
+        Args:
+            n_images: Number of images processed in this step, over all processes.
+
+        """
+        if not self.enabled or self.step_start is None:
+            return
+        self.elapsed += time.perf_counter() - self.step_start
+        self.step_start = None
+        self.n_steps += 1
+        self.n_images += n_images
+
+    def summary(self, reset: bool = True) -> Dict[str, float]:
+        """Return the averaged statistics since last reset.
+
+        Returns:
+            A dict containing `img_per_sec`, `step_ms`, `{phase}_ms` (averaged per step), `data_ready` (fraction
+            of batches that were already prefetched) and `peak_mem_mb` (peak allocated memory, CUDA only).
+
+        """
+        if not self.enabled or self.n_steps == 0:
+            return dict()
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        status = dict(
+            img_per_sec=self.n_images / self.elapsed,
+            step_ms=self.elapsed * 1000 / self.n_steps,
+        )
+        phase_ms = defaultdict(float, self.host_ms)
+        for name, events in self.cuda_events.items():
+            phase_ms[name] += sum(start.elapsed_time(end) for start, end in events)
+        for name, ms in phase_ms.items():
+            status[f'{name}_ms'] = ms / self.n_steps
+        if self.n_data_fetch > 0:
+            status['data_ready'] = self.n_data_ready / self.n_data_fetch
+        if self.use_cuda:
+            status['peak_mem_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        if reset:
+            self.reset()
+        return status
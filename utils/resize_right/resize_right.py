@@ -1,6 +1,7 @@
 import warnings
 from math import ceil
 from fractions import Fraction
+from functools import lru_cache
 from utils.resize_right import interp_methods
 
 
@@ -38,6 +39,17 @@ def resize(input, scale_factors=None, out_shape=None,
     # fw stands for framework that can be either numpy or torch,
     # determined by the input type
     fw = numpy if type(input) is numpy.ndarray else torch
+
+    # for torch tensors, the resizing of each dim is a linear operator that
+    # only depends on the shapes and arguments, so we build it once as a
+    # matrix per dim and cache it. repeated resizes of the same shape (e.g.
+    # in every denoising step) then become a few small matmuls.
+    if fw is torch and by_convs is False and input.is_floating_point():
+        plan = get_resize_plan(tuple(in_shape), _to_hashable(scale_factors),
+                               _to_hashable(out_shape), interp_method,
+                               support_sz, antialiasing, pad_mode,
+                               input.device, input.dtype)
+        return plan(input)
     eps = fw.finfo(fw.float32).eps
     device = input.device if fw is torch else None
 
@@ -122,6 +134,100 @@ def resize(input, scale_factors=None, out_shape=None,
     return output
 
 
+def _to_hashable(x):
+    return tuple(x) if isinstance(x, (list, tuple)) else x
+
+
+class ResizePlan:
+    """Precomputed resizing of torch tensors of a fixed shape.
+
+    Resizing along each dim is represented by a dense [out_sz, in_sz] matrix,
+    obtained by resizing an identity matrix with the same steps as `resize`,
+    so padding and antialiasing are included. Applying the plan is a matmul
+    per resized dim. Use `get_resize_plan` to get a cached plan.
+    """
+    def __init__(self, in_shape, scale_factors=None, out_shape=None,
+                 interp_method=interp_methods.cubic, support_sz=None,
+                 antialiasing=True, pad_mode='constant', device=None,
+                 dtype=None):
+        if torch is None:
+            raise ImportError("ResizePlan requires PyTorch")
+        eps = torch.finfo(torch.float32).eps
+        scale_factors = (list(scale_factors)
+                         if isinstance(scale_factors, (list, tuple))
+                         else scale_factors)
+        scale_factors, out_shape, _ = set_scale_and_out_sz(in_shape,
+                                                           out_shape,
+                                                           scale_factors,
+                                                           False, None, 10,
+                                                           eps, torch)
+        if support_sz is None:
+            support_sz = interp_method.support_sz
+        self.in_shape = tuple(in_shape)
+        self.out_shape = tuple(out_shape)
+        self.n_dims = len(in_shape)
+        # same order of dims as `resize`
+        self.matrices = [(dim, get_resize_matrix(in_shape[dim],
+                                                 out_shape[dim],
+                                                 scale_factors[dim],
+                                                 interp_method, support_sz,
+                                                 antialiasing, pad_mode,
+                                                 device, dtype))
+                         for dim in sorted(range(self.n_dims),
+                                           key=lambda ind: scale_factors[ind])
+                         if scale_factors[dim] != 1.]
+
+    def __call__(self, input):
+        output = input
+        for dim, matrix in self.matrices:
+            if dim == self.n_dims - 1:
+                output = output @ matrix.T
+            elif dim == self.n_dims - 2:
+                output = matrix @ output
+            else:
+                output = (output.movedim(dim, -1) @ matrix.T).movedim(-1, dim)
+        return output
+
+
+@lru_cache(maxsize=64)
+def get_resize_plan(in_shape, scale_factors=None, out_shape=None,
+                    interp_method=interp_methods.cubic, support_sz=None,
+                    antialiasing=True, pad_mode='constant', device=None,
+                    dtype=None):
+    # all arguments should be hashable, i.e., tuples instead of lists
+    return ResizePlan(in_shape, scale_factors, out_shape, interp_method,
+                      support_sz, antialiasing, pad_mode, device, dtype)
+
+
+@lru_cache(maxsize=128)
+def get_resize_matrix(in_sz, out_sz, scale_factor, interp_method, support_sz,
+                      antialiasing, pad_mode, device, dtype):
+    # the same steps as in `resize` for a single dim, see comments there
+    eps = torch.finfo(torch.float32).eps
+    projected_grid = get_projected_grid(in_sz, out_sz, scale_factor, torch,
+                                        False, device)
+    cur_interp_method, cur_support_sz = apply_antialiasing_if_needed(
+                                                            interp_method,
+                                                            support_sz,
+                                                            scale_factor,
+                                                            antialiasing)
+    field_of_view = get_field_of_view(projected_grid, cur_support_sz, torch,
+                                      eps, device)
+    pad_sz, projected_grid, field_of_view = calc_pad_sz(in_sz, out_sz,
+                                                        field_of_view,
+                                                        projected_grid,
+                                                        scale_factor, False,
+                                                        torch, device)
+    weights = get_weights(cur_interp_method, projected_grid, field_of_view)
+    # resizing the columns of an identity matrix gives the matrix of the
+    # operator. a trailing singleton dim is added so that padding works on
+    # the first dim.
+    eye = torch.eye(in_sz, device=device)[:, :, None]
+    matrix = apply_weights(eye, field_of_view, weights, 0, 3, pad_sz,
+                           pad_mode, torch)[..., 0]
+    return matrix if dtype is None else matrix.to(dtype)
+
+
 def get_projected_grid(in_sz, out_sz, scale_factor, fw, by_convs, device=None):
     # we start by having the ouput coordinates which are just integer locations
     # in the special case when usin by_convs, we only need two cycles of grid
@@ -0,0 +1,255 @@
+import os
+import glob
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Union
+
+import numpy as np
+from torch import Tensor
+from torchvision.utils import save_image
+
+from utils.misc import image_norm_to_uint8
+
+
+class ImageWriter:
+    def __init__(self, max_workers: int = None, max_pending: int = 256, image_format: str = None):
+        """Save images in a background thread pool.
+
+        The caller copies images to CPU and submits them with `save()`, which returns immediately, so that encoding
+        (PNG / JPEG / WebP) overlaps with sampling of the next batch. PIL releases the GIL when encoding, so threads
+        are sufficient. The number of pending images is bounded by `max_pending`, and `save()` blocks when the queue
+        is full, which limits the memory held by the writer.
+
+        Args:
+            max_workers: Number of threads. Default to min(8, number of CPUs).
+            max_pending: Maximum number of images waiting to be saved.
+            image_format: If specified, replace the file extension of paths with it, e.g., 'png', 'jpg' or 'webp'.
+
+        """
+        if max_workers is None:
+            max_workers = min(8, os.cpu_count() or 1)
+        if image_format is not None and image_format.lower() not in ['png', 'jpg', 'jpeg', 'webp']:
+            raise ValueError(f'Invalid image_format: {image_format}')
+        self.image_format = image_format
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def _save(self, images, path, callback, kwargs):
+        try:
+            save_image(images, path, **kwargs)
+            if callback is not None:
+                callback()
+        finally:
+            self.semaphore.release()
+
+    def save(self, images: Union[Tensor, List[Tensor]], path: str, callback: Callable = None, **kwargs):
+        """Submit images to be saved, other arguments are the same as `torchvision.utils.save_image()`.
+
+        Images should be on CPU, otherwise the device-to-host copy is done in the background threads. `callback` is
+        called in the background thread after the images are saved, e.g., to record the progress.
+
+        """
+        if self.image_format is not None:
+            path = f'{os.path.splitext(path)[0]}.{self.image_format}'
+        self.semaphore.acquire()
+        self.futures.append(self.executor.submit(self._save, images, path, callback, kwargs))
+        # drop finished futures and raise their exceptions early
+        if len(self.futures) >= 1024:
+            self._collect(wait=False)
+
+    def _collect(self, wait: bool):
+        pending = []
+        for future in self.futures:
+            if wait or future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def flush(self):
+        """Wait until all the submitted images are saved."""
+        self._collect(wait=True)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ArrayWriter:
+    def __init__(
+            self,
+            save_dir: str,
+            n_samples: int,
+            with_labels: bool = False,
+            with_seeds: bool = False,
+            exist_ok: bool = False,
+            is_main_process: bool = True,
+            sync_fn: Callable = None,
+    ):
+        """Write samples into preallocated memory-mapped npy files, supporting random access by global index.
+
+        Files under `save_dir`:
+          - samples.npy: uint8 array of shape [N, ..., H, W, C], e.g., [N, H, W, C] for images and [N, T, H, W, C]
+            for trajectories. The channel-last layout is the same as the npz files used by the evaluation suite of
+            guided-diffusion, and can be loaded by `np.load(path, mmap_mode='r')` without reading the whole file.
+          - labels.npy: int64 array of shape [N], if `with_labels`.
+          - seeds.npy: int64 array of shape [N], if `with_seeds`.
+
+        The files are created on the first call of `write()`, when the shape of samples is known. In distributed
+        mode where every process writes its own samples, pass `sync_fn=accelerator.wait_for_everyone` so that the
+        main process creates the files before the others open them; in this case all processes must call `write()`
+        in the first fold, possibly with empty indices.
+
+        Args:
+            save_dir: Directory of the files.
+            n_samples: Total number of samples N.
+            with_labels: Whether to save labels.
+            with_seeds: Whether to save seeds.
+            exist_ok: Open the existing files, e.g., when resuming a job. Raise an error if their shapes or dtypes
+             do not match.
+            is_main_process: Whether the current process is the main process, which creates the files.
+            sync_fn: Function to synchronize processes after the files are created.
+
+        """
+        self.save_dir = save_dir
+        self.n_samples = n_samples
+        self.fields = ['samples'] + (['labels'] if with_labels else []) + (['seeds'] if with_seeds else [])
+        self.exist_ok = exist_ok
+        self.is_main_process = is_main_process
+        self.sync_fn = sync_fn
+        self.arrays: Dict[str, np.memmap] = dict()
+
+    def _create(self, sample_shape):
+        shapes = dict(samples=(self.n_samples, *sample_shape), labels=(self.n_samples, ), seeds=(self.n_samples, ))
+        dtypes = dict(samples=np.uint8, labels=np.int64, seeds=np.int64)
+        if self.is_main_process:
+            for field in self.fields:
+                path = os.path.join(self.save_dir, f'{field}.npy')
+                if self.exist_ok and os.path.isfile(path):
+                    arr = np.load(path, mmap_mode='r')
+                    if arr.shape != shapes[field] or arr.dtype != dtypes[field]:
+                        # recreating the file would lose the samples recorded as completed by the manifest
+                        raise ValueError(
+                            f'Invalid existing file {path}: expected shape {shapes[field]} and dtype '
+                            f'{np.dtype(dtypes[field])}, got shape {arr.shape} and dtype {arr.dtype}'
+                        )
+                    continue
+                np.lib.format.open_memmap(path, mode='w+', dtype=dtypes[field], shape=shapes[field]).flush()
+        if self.sync_fn is not None:
+            self.sync_fn()
+        for field in self.fields:
+            self.arrays[field] = np.load(os.path.join(self.save_dir, f'{field}.npy'), mmap_mode='r+')
+
+    def write(self, indices: Iterable[int], samples: Tensor, labels: Iterable[int] = None, seeds: Iterable[int] = None):
+        """Write samples in [-1, 1] of shape [B, ..., C, H, W] at `indices`."""
+        samples = image_norm_to_uint8(samples.float().cpu()).movedim(-3, -1).numpy()
+        if not self.arrays:
+            self._create(samples.shape[1:])
+        indices = list(indices)
+        if len(indices) == 0:
+            return
+        # use slicing for contiguous indices, which is faster than fancy indexing
+        if indices == list(range(indices[0], indices[0] + len(indices))):
+            indices = slice(indices[0], indices[0] + len(indices))
+        self.arrays['samples'][indices] = samples
+        if labels is not None and 'labels' in self.arrays:
+            self.arrays['labels'][indices] = np.asarray(list(labels), dtype=np.int64)
+        if seeds is not None and 'seeds' in self.arrays:
+            self.arrays['seeds'][indices] = np.asarray(list(seeds), dtype=np.int64)
+
+    def flush(self):
+        """Flush the written samples to disk."""
+        for arr in self.arrays.values():
+            arr.flush()
+
+    def close(self):
+        self.flush()
+        self.arrays = dict()
+
+
+class Manifest:
+    def __init__(self, save_dir: str, rank: int = 0, name: str = 'manifest'):
+        """Record saved samples of one process in a part file `{name}-rank{rank}.jsonl` under `save_dir`.
+
+        Each line is a json object with the global index, the file path relative to `save_dir`, and optional extra
+        information. Part files of all processes are merged by `Manifest.merge()` in the end. Records are flushed
+        line by line and `add()` is thread-safe, so the part file also serves as the progress of an unfinished job.
+
+        """
+        self.save_dir = save_dir
+        self.name = name
+        self.part_path = os.path.join(save_dir, f'{name}-rank{rank}.jsonl')
+        self.file = open(self.part_path, 'w', buffering=1)
+        self.lock = threading.Lock()
+
+    def add(self, index: int, file: str, **info):
+        with self.lock:
+            self.file.write(json.dumps(dict(index=index, file=file, **info)) + '\n')
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(save_dir: str, name: str = 'manifest') -> List[dict]:
+        """Load records in `{name}.jsonl`, return an empty list if it does not exist."""
+        path = os.path.join(save_dir, f'{name}.jsonl')
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    @staticmethod
+    def merge(save_dir: str, name: str = 'manifest', include_existing: bool = False):
+        """Merge part files into `{name}.jsonl` sorted by index, and remove the part files. Returns the number of
+        records.
+
+        Args:
+            save_dir: Directory of the manifest.
+            name: Name of the manifest.
+            include_existing: Keep the records in the existing `{name}.jsonl`, e.g., when resuming a job.
+
+        """
+        records = dict()
+        merged_path = os.path.join(save_dir, f'{name}.jsonl')
+        part_paths = sorted(glob.glob(os.path.join(save_dir, f'{name}-rank*.jsonl')))
+        for record in (Manifest.load(save_dir, name) if include_existing else []):
+            records[record['index']] = record
+        for path in part_paths:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # empty or truncated line of a killed job
+                    records[record['index']] = record
+        with open(merged_path, 'w') as f:
+            for index in sorted(records):
+                f.write(json.dumps(records[index]) + '\n')
+        for path in part_paths:
+            os.remove(path)
+        return len(records)
+
+
+def get_shard_indices(offset: int, bs: int, bspp: int, rank: int):
+    """Global indices of the samples generated by a process in a fold.
+
+    The indices are consistent with the order of `accelerator.gather()`, i.e., process `rank` generates samples
+    [offset + rank * bspp, offset + (rank + 1) * bspp), and those beyond the fold size `bs` are padding.
+
+    Args:
+        offset: Global index of the first sample in the fold.
+        bs: Number of valid samples in the fold over all processes.
+        bspp: Batch size per process.
+        rank: Index of the process.
+
+    """
+    start = offset + rank * bspp
+    return list(range(start, min(start + bspp, offset + bs)))